@@ -0,0 +1,233 @@
+"""Benchmark de la capa de datos del inventario sobre conteos sintéticos
+
+Siembra conteos sintéticos (sobre el catálogo y los almacenes reales) hasta
+cada tamaño pedido y mide las operaciones de lectura y escritura de la app.
+Guarda p50/p95 de latencia y el pico de memoria (RSS) en un JSON para
+comparar entre versiones:
+
+    BENCHMARK_DATABASE_URL=postgresql://localhost/inventario_bench \\
+        python benchmark.py --filas 10000 100000 1000000 --salida resultados.json
+
+Usa una base PostgreSQL propia: el esquema (particiones, triggers, índices)
+es el mismo que en producción. Los conteos sembrados se marcan con el
+responsable "benchmark" y se reutilizan entre corridas.
+"""
+import argparse
+import io
+import json
+import os
+import resource
+import sys
+import time
+import uuid
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+
+if "BENCHMARK_DATABASE_URL" not in os.environ:
+    sys.exit("Define BENCHMARK_DATABASE_URL con una base PostgreSQL exclusiva para el benchmark")
+# La capa de datos lee DATABASE_URL al importarse
+os.environ["DATABASE_URL"] = os.environ["BENCHMARK_DATABASE_URL"]
+
+from sqlalchemy import text
+
+import inventario_datos as datos
+
+RESPONSABLE_BENCHMARK = "benchmark"
+DIAS_SINTETICOS = 730      # los conteos se reparten en los últimos dos años
+BLOQUE_SIEMBRA = 500_000   # filas por COPY al sembrar
+FILAS_DEFECTO = (10_000, 100_000, 1_000_000, 10_000_000)
+
+def rss_pico_mb():
+    """Devuelve el pico de memoria residente del proceso en MB"""
+    pico = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux informa en KB, macOS en bytes
+    return round(pico / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+def verificar_base():
+    """Aborta si la base tiene conteos que no fueron sembrados por el benchmark"""
+    with datos.engine.connect() as conn:
+        ajenos = conn.execute(
+            text("SELECT EXISTS (SELECT 1 FROM inventario WHERE responsable <> :responsable)"),
+            {"responsable": RESPONSABLE_BENCHMARK}
+        ).scalar()
+    if ajenos:
+        sys.exit("La base tiene conteos reales; el benchmark necesita una base propia")
+
+def contar_filas():
+    """Cuenta los conteos de la tabla inventario"""
+    with datos.engine.connect() as conn:
+        return conn.execute(text("SELECT count(*) FROM inventario")).scalar()
+
+def filas_sinteticas(tabla_catalogo, n, rng):
+    """Genera n conteos sintéticos con las columnas de COLUMNAS_REGISTRO"""
+    elegidos = tabla_catalogo.iloc[rng.integers(0, len(tabla_catalogo), n)]
+    cantidades = rng.integers(1, 500, n)
+    segundos = rng.integers(0, DIAS_SINTETICOS * 86400, n)
+    fechas = pd.Timestamp.now().floor("s") - pd.to_timedelta(segundos, unit="s")
+    return pd.DataFrame({
+        "id_cliente": [str(uuid.uuid4()) for _ in range(n)],
+        "fecha_hora": fechas.strftime("%Y-%m-%d %H:%M:%S"),
+        "codigo": elegidos["codigo"].to_numpy(),
+        "producto": elegidos.index.to_numpy(),
+        "clasificacion": elegidos["clasificacion"].to_numpy(),
+        "linea": elegidos["linea"].to_numpy(),
+        "presentacion": elegidos["presentacion"].to_numpy(),
+        "cantidad_unidades": cantidades,
+        "total_kg_lt": cantidades * elegidos["factor"].to_numpy(),
+        "unidad_medida": elegidos["unidad"].to_numpy(),
+        "almacen": np.array(datos.ALMACENES)[rng.integers(0, len(datos.ALMACENES), n)],
+        "responsable": RESPONSABLE_BENCHMARK,
+        "observaciones": "",
+    }, columns=datos.COLUMNAS_REGISTRO)
+
+def sembrar(tabla_catalogo, n, rng):
+    """Agrega n conteos sintéticos con COPY a una tabla temporal, en bloques de BLOQUE_SIEMBRA filas"""
+    columnas = ", ".join(datos.COLUMNAS_REGISTRO)
+    hoy = datetime.now().date()
+    for inicio in range(0, n, BLOQUE_SIEMBRA):
+        df = filas_sinteticas(tabla_catalogo, min(BLOQUE_SIEMBRA, n - inicio), rng)
+        buffer = io.StringIO()
+        df.to_csv(buffer, index=False, header=False)
+        buffer.seek(0)
+        with datos.engine.begin() as conn:
+            datos.sin_timeout(conn)
+            conn.execute(
+                text("SELECT asegurar_particiones_inventario(:desde, :hasta)"),
+                {"desde": hoy - timedelta(days=DIAS_SINTETICOS), "hasta": hoy}
+            )
+            conn.execute(text(f"""
+                CREATE TEMP TABLE benchmark_staging ON COMMIT DROP AS
+                SELECT {columnas} FROM inventario WITH NO DATA
+            """))
+            cursor = conn.connection.cursor()
+            cursor.copy_expert(f"COPY benchmark_staging ({columnas}) FROM STDIN WITH (FORMAT csv)", buffer)
+            datos.integrar_conteos(conn, "benchmark_staging o")
+    with datos.engine.connect() as conn:
+        conn.execution_options(isolation_level="AUTOCOMMIT").execute(text("ANALYZE conteos"))
+
+def medir(funcion, repeticiones):
+    """Ejecuta la función varias veces y devuelve p50/p95 en milisegundos"""
+    tiempos = []
+    for _ in range(repeticiones):
+        inicio = time.perf_counter()
+        funcion()
+        tiempos.append((time.perf_counter() - inicio) * 1000)
+    return {
+        "p50_ms": round(float(np.percentile(tiempos, 50)), 2),
+        "p95_ms": round(float(np.percentile(tiempos, 95)), 2),
+        "muestras": len(tiempos),
+        "rss_pico_mb": rss_pico_mb(),
+    }
+
+def sin_cache(funcion, *args):
+    """Llama a una consulta cacheada vaciando antes su caché, para medir la consulta real"""
+    funcion.clear()
+    return funcion(*args)
+
+def exportar(formato):
+    """Genera una exportación completa y borra el archivo"""
+    os.remove(datos.generar_exportacion(formato))
+
+def medir_operaciones(catalogo, filas, repeticiones, repeticiones_exportacion):
+    """Mide las operaciones de la app con el tamaño de inventario actual"""
+    hoy = datetime.now().date()
+    base = datos.FiltrosHistorial(desde=hoy - timedelta(days=datos.HISTORIAL_DIAS), hasta=hoy)
+    filtrado = base._replace(
+        almacenes=(datos.ALMACENES[0],), clasificaciones=("Producto Terminado",), busqueda="sulfato"
+    )
+    version = datos.version_datos()
+    producto = next(iter(catalogo))
+
+    def selector_eliminar():
+        df, _ = sin_cache(datos.obtener_historial, version, base._replace(busqueda="magnesio"))
+        datos.etiquetas_registros(df)
+
+    def guardar():
+        datos.guardar_registro(datos.crear_registro(
+            catalogo, producto, 10, datos.ALMACENES[0], RESPONSABLE_BENCHMARK, "benchmark"
+        ))
+
+    operaciones = {
+        "historial": lambda: sin_cache(datos.obtener_historial, version, base),
+        "historial_filtros": lambda: sin_cache(datos.obtener_historial, version, filtrado),
+        "resumen": lambda: sin_cache(datos.obtener_resumen, version, base),
+        "selector_eliminar": selector_eliminar,
+        "guardar_registro": guardar,
+    }
+    resultados = {}
+    for nombre, funcion in operaciones.items():
+        resultados[nombre] = medir(funcion, repeticiones)
+        print(f"  {nombre}: p50 {resultados[nombre]['p50_ms']} ms, p95 {resultados[nombre]['p95_ms']} ms")
+
+    for nombre, formato in (("exportacion_excel", "Excel (.xlsx)"), ("exportacion_csv", "CSV comprimido (.csv.gz)")):
+        if formato.startswith("Excel") and filas > datos.EXCEL_MAX_FILAS:
+            resultados[nombre] = None  # la app rechaza este tamaño en Excel
+            continue
+        resultados[nombre] = medir(lambda: exportar(formato), repeticiones_exportacion)
+        print(f"  {nombre}: p50 {resultados[nombre]['p50_ms']} ms")
+    return resultados
+
+def comparar(resultados, ruta_base):
+    """Imprime la variación de p95 respecto de un JSON de una corrida anterior"""
+    with open(ruta_base, encoding="utf-8") as f:
+        base = {r["filas"]: r["operaciones"] for r in json.load(f)["resultados"]}
+    for resultado in resultados:
+        anterior = base.get(resultado["filas"])
+        if anterior is None:
+            continue
+        print(f"{resultado['filas']:,} filas vs. {ruta_base}:")
+        for nombre, medida in resultado["operaciones"].items():
+            previa = anterior.get(nombre)
+            if medida and previa and previa["p95_ms"]:
+                cambio = (medida["p95_ms"] / previa["p95_ms"] - 1) * 100
+                print(f"  {nombre}: p95 {previa['p95_ms']} -> {medida['p95_ms']} ms ({cambio:+.0f}%)")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--filas", type=int, nargs="+", default=FILAS_DEFECTO,
+                        help="tamaños del inventario a medir, en orden creciente")
+    parser.add_argument("--repeticiones", type=int, default=20)
+    parser.add_argument("--repeticiones-exportacion", type=int, default=3)
+    parser.add_argument("--semilla", type=int, default=0)
+    parser.add_argument("--salida", default="benchmark_resultados.json")
+    parser.add_argument("--base", help="JSON de una corrida anterior para comparar p95")
+    args = parser.parse_args()
+
+    datos.init_db()
+    verificar_base()
+    indice = datos.indice_catalogo()
+    rng = np.random.default_rng(args.semilla)
+
+    resultados = []
+    for objetivo in sorted(args.filas):
+        actuales = contar_filas()
+        inicio = time.perf_counter()
+        if objetivo > actuales:
+            print(f"Sembrando {objetivo - actuales:,} conteos...")
+            sembrar(indice.tabla, objetivo - actuales, rng)
+        siembra_s = round(time.perf_counter() - inicio, 1)
+        filas = contar_filas()
+        print(f"{filas:,} filas:")
+        resultados.append({
+            "filas": filas,
+            "siembra_s": siembra_s,
+            "operaciones": medir_operaciones(
+                indice.catalogo, filas, args.repeticiones, args.repeticiones_exportacion
+            ),
+        })
+
+    with open(args.salida, "w", encoding="utf-8") as f:
+        json.dump({
+            "fecha": datetime.now().isoformat(timespec="seconds"),
+            "repeticiones": args.repeticiones,
+            "rss_pico_mb": rss_pico_mb(),
+            "resultados": resultados,
+        }, f, indent=2, ensure_ascii=False)
+    print(f"Resultados en {args.salida}")
+    if args.base:
+        comparar(resultados, args.base)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,3327 @@
+"""Capa de datos del inventario cíclico: PostgreSQL, catálogo, diario local y consultas"""
+import streamlit as st
+import pandas as pd
+import numpy as np
+import json
+import logging
+import cProfile
+import re
+import io
+import gzip
+import bisect
+import heapq
+import difflib
+import tempfile
+import unicodedata
+import queue
+import select
+import sqlite3
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+import os
+from collections import namedtuple
+from contextlib import closing, contextmanager
+from types import MappingProxyType
+import xlsxwriter
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.exc import DataError, IntegrityError, OperationalError, InterfaceError
+from sqlalchemy.pool import NullPool
+
+def _config(nombre, defecto=None):
+    """Lee un parámetro de las variables de entorno o, si no está, de secrets.toml"""
+    if nombre in os.environ:
+        return os.environ[nombre]
+    try:
+        return st.secrets.get(nombre, defecto)
+    except FileNotFoundError:
+        # Sin secrets.toml (p. ej. al correr benchmark.py)
+        return defecto
+
+def _config_bool(nombre, defecto):
+    """Lee un parámetro booleano; acepta true/false como texto"""
+    valor = _config(nombre, defecto)
+    if isinstance(valor, str):
+        return valor.strip().lower() in ("1", "true", "si", "sí", "yes")
+    return bool(valor)
+
+DATABASE_URL = _config("DATABASE_URL") or st.secrets["DATABASE_URL"]
+
+# --- CONFIGURACIÓN DEL POOL ---
+# Todos los valores se pueden ajustar en secrets.toml o con variables de
+# entorno del mismo nombre. Con DB_PGBOUNCER = true el pool local se desactiva
+# y el timeout se fija por transacción, que es lo que admite PgBouncer en modo
+# transacción.
+DB_POOL_SIZE = int(_config("DB_POOL_SIZE", 5))
+DB_MAX_OVERFLOW = int(_config("DB_MAX_OVERFLOW", 10))
+DB_POOL_TIMEOUT = int(_config("DB_POOL_TIMEOUT", 30))
+DB_POOL_RECYCLE = int(_config("DB_POOL_RECYCLE", 1800))
+DB_POOL_PRE_PING = _config_bool("DB_POOL_PRE_PING", True)
+DB_STATEMENT_TIMEOUT_MS = int(_config("DB_STATEMENT_TIMEOUT_MS", 30000))
+DB_PGBOUNCER = _config_bool("DB_PGBOUNCER", False)
+# LISTEN necesita una conexión de sesión: con PgBouncer en modo transacción,
+# apuntar DATABASE_URL_LISTEN directo a PostgreSQL
+DATABASE_URL_LISTEN = _config("DATABASE_URL_LISTEN") or DATABASE_URL
+
+# --- INSTRUMENTACIÓN ---
+# Cada rerun de la página abre una medición en el hilo de su sesión. Los
+# tramos marcados con tramo() y las consultas que pasan por el engine se
+# acumulan en ella; al cerrarla se escribe como una línea JSON en el log
+# "inventario.medicion". Con perfilar=True además se guarda un perfil de
+# cProfile del rerun en PERFILES_DIR.
+PERFILES_DIR = _config("PERFILES_DIR", "perfiles")
+PERFILAR = _config_bool("PERFILAR", False)
+SQL_VISIBLE = 160  # caracteres de cada sentencia que se guardan en la medición
+
+log_mediciones = logging.getLogger("inventario.medicion")
+if not log_mediciones.handlers:
+    _manejador_log = logging.StreamHandler()
+    _manejador_log.setFormatter(logging.Formatter("%(message)s"))
+    log_mediciones.addHandler(_manejador_log)
+    log_mediciones.setLevel(logging.INFO)
+    log_mediciones.propagate = False
+
+_hilo = threading.local()
+
+def iniciar_medicion(sesion, perfilar=False):
+    """Abre la medición del rerun actual en este hilo y la devuelve"""
+    medicion = {
+        "sesion": sesion,
+        "inicio": datetime.now().isoformat(timespec="milliseconds"),
+        "t0": time.perf_counter(),
+        "tramos": [],
+        "consultas": [],
+        "filas": 0,
+        "bytes_enviados": 0,
+        "perfil": None,
+        "perfilador": None,
+    }
+    if perfilar:
+        perfilador = cProfile.Profile()
+        try:
+            perfilador.enable()
+            medicion["perfilador"] = perfilador
+        except ValueError:
+            # Otra sesión ya está perfilando (solo puede haber un perfilador activo)
+            pass
+    _hilo.medicion = medicion
+    return medicion
+
+def medicion_actual():
+    """Devuelve la medición abierta en este hilo, o None"""
+    return getattr(_hilo, "medicion", None)
+
+@contextmanager
+def tramo(nombre):
+    """Mide el tiempo, las consultas y las filas leídas de un bloque del rerun"""
+    medicion = medicion_actual()
+    if medicion is None:
+        yield
+        return
+    consultas = len(medicion["consultas"])
+    filas = medicion["filas"]
+    inicio = time.perf_counter()
+    try:
+        yield
+    finally:
+        nuevas = medicion["consultas"][consultas:]
+        medicion["tramos"].append({
+            "tramo": nombre,
+            "desde_ms": round((inicio - medicion["t0"]) * 1000, 1),
+            "ms": round((time.perf_counter() - inicio) * 1000, 1),
+            "consultas": len(nuevas),
+            "sql_ms": round(sum(c["ms"] for c in nuevas), 1),
+            "filas": medicion["filas"] - filas,
+        })
+
+def registrar_envio(objeto):
+    """Suma a la medición los bytes de un DataFrame o archivo enviado al navegador"""
+    medicion = medicion_actual()
+    if medicion is None:
+        return
+    if isinstance(objeto, pd.DataFrame):
+        medicion["bytes_enviados"] += int(objeto.memory_usage(deep=True).sum())
+    else:
+        medicion["bytes_enviados"] += int(objeto)
+
+def cerrar_medicion(medicion, completa=True):
+    """Cierra una medición, guarda el perfil si lo hay y la escribe en el log
+
+    completa=False indica un rerun que terminó antes del final de la página
+    (st.rerun o st.stop). Devuelve la medición sin los campos internos.
+    """
+    if getattr(_hilo, "medicion", None) is medicion:
+        _hilo.medicion = None
+    perfilador = medicion.pop("perfilador", None)
+    if perfilador is not None:
+        perfilador.disable()
+        os.makedirs(PERFILES_DIR, exist_ok=True)
+        ruta = os.path.join(
+            PERFILES_DIR, f"rerun_{datetime.now():%Y%m%d_%H%M%S_%f}_{medicion['sesion'][:8]}.prof"
+        )
+        perfilador.dump_stats(ruta)
+        medicion["perfil"] = ruta
+    medicion["total_ms"] = round((time.perf_counter() - medicion.pop("t0")) * 1000, 1)
+    medicion["completa"] = completa
+    medicion["sql_ms"] = round(sum(c["ms"] for c in medicion["consultas"]), 1)
+    log_mediciones.info(json.dumps(medicion, default=str, ensure_ascii=False))
+    return medicion
+
+def _antes_de_consulta(conn, cursor, statement, parameters, context, executemany):
+    """Marca el inicio de una sentencia si hay una medición abierta"""
+    if medicion_actual() is not None:
+        conn.info.setdefault("inicios_consulta", []).append(time.perf_counter())
+
+def _despues_de_consulta(conn, cursor, statement, parameters, context, executemany):
+    """Registra duración y filas de la sentencia en la medición abierta"""
+    medicion = medicion_actual()
+    inicios = conn.info.get("inicios_consulta")
+    if medicion is None or not inicios:
+        return
+    ms = (time.perf_counter() - inicios.pop()) * 1000
+    filas = cursor.rowcount if cursor.description is not None and cursor.rowcount > 0 else 0
+    medicion["filas"] += filas
+    medicion["consultas"].append({
+        "sql": " ".join(statement.split())[:SQL_VISIBLE],
+        "ms": round(ms, 2),
+        "filas": filas,
+    })
+
+@st.cache_resource
+def get_engine():
+    """Crea el engine y su pool de conexiones una sola vez por proceso"""
+    connect_args = {
+        "application_name": "inventario-ciclico",
+        # Sin conexión, fallar rápido y seguir con el diario local
+        "connect_timeout": 5,
+        # Detecta conexiones cortadas por la red o por el servidor inactivo
+        "keepalives": 1,
+        "keepalives_idle": 30,
+        "keepalives_interval": 10,
+        "keepalives_count": 3,
+    }
+    if DB_PGBOUNCER:
+        nuevo_engine = create_engine(DATABASE_URL, poolclass=NullPool, connect_args=connect_args)
+        
+        @event.listens_for(nuevo_engine, "begin")
+        def fijar_timeout(conn):
+            conn.exec_driver_sql(f"SET LOCAL statement_timeout = {DB_STATEMENT_TIMEOUT_MS}")
+    else:
+        connect_args["options"] = f"-c statement_timeout={DB_STATEMENT_TIMEOUT_MS}"
+        nuevo_engine = create_engine(
+            DATABASE_URL,
+            pool_size=DB_POOL_SIZE,
+            max_overflow=DB_MAX_OVERFLOW,
+            pool_timeout=DB_POOL_TIMEOUT,
+            pool_recycle=DB_POOL_RECYCLE,
+            pool_pre_ping=DB_POOL_PRE_PING,
+            pool_use_lifo=True,
+            connect_args=connect_args
+        )
+    event.listen(nuevo_engine, "before_cursor_execute", _antes_de_consulta)
+    event.listen(nuevo_engine, "after_cursor_execute", _despues_de_consulta)
+    return nuevo_engine
+
+def sin_timeout(conn):
+    """Quita el statement_timeout para el resto de la transacción (operaciones largas)"""
+    conn.execute(text("SET LOCAL statement_timeout = 0"))
+
+def estado_pool():
+    """Devuelve las métricas del pool de conexiones del proceso"""
+    pool = engine.pool
+    if isinstance(pool, NullPool):
+        return {"modo": "PgBouncer (sin pool local)"}
+    return {
+        "modo": "Pool local",
+        "tamaño": pool.size(),
+        "en uso": pool.checkedout(),
+        "disponibles": pool.checkedin(),
+        "desborde": pool.overflow(),
+        "máximo": DB_POOL_SIZE + DB_MAX_OVERFLOW,
+    }
+
+engine = get_engine()
+
+# --- CONFIGURACIÓN ARCHIVOS ---
+DB_PATH = "inventario.db"
+DIARIO_PATH = "diario_conteos.db"  # diario local de conteos (SQLite en modo WAL)
+CATALOGO_PATH = "catalogo_productos.json"  # catálogo anterior, solo para la migración inicial
+
+# --- LÍNEAS DISPONIBLES ---
+LINEAS = [
+    "Magnesio", "Magnesio Suelo", "Fierro", "Nitrato de Magnesio", 
+    "Zinc Hepta", "Zinc Mono", "Azufre", "Sulfato de Potasio", 
+    "Nitrato de Calcio", "Manganeso", "Nitrato de Potasio", "Cobre", 
+    "Fosfato Monoamonico", "Acido Borico", "Acido Fosforico", 
+    "Quelatos", "Otras"
+]
+
+# --- ALMACENES ---
+ALMACENES = [
+    "Almacen A", "Almacen D", "Almacen E", "Almacen F", "Almacen G",
+    "Almacen 13 (Sullana)", "Almacen 3 (Ica)", "Ferrofert (Paita)"
+]
+
+# --- CATÁLOGO POR DEFECTO ---
+# Solo se usa para sembrar la tabla catalogo la primera vez que se migra el esquema
+CATALOGO_DEFAULT = {
+    "Sulfato de Magnesio Heptahidratado (PT)": {
+        "codigo": "PT0000000093",
+        "presentacion": "Sacos x 25 kg",
+        "factor": 25,
+        "unidad": "kg",
+        "clasificacion": "Producto Terminado",
+        "linea": "Magnesio"
+    },
+    "Oxido de Magnesio (PT)": {
+        "codigo": "PT000000174",
+        "presentacion": "Sacos x 25 kg",
+        "factor": 25,
+        "unidad": "kg",
+        "clasificacion": "Producto Terminado",
+        "linea": "Magnesio"
+    },
+    "Sulfato de Magnesio Heptahidratado SQM (PT)": {
+        "codigo": "PT000000153",
+        "presentacion": "Sacos x 25 kg",
+        "factor": 25,
+        "unidad": "kg",
+        "clasificacion": "Producto Terminado",
+        "linea": "Magnesio"
+    },
+    "Sulfato de Magnesio Heptahidratado - Quiagral (PT)": {
+        "codigo": "PT000000156",
+        "presentacion": "Sacos x 25 kg",
+        "factor": 25,
+        "unidad": "kg",
+        "clasificacion": "Producto Terminado",
+        "linea": "Magnesio"
+    },
+    "Sulfato de Magnesio Heptahidratado - Industrial (PT)": {
+        "codigo": "PT000000191",
+        "presentacion": "Sacos x 25 kg",
+        "factor": 25,
+        "unidad": "kg",
+        "clasificacion": "Producto Terminado",
+        "linea": "Magnesio"
+    },
+    # Magnesio Suelo
+    "Sulfato de Magnesio Suelo (PT)": {
+        "codigo": "PT000000245",
+        "presentacion": "Sacos x 25 kg",
+        "factor": 25,
+        "unidad": "kg",
+        "clasificacion": "Producto Terminado",
+        "linea": "Magnesio Suelo"
+    },
+    "Sulfato de Magnesio Suelo (MRC)": {
+        "codigo": "MRC000000015",
+        "presentacion": "Sacos x 25 kg",
+        "factor": 25,
+        "unidad": "kg",
+        "clasificacion": "Mercaderia",
+        "linea": "Magnesio Suelo"
+    },
+    # Nitrato de Magnesio
+    "Nitrato de Magnesio Hexahidratado (PT)": {
+        "codigo": "PT000000230",
+        "presentacion": "Sacos x 25 kg",
+        "factor": 25,
+        "unidad": "kg",
+        "clasificacion": "Producto Terminado",
+        "linea": "Nitrato de Magnesio"
+    },
+    "Nitrato de Magnesio Hexahidratado (MRC)": {
+        "codigo": "MRC000000053",
+        "presentacion": "Sacos x 25 kg",
+        "factor": 25,
+        "unidad": "kg",
+        "clasificacion": "Mercaderia",
+        "linea": "Nitrato de Magnesio"
+    },
+    # Fierro
+    "Sulfato Ferroso Heptahidratado C/C (PT)": {
+        "codigo": "PT000000130",
+        "presentacion": "Sacos x 25 kg",
+        "factor": 25,
+        "unidad": "kg",
+        "clasificacion": "Producto Terminado",
+        "linea": "Fierro"
+    },
+    "Sulfato Ferroso Tetrahidratado (PT)": {
+        "codigo": "PT0000000117",
+        "presentacion": "Sacos x 25 kg",
+        "factor": 25,
+        "unidad": "kg",
+        "clasificacion": "Producto Terminado",
+        "linea": "Fierro"
+    },
+    "Sulfato Ferroso Heptahidratado S/C (PT)": {
+        "codigo": "PT0000000111",
+        "presentacion": "Sacos x 25 kg",
+        "factor": 25,
+        "unidad": "kg",
+        "clasificacion": "Producto Terminado",
+        "linea": "Fierro"
+    },
+    "Sulfato Ferroso Heptahidratado - Fermagri (PT)": {
+        "codigo": "PT0000000114",
+        "presentacion": "Sacos x 25 kg",
+        "factor": 25,
+        "unidad": "kg",
+        "clasificacion": "Producto Terminado",
+        "linea": "Fierro"
+    },
+    "Sulfato Ferroso Heptahidratado - Quiagral (PT)": {
+        "codigo": "PT000000138",
+        "presentacion": "Sacos x 25 kg",
+        "factor": 25,
+        "unidad": "kg",
+        "clasificacion": "Producto Terminado",
+        "linea": "Fierro"
+    },
+    "Sulfato Ferroso Heptahidratado S/C USP (PT)": {
+        "codigo": "PT0000000113",
+        "presentacion": "Tambor x 25 kg",
+        "factor": 25,
+        "unidad": "kg",
+        "clasificacion": "Producto Terminado",
+        "linea": "Fierro"
+    },
+    "Sulfato Ferroso Monohidratado USP (PT)": {
+        "codigo": "PT0000000116",
+        "presentacion": "Tambor x 25 kg",
+        "factor": 25,
+        "unidad": "kg",
+        "clasificacion": "Producto Terminado",
+        "linea": "Fierro"
+    },
+    "Sulfato Ferroso Monohidratado (MRC)": {
+        "codigo": "MRC000000048",
+        "presentacion": "Sacos x 25 kg",
+        "factor": 25,
+        "unidad": "kg",
+        "clasificacion": "Mercaderia",
+        "linea": "Fierro"
+    },
+    "Sulfato Ferroso Heptahidratado Paletizado (PT)": {
+        "codigo": "PT000000189",
+        "presentacion": "Sacos x 25 kg",
+        "factor": 25,
+        "unidad": "kg",
+        "clasificacion": "Producto Terminado",
+        "linea": "Fierro"
+    },
+    # Zinc Hepta
+    "Sulfato de Zinc Heptahidratado (MRC)": {
+        "codigo": "MRC000000021",
+        "presentacion": "Sacos x 25 kg",
+        "factor": 25,
+        "unidad": "kg",
+        "clasificacion": "Mercaderia",
+        "linea": "Zinc Hepta"
+    },
+    "Sulfato de Zinc Heptahidratado - Nexa el Porvenir (PT)": {
+        "codigo": "PT0000000104",
+        "presentacion": "Sacos x 25 kg",
+        "factor": 25,
+        "unidad": "kg",
+        "clasificacion": "Producto Terminado",
+        "linea": "Zinc Hepta"
+    },
+    "Sulfato de Zinc Heptahidratado (PT)": {
+        "codigo": "PT0000000173",
+        "presentacion": "Sacos x 25 kg",
+        "factor": 25,
+        "unidad": "kg",
+        "clasificacion": "Producto Terminado",
+        "linea": "Zinc Hepta"
+    },
+    "Sulfato de Zinc Heptahidratado PT Bigbag x 1 TM (PT)": {
+        "codigo": "PT0000000145",
+        "presentacion": "Bigbag x 1000 kg",
+        "factor": 1000,
+        "unidad": "kg",
+        "clasificacion": "Producto Terminado",
+        "linea": "Zinc Hepta"
+    },
+    "Sulfato de Zinc Heptahidratado PT Bigbag x 1.5 TM (PT)": {
+        "codigo": "PT0000000174",
+        "presentacion": "Bigbag x 1500 kg",
+        "factor": 1500,
+        "unidad": "kg",
+        "clasificacion": "Producto Terminado",
+        "linea": "Zinc Hepta"
+    },
+    "Sulfato de Zinc Heptahidratado - Diamond (PT)": {
+        "codigo": "PT0000000163",
+        "presentacion": "Sacos x 25 kg",
+        "factor": 25,
+        "unidad": "kg",
+        "clasificacion": "Producto Terminado",
+        "linea": "Zinc Hepta"
+    },
+    "Sulfato de Zinc Heptahidratado - Quiagral (PT)": {
+        "codigo": "PT0000000140",
+        "presentacion": "Sacos x 25 kg",
+        "factor": 25,
+        "unidad": "kg",
+        "clasificacion": "Producto Terminado",
+        "linea": "Zinc Hepta"
+    },
+    # Zinc Mono
+    "Sulfato de Zinc Monohidratado 1 TM - Exportacion (PT)": {
+        "codigo": "PT0000000126",
+        "presentacion": "Bigbag x 1000 kg",
+        "factor": 1000,
+        "unidad": "kg",
+        "clasificacion": "Producto Terminado",
+        "linea": "Zinc Mono"
+    },
+    "Sulfato de Zinc Monohidratado - Antamina (PT)": {
+        "codigo": "PT000000182",
+        "presentacion": "Bigbag x 1000 kg",
+        "factor": 1000,
+        "unidad": "kg",
+        "clasificacion": "Producto Terminado",
+        "linea": "Zinc Mono"
+    },
+    "Sulfato de Zinc Monohidratado AFG (MRC)": {
+        "codigo": "MRC000000024",
+        "presentacion": "Sacos x 25 kg",
+        "factor": 25,
+        "unidad": "kg",
+        "clasificacion": "Mercaderia",
+        "linea": "Zinc Mono"
+    },
+    "Sulfato de Zinc Monohidratado (PT)": {
+        "codigo": "PT000000181",
+        "presentacion": "Sacos x 25 kg",
+        "factor": 25,
+        "unidad": "kg",
+        "clasificacion": "Producto Terminado",
+        "linea": "Zinc Mono"
+    },
+    # Azufre
+    "Azufre Puro Granulado (PT)": {
+        "codigo": "PT000000209",
+        "presentacion": "Sacos x 25 kg",
+        "factor": 25,
+        "unidad": "kg",
+        "clasificacion": "Producto Terminado",
+        "linea": "Azufre"
+    },
+    "Fungisulf WP (PT)": {
+        "codigo": "PT000000188",
+        "presentacion": "Sacos x 25 kg",
+        "factor": 25,
+        "unidad": "kg",
+        "clasificacion": "Producto Terminado",
+        "linea": "Azufre"
+    },
+    "Fungisulf DP-400 (PT)": {
+        "codigo": "PT000000187",
+        "presentacion": "Sacos x 25 kg",
+        "factor": 25,
+        "unidad": "kg",
+        "clasificacion": "Producto Terminado",
+        "linea": "Azufre"
+    },
+    "Azufre Puro Micronizado (PT)": {
+        "codigo": "PT000000216",
+        "presentacion": "Sacos x 25 kg",
+        "factor": 25,
+        "unidad": "kg",
+        "clasificacion": "Producto Terminado",
+        "linea": "Azufre"
+    },
+    # Sulfato de Potasio
+    "Sulfato de potasio (MRC)": {
+        "codigo": "MRC000000019",
+        "presentacion": "Sacos x 25 kg",
+        "factor": 25,
+        "unidad": "kg",
+        "clasificacion": "Mercaderia",
+        "linea": "Sulfato de Potasio"
+    },
+    "Sulfato de potasio (PT)": {
+        "codigo": "PT000000134",
+        "presentacion": "Sacos x 25 kg",
+        "factor": 25,
+        "unidad": "kg",
+        "clasificacion": "Producto Terminado",
+        "linea": "Sulfato de Potasio"
+    },
+    # Nitrato de Calcio
+    "Nitrato de Calcio/Granular (PT)": {
+        "codigo": "PT000000173",
+        "presentacion": "Sacos x 25 kg",
+        "factor": 25,
+        "unidad": "kg",
+        "clasificacion": "Producto Terminado",
+        "linea": "Nitrato de Calcio"
+    },
+    "Nitrato de Calcio Tetrahidratado Cristalizado (PT)": {
+        "codigo": "PT000000171",
+        "presentacion": "Sacos x 25 kg",
+        "factor": 25,
+        "unidad": "kg",
+        "clasificacion": "Producto Terminado",
+        "linea": "Nitrato de Calcio"
+    },
+    "Nitrato de Calcio/Amonio (MRC)": {
+        "codigo": "MRC000000029",
+        "presentacion": "Sacos x 25 kg",
+        "factor": 25,
+        "unidad": "kg",
+        "clasificacion": "Mercaderia",
+        "linea": "Nitrato de Calcio"
+    },
+    # Manganeso
+    "Sulfato de Manganeso Monohidratado (PT)": {
+        "codigo": "PT0000000094",
+        "presentacion": "Sacos x 25 kg",
+        "factor": 25,
+        "unidad": "kg",
+        "clasificacion": "Producto Terminado",
+        "linea": "Manganeso"
+    },
+    "Sulfato de Manganeso Monohidratado al 31% (MRC)": {
+        "codigo": "MRC000000018",
+        "presentacion": "Bigbag x 1000 kg",
+        "factor": 1000,
+        "unidad": "kg",
+        "clasificacion": "Mercaderia",
+        "linea": "Manganeso"
+    },
+    # Nitrato de Potasio
+    "Nitrato de Potasio (MRC)": {
+        "codigo": "MRC000000030",
+        "presentacion": "Sacos x 25 kg",
+        "factor": 25,
+        "unidad": "kg",
+        "clasificacion": "Mercaderia",
+        "linea": "Nitrato de Potasio"
+    },
+    "Nitrato de Potasio (PT)": {
+        "codigo": "PT000000195",
+        "presentacion": "Sacos x 25 kg",
+        "factor": 25,
+        "unidad": "kg",
+        "clasificacion": "Producto Terminado",
+        "linea": "Nitrato de Potasio"
+    },
+    # Cobre
+    "Oxicloruro de Cobre (MRC)": {
+        "codigo": "MRC000000009",
+        "presentacion": "Sacos x 25 kg",
+        "factor": 25,
+        "unidad": "kg",
+        "clasificacion": "Mercaderia",
+        "linea": "Cobre"
+    },
+    "Sulfato de Cobre Pentahidratado - Marcobre (MRC)": {
+        "codigo": "MRC000000010",
+        "presentacion": "Sacos x 25 kg",
+        "factor": 25,
+        "unidad": "kg",
+        "clasificacion": "Mercaderia",
+        "linea": "Cobre"
+    },
+    "Sulfato de Cobre Pentahidratado (PT)": {
+        "codigo": "PT000000231",
+        "presentacion": "Sacos x 25 kg",
+        "factor": 25,
+        "unidad": "kg",
+        "clasificacion": "Producto Terminado",
+        "linea": "Cobre"
+    },
+    "Sulfato de Cobre Pentahidratado - Nacol (MRC)": {
+        "codigo": "MRC000000011",
+        "presentacion": "Sacos x 25 kg",
+        "factor": 25,
+        "unidad": "kg",
+        "clasificacion": "Mercaderia",
+        "linea": "Cobre"
+    },
+    # Fosfato Monoamonico
+    "Fosfato Monoamonico (PT)": {
+        "codigo": "PT000000229",
+        "presentacion": "Sacos x 25 kg",
+        "factor": 25,
+        "unidad": "kg",
+        "clasificacion": "Producto Terminado",
+        "linea": "Fosfato Monoamonico"
+    },
+    "Fosfato Monoamonico (MRC)": {
+        "codigo": "MRC000000036",
+        "presentacion": "Sacos x 25 kg",
+        "factor": 25,
+        "unidad": "kg",
+        "clasificacion": "Mercaderia",
+        "linea": "Fosfato Monoamonico"
+    },
+    # Acido Borico
+    "Acido Borico Granulado (MRC)": {
+        "codigo": "MRC000000043",
+        "presentacion": "Sacos x 25 kg",
+        "factor": 25,
+        "unidad": "kg",
+        "clasificacion": "Mercaderia",
+        "linea": "Acido Borico"
+    },
+    "Acido Borico (PT)": {
+        "codigo": "PT000000244",
+        "presentacion": "Sacos x 25 kg",
+        "factor": 25,
+        "unidad": "kg",
+        "clasificacion": "Producto Terminado",
+        "linea": "Acido Borico"
+    },
+    # Acido Fosforico
+    "Acido Fosforico al 85 % - Grado Tecnico (MRC)": {
+        "codigo": "MRC000000040",
+        "presentacion": "Bidon x 35 kg",
+        "factor": 35,
+        "unidad": "kg",
+        "clasificacion": "Mercaderia",
+        "linea": "Acido Fosforico"
+    },
+    "Acido Fosforico (PT)": {
+        "codigo": "PT000000133",
+        "presentacion": "Bidon x 33.65 kg",
+        "factor": 33.65,
+        "unidad": "kg",
+        "clasificacion": "Producto Terminado",
+        "linea": "Acido Fosforico"
+    },
+    "Acido Fosforico al 85 % - Grado Alimenticio (MRC)": {
+        "codigo": "MRC000000001",
+        "presentacion": "Bidon x 35 kg",
+        "factor": 35,
+        "unidad": "kg",
+        "clasificacion": "Mercaderia",
+        "linea": "Acido Fosforico"
+    },
+    # Quelatos
+    "Organikel Vida Plus (20 lt)": {
+        "codigo": "PT000000200",
+        "presentacion": "Bidon x 20 lt",
+        "factor": 20,
+        "unidad": "lt",
+        "clasificacion": "Producto Terminado",
+        "linea": "Quelatos"
+    },
+    "Organikel Vida Plus (1 lt)": {
+        "codigo": "PT000000199",
+        "presentacion": "Frasco x 1 lt",
+        "factor": 1,
+        "unidad": "lt",
+        "clasificacion": "Producto Terminado",
+        "linea": "Quelatos"
+    },
+    "Citrato de Magnesio (1 lt)": {
+        "codigo": "PT0000000001",
+        "presentacion": "Frasco x 1 lt",
+        "factor": 1,
+        "unidad": "lt",
+        "clasificacion": "Producto Terminado",
+        "linea": "Quelatos"
+    },
+    "Sulcopenta F-4 (20 lt)": {
+        "codigo": "PT000000263",
+        "presentacion": "Bidon x 20 lt",
+        "factor": 20,
+        "unidad": "lt",
+        "clasificacion": "Producto Terminado",
+        "linea": "Quelatos"
+    },
+    "Sulcopenta (20 lt)": {
+        "codigo": "PT0000000070",
+        "presentacion": "Bidon x 20 lt",
+        "factor": 20,
+        "unidad": "lt",
+        "clasificacion": "Producto Terminado",
+        "linea": "Quelatos"
+    },
+    "Sulcopenta F-4 (1 lt)": {
+        "codigo": "PT000000264",
+        "presentacion": "Frasco x 1 lt",
+        "factor": 1,
+        "unidad": "lt",
+        "clasificacion": "Producto Terminado",
+        "linea": "Quelatos"
+    },
+    "Sulcopenta F-3 (1 lt)": {
+        "codigo": "PT000000206",
+        "presentacion": "Frasco x 1 lt",
+        "factor": 1,
+        "unidad": "lt",
+        "clasificacion": "Producto Terminado",
+        "linea": "Quelatos"
+    },
+    "Organikel Zinc Plus 25% (1 lt)": {
+        "codigo": "PT000000236",
+        "presentacion": "Frasco x 1 lt",
+        "factor": 1,
+        "unidad": "lt",
+        "clasificacion": "Producto Terminado",
+        "linea": "Quelatos"
+    },
+    "Organikel NPK 5-50-5 (1 lt)": {
+        "codigo": "PT0000000057",
+        "presentacion": "Frasco x 1 lt",
+        "factor": 1,
+        "unidad": "lt",
+        "clasificacion": "Producto Terminado",
+        "linea": "Quelatos"
+    },
+    "Organikel NPK 5-50-5 (20 lt)": {
+        "codigo": "PT0000000044",
+        "presentacion": "Bidon x 20 lt",
+        "factor": 20,
+        "unidad": "lt",
+        "clasificacion": "Producto Terminado",
+        "linea": "Quelatos"
+    },
+    "Organikel PK 0-40-40 (1 lt)": {
+        "codigo": "PT000000148",
+        "presentacion": "Frasco x 1 lt",
+        "factor": 1,
+        "unidad": "lt",
+        "clasificacion": "Producto Terminado",
+        "linea": "Quelatos"
+    },
+    "Organikel PK 0-40-40 (20 lt)": {
+        "codigo": "PT0000000047",
+        "presentacion": "Bidon x 20 lt",
+        "factor": 20,
+        "unidad": "lt",
+        "clasificacion": "Producto Terminado",
+        "linea": "Quelatos"
+    },
+    "Organikel Magnesio 14.5% (20 lt)": {
+        "codigo": "PT000000221",
+        "presentacion": "Bidon x 20 lt",
+        "factor": 20,
+        "unidad": "lt",
+        "clasificacion": "Producto Terminado",
+        "linea": "Quelatos"
+    }
+}
+
+# --- CONFIGURACIÓN SQLITE ---
+def get_connection():
+    """Devuelve una conexión a PostgreSQL"""
+    return engine.connect()
+
+# Reconstruye las filas de inventario desde conteos y sus dimensiones. Es la
+# definición de la vista inventario y también sirve para leer una partición
+# ya separada de conteos al archivarla.
+SQL_VISTA_INVENTARIO = """
+    SELECT c.id, c.fecha_hora, p.codigo, p.producto, p.clasificacion, p.linea, p.presentacion,
+           c.cantidad_unidades, c.total_kg_lt, p.unidad_medida, a.almacen, r.responsable,
+           c.observaciones, c.estado, c.id_cliente
+    FROM {tabla} c
+    JOIN dim_producto p ON p.id = c.producto_id
+    LEFT JOIN dim_almacen a ON a.id = c.almacen_id
+    LEFT JOIN dim_responsable r ON r.id = c.responsable_id
+"""
+
+# --- MIGRACIONES DEL ESQUEMA ---
+# Cada migración se aplica una sola vez por base de datos y queda registrada
+# en schema_version. Las nuevas versiones se agregan al final de la lista.
+# Un paso puede ser una sentencia SQL o una función que recibe la conexión.
+# Productos del JSON anterior que no entraron al catálogo al sembrarlo porque
+# su código o su descripción ya los usaba otro; se muestran en la administración
+SQL_CATALOGO_DESCARTADOS = """
+    CREATE TABLE IF NOT EXISTS catalogo_descartados (
+        codigo VARCHAR(100),
+        nombre VARCHAR(255),
+        presentacion VARCHAR(100),
+        factor DOUBLE PRECISION,
+        unidad VARCHAR(50),
+        clasificacion VARCHAR(100),
+        linea VARCHAR(100),
+        motivo TEXT NOT NULL,
+        registrado_en TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+"""
+
+log_catalogo = logging.getLogger("inventario.catalogo")
+
+def _sembrar_catalogo(conn):
+    """Carga el catálogo inicial desde el JSON anterior o, si no existe, el de por defecto
+
+    Los productos que chocan por código o descripción con uno ya cargado no
+    se descartan en silencio: quedan en catalogo_descartados y en el log.
+    """
+    try:
+        with open(CATALOGO_PATH, 'r', encoding='utf-8') as f:
+            catalogo = json.load(f)
+    except FileNotFoundError:
+        catalogo = CATALOGO_DEFAULT
+    filas = [
+        {
+            "codigo": datos["codigo"],
+            "nombre": nombre,
+            "presentacion": datos.get("presentacion"),
+            "factor": datos.get("factor", 1),
+            "unidad": datos.get("unidad", "kg"),
+            "clasificacion": datos.get("clasificacion"),
+            "linea": datos.get("linea"),
+        }
+        for nombre, datos in catalogo.items()
+    ]
+    conn.execute(text("""
+        INSERT INTO catalogo (codigo, nombre, presentacion, factor, unidad, clasificacion, linea)
+        VALUES (:codigo, :nombre, :presentacion, :factor, :unidad, :clasificacion, :linea)
+        ON CONFLICT DO NOTHING
+    """), filas)
+    
+    cargados = {fila.nombre: fila.codigo for fila in conn.execute(text("SELECT nombre, codigo FROM catalogo"))}
+    descartados = []
+    for fila in filas:
+        if cargados.get(fila["nombre"]) == fila["codigo"]:
+            continue
+        if fila["nombre"] in cargados:
+            motivo = f"La descripción ya la usa el código {cargados[fila['nombre']]}"
+        else:
+            motivo = "El código ya lo usa otro producto"
+        descartados.append({**fila, "motivo": motivo})
+    if descartados:
+        conn.execute(text(SQL_CATALOGO_DESCARTADOS))
+        conn.execute(text("""
+            INSERT INTO catalogo_descartados
+            (codigo, nombre, presentacion, factor, unidad, clasificacion, linea, motivo)
+            VALUES (:codigo, :nombre, :presentacion, :factor, :unidad, :clasificacion, :linea, :motivo)
+        """), descartados)
+        for fila in descartados:
+            log_catalogo.warning(
+                "Producto no cargado al catálogo: %s (%s): %s", fila["nombre"], fila["codigo"], fila["motivo"]
+            )
+
+MIGRACIONES = [
+    (1, "Tabla inventario", [
+        """
+        CREATE TABLE IF NOT EXISTS inventario (
+            id SERIAL PRIMARY KEY,
+            fecha_hora TIMESTAMP,
+            codigo VARCHAR(100),
+            producto VARCHAR(255),
+            clasificacion VARCHAR(100),
+            linea VARCHAR(100),
+            presentacion VARCHAR(100),
+            cantidad_unidades INTEGER,
+            total_kg_lt NUMERIC,
+            unidad_medida VARCHAR(50),
+            almacen VARCHAR(100),
+            responsable VARCHAR(100),
+            observaciones TEXT,
+            estado VARCHAR(50) DEFAULT 'Pendiente'
+        )
+        """,
+    ]),
+    (2, "Índices del historial y búsqueda por código", [
+        # Orden del historial y paginación por (fecha_hora, id)
+        "CREATE INDEX IF NOT EXISTS idx_inventario_fecha ON inventario (fecha_hora DESC, id DESC)",
+        # Un índice por filtro del historial, con el mismo orden que la consulta
+        "CREATE INDEX IF NOT EXISTS idx_inventario_almacen_fecha ON inventario (almacen, fecha_hora DESC, id DESC)",
+        "CREATE INDEX IF NOT EXISTS idx_inventario_linea_fecha ON inventario (linea, fecha_hora DESC, id DESC)",
+        "CREATE INDEX IF NOT EXISTS idx_inventario_clasificacion_fecha ON inventario (clasificacion, fecha_hora DESC, id DESC)",
+        # Índice cubriente para consultas por producto y almacén
+        """
+        CREATE INDEX IF NOT EXISTS idx_inventario_codigo
+        ON inventario (codigo, almacen, fecha_hora DESC)
+        INCLUDE (cantidad_unidades, total_kg_lt, unidad_medida)
+        """,
+        "ANALYZE inventario",
+    ]),
+    (3, "Versión de datos para invalidar cachés", [
+        """
+        CREATE TABLE IF NOT EXISTS versiones (
+            nombre VARCHAR(50) PRIMARY KEY,
+            version BIGINT NOT NULL DEFAULT 0
+        )
+        """,
+        "INSERT INTO versiones (nombre) VALUES ('inventario') ON CONFLICT DO NOTHING",
+        # Cada sentencia que modifica la tabla incrementa su versión dentro de
+        # la misma transacción, sin importar qué réplica o sesión escribió
+        """
+        CREATE OR REPLACE FUNCTION incrementar_version() RETURNS trigger AS $$
+        BEGIN
+            UPDATE versiones SET version = version + 1 WHERE nombre = TG_ARGV[0];
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+        """,
+        "DROP TRIGGER IF EXISTS trg_inventario_version ON inventario",
+        """
+        CREATE TRIGGER trg_inventario_version
+        AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON inventario
+        FOR EACH STATEMENT EXECUTE FUNCTION incrementar_version('inventario')
+        """,
+    ]),
+    (4, "Catálogo de productos en base de datos", [
+        """
+        CREATE TABLE IF NOT EXISTS catalogo (
+            codigo VARCHAR(100) PRIMARY KEY,
+            nombre VARCHAR(255) NOT NULL UNIQUE,
+            presentacion VARCHAR(100),
+            factor DOUBLE PRECISION NOT NULL DEFAULT 1,
+            unidad VARCHAR(50),
+            clasificacion VARCHAR(100),
+            linea VARCHAR(100),
+            orden SERIAL
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_catalogo_linea ON catalogo (linea)",
+        "CREATE INDEX IF NOT EXISTS idx_catalogo_clasificacion ON catalogo (clasificacion)",
+        "INSERT INTO versiones (nombre) VALUES ('catalogo') ON CONFLICT DO NOTHING",
+        "DROP TRIGGER IF EXISTS trg_catalogo_version ON catalogo",
+        """
+        CREATE TRIGGER trg_catalogo_version
+        AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON catalogo
+        FOR EACH STATEMENT EXECUTE FUNCTION incrementar_version('catalogo')
+        """,
+        _sembrar_catalogo,
+    ]),
+    (5, "Stock actual por almacén y producto", [
+        """
+        CREATE TABLE IF NOT EXISTS stock_actual (
+            almacen VARCHAR(100) NOT NULL,
+            codigo VARCHAR(100) NOT NULL,
+            producto VARCHAR(255),
+            linea VARCHAR(100),
+            unidad_medida VARCHAR(50),
+            ultimo_id INTEGER,
+            ultima_fecha TIMESTAMP,
+            ultimo_conteo INTEGER,
+            ultimo_total NUMERIC,
+            fecha_anterior TIMESTAMP,
+            conteo_anterior INTEGER,
+            total_anterior NUMERIC,
+            delta_unidades INTEGER,
+            delta_total NUMERIC,
+            PRIMARY KEY (almacen, codigo)
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_stock_actual_fecha ON stock_actual (ultima_fecha)",
+        # Recalcula las claves (almacén, código) afectadas a partir de sus dos
+        # conteos más recientes, usando el índice idx_inventario_codigo
+        """
+        CREATE OR REPLACE FUNCTION refrescar_stock_actual(p_almacenes TEXT[], p_codigos TEXT[])
+        RETURNS void AS $$
+        BEGIN
+            -- Serializa por clave para que escrituras concurrentes no se pisen
+            PERFORM pg_advisory_xact_lock(hashtext(k.almacen || '|' || k.codigo))
+            FROM (
+                SELECT DISTINCT almacen, codigo FROM unnest(p_almacenes, p_codigos) AS t(almacen, codigo)
+                ORDER BY almacen, codigo
+            ) k;
+            
+            INSERT INTO stock_actual (
+                almacen, codigo, producto, linea, unidad_medida,
+                ultimo_id, ultima_fecha, ultimo_conteo, ultimo_total,
+                fecha_anterior, conteo_anterior, total_anterior,
+                delta_unidades, delta_total
+            )
+            SELECT
+                k.almacen, k.codigo, u.producto, u.linea, u.unidad_medida,
+                u.id, u.fecha_hora, u.cantidad_unidades, u.total_kg_lt,
+                a.fecha_hora, a.cantidad_unidades, a.total_kg_lt,
+                u.cantidad_unidades - a.cantidad_unidades, u.total_kg_lt - a.total_kg_lt
+            FROM (
+                SELECT DISTINCT almacen, codigo FROM unnest(p_almacenes, p_codigos) AS t(almacen, codigo)
+            ) k
+            CROSS JOIN LATERAL (
+                SELECT * FROM inventario i
+                WHERE i.almacen = k.almacen AND i.codigo = k.codigo
+                ORDER BY i.fecha_hora DESC, i.id DESC
+                LIMIT 1
+            ) u
+            LEFT JOIN LATERAL (
+                SELECT * FROM inventario i
+                WHERE i.almacen = k.almacen AND i.codigo = k.codigo
+                ORDER BY i.fecha_hora DESC, i.id DESC
+                OFFSET 1 LIMIT 1
+            ) a ON TRUE
+            ON CONFLICT (almacen, codigo) DO UPDATE SET
+                producto = EXCLUDED.producto,
+                linea = EXCLUDED.linea,
+                unidad_medida = EXCLUDED.unidad_medida,
+                ultimo_id = EXCLUDED.ultimo_id,
+                ultima_fecha = EXCLUDED.ultima_fecha,
+                ultimo_conteo = EXCLUDED.ultimo_conteo,
+                ultimo_total = EXCLUDED.ultimo_total,
+                fecha_anterior = EXCLUDED.fecha_anterior,
+                conteo_anterior = EXCLUDED.conteo_anterior,
+                total_anterior = EXCLUDED.total_anterior,
+                delta_unidades = EXCLUDED.delta_unidades,
+                delta_total = EXCLUDED.delta_total;
+            
+            -- Claves que se quedaron sin conteos
+            DELETE FROM stock_actual s
+            USING unnest(p_almacenes, p_codigos) AS k(almacen, codigo)
+            WHERE s.almacen = k.almacen AND s.codigo = k.codigo
+              AND NOT EXISTS (
+                  SELECT 1 FROM inventario i WHERE i.almacen = s.almacen AND i.codigo = s.codigo
+              );
+        END;
+        $$ LANGUAGE plpgsql
+        """,
+        """
+        CREATE OR REPLACE FUNCTION stock_actual_tras_cambio() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP = 'INSERT' THEN
+                PERFORM refrescar_stock_actual(array_agg(almacen::text), array_agg(codigo::text)) FROM nuevos;
+            ELSIF TG_OP = 'DELETE' THEN
+                PERFORM refrescar_stock_actual(array_agg(almacen::text), array_agg(codigo::text)) FROM viejos;
+            ELSE
+                PERFORM refrescar_stock_actual(array_agg(almacen::text), array_agg(codigo::text))
+                FROM (SELECT almacen, codigo FROM nuevos UNION SELECT almacen, codigo FROM viejos) k;
+            END IF;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+        """,
+        "DROP TRIGGER IF EXISTS trg_inventario_stock_insert ON inventario",
+        "DROP TRIGGER IF EXISTS trg_inventario_stock_delete ON inventario",
+        "DROP TRIGGER IF EXISTS trg_inventario_stock_update ON inventario",
+        """
+        CREATE TRIGGER trg_inventario_stock_insert
+        AFTER INSERT ON inventario REFERENCING NEW TABLE AS nuevos
+        FOR EACH STATEMENT EXECUTE FUNCTION stock_actual_tras_cambio()
+        """,
+        """
+        CREATE TRIGGER trg_inventario_stock_delete
+        AFTER DELETE ON inventario REFERENCING OLD TABLE AS viejos
+        FOR EACH STATEMENT EXECUTE FUNCTION stock_actual_tras_cambio()
+        """,
+        """
+        CREATE TRIGGER trg_inventario_stock_update
+        AFTER UPDATE ON inventario REFERENCING OLD TABLE AS viejos NEW TABLE AS nuevos
+        FOR EACH STATEMENT EXECUTE FUNCTION stock_actual_tras_cambio()
+        """,
+        # Carga inicial con el historial existente
+        """
+        SELECT refrescar_stock_actual(array_agg(almacen::text), array_agg(codigo::text))
+        FROM (SELECT DISTINCT almacen, codigo FROM inventario) k
+        """,
+    ]),
+    (6, "Particionado mensual de inventario por fecha_hora", [
+        # La tabla actual se reemplaza por una particionada con los mismos datos;
+        # la clave primaria debe incluir la columna de partición
+        "ALTER TABLE inventario RENAME TO inventario_sin_particionar",
+        "ALTER INDEX inventario_pkey RENAME TO inventario_sin_particionar_pkey",
+        "ALTER SEQUENCE inventario_id_seq OWNED BY NONE",
+        """
+        CREATE TABLE inventario (
+            id INTEGER NOT NULL DEFAULT nextval('inventario_id_seq'),
+            fecha_hora TIMESTAMP NOT NULL,
+            codigo VARCHAR(100),
+            producto VARCHAR(255),
+            clasificacion VARCHAR(100),
+            linea VARCHAR(100),
+            presentacion VARCHAR(100),
+            cantidad_unidades INTEGER,
+            total_kg_lt NUMERIC,
+            unidad_medida VARCHAR(50),
+            almacen VARCHAR(100),
+            responsable VARCHAR(100),
+            observaciones TEXT,
+            estado VARCHAR(50) DEFAULT 'Pendiente',
+            PRIMARY KEY (id, fecha_hora)
+        ) PARTITION BY RANGE (fecha_hora)
+        """,
+        "ALTER SEQUENCE inventario_id_seq OWNED BY inventario.id",
+        "CREATE TABLE IF NOT EXISTS inventario_default PARTITION OF inventario DEFAULT",
+        """
+        CREATE OR REPLACE FUNCTION asegurar_particiones_inventario(p_desde DATE, p_hasta DATE)
+        RETURNS void AS $$
+        DECLARE
+            mes DATE := date_trunc('month', p_desde);
+            particion TEXT;
+        BEGIN
+            WHILE mes <= p_hasta LOOP
+                particion := 'inventario_' || to_char(mes, 'YYYY_MM');
+                IF to_regclass(particion) IS NULL THEN
+                    EXECUTE format(
+                        'CREATE TABLE %I PARTITION OF inventario FOR VALUES FROM (%L) TO (%L)',
+                        particion, mes, (mes + interval '1 month')::date
+                    );
+                END IF;
+                mes := (mes + interval '1 month')::date;
+            END LOOP;
+        END;
+        $$ LANGUAGE plpgsql
+        """,
+        """
+        SELECT asegurar_particiones_inventario(
+            COALESCE((SELECT MIN(fecha_hora)::date FROM inventario_sin_particionar), CURRENT_DATE),
+            CURRENT_DATE + 62
+        )
+        """,
+        """
+        INSERT INTO inventario (
+            id, fecha_hora, codigo, producto, clasificacion, linea, presentacion,
+            cantidad_unidades, total_kg_lt, unidad_medida, almacen, responsable,
+            observaciones, estado
+        )
+        SELECT
+            id, COALESCE(fecha_hora, TIMESTAMP '2000-01-01'), codigo, producto, clasificacion, linea, presentacion,
+            cantidad_unidades, total_kg_lt, unidad_medida, almacen, responsable,
+            observaciones, estado
+        FROM inventario_sin_particionar
+        """,
+        "DROP TABLE inventario_sin_particionar",
+        # Índices y triggers se crean en la tabla padre y se propagan a las particiones
+        "CREATE INDEX IF NOT EXISTS idx_inventario_fecha ON inventario (fecha_hora DESC, id DESC)",
+        "CREATE INDEX IF NOT EXISTS idx_inventario_almacen_fecha ON inventario (almacen, fecha_hora DESC, id DESC)",
+        "CREATE INDEX IF NOT EXISTS idx_inventario_linea_fecha ON inventario (linea, fecha_hora DESC, id DESC)",
+        "CREATE INDEX IF NOT EXISTS idx_inventario_clasificacion_fecha ON inventario (clasificacion, fecha_hora DESC, id DESC)",
+        """
+        CREATE INDEX IF NOT EXISTS idx_inventario_codigo
+        ON inventario (codigo, almacen, fecha_hora DESC)
+        INCLUDE (cantidad_unidades, total_kg_lt, unidad_medida)
+        """,
+        """
+        CREATE TRIGGER trg_inventario_version
+        AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON inventario
+        FOR EACH STATEMENT EXECUTE FUNCTION incrementar_version('inventario')
+        """,
+        """
+        CREATE TRIGGER trg_inventario_stock_insert
+        AFTER INSERT ON inventario REFERENCING NEW TABLE AS nuevos
+        FOR EACH STATEMENT EXECUTE FUNCTION stock_actual_tras_cambio()
+        """,
+        """
+        CREATE TRIGGER trg_inventario_stock_delete
+        AFTER DELETE ON inventario REFERENCING OLD TABLE AS viejos
+        FOR EACH STATEMENT EXECUTE FUNCTION stock_actual_tras_cambio()
+        """,
+        """
+        CREATE TRIGGER trg_inventario_stock_update
+        AFTER UPDATE ON inventario REFERENCING OLD TABLE AS viejos NEW TABLE AS nuevos
+        FOR EACH STATEMENT EXECUTE FUNCTION stock_actual_tras_cambio()
+        """,
+        "UPDATE versiones SET version = version + 1 WHERE nombre = 'inventario'",
+        "ANALYZE inventario",
+    ]),
+    (7, "Varianzas entre conteos consecutivos", [
+        """
+        CREATE TABLE IF NOT EXISTS varianzas (
+            inventario_id INTEGER NOT NULL,
+            almacen VARCHAR(100) NOT NULL,
+            codigo VARCHAR(100) NOT NULL,
+            producto VARCHAR(255),
+            unidad_medida VARCHAR(50),
+            fecha_hora TIMESTAMP NOT NULL,
+            fecha_anterior TIMESTAMP,
+            cantidad_unidades INTEGER,
+            cantidad_anterior INTEGER,
+            total_kg_lt NUMERIC,
+            total_anterior NUMERIC,
+            delta_unidades INTEGER,
+            delta_total NUMERIC,
+            delta_pct NUMERIC,
+            es_atipico BOOLEAN NOT NULL DEFAULT FALSE,
+            PRIMARY KEY (almacen, codigo, fecha_hora, inventario_id)
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_varianzas_fecha ON varianzas (fecha_hora DESC)",
+        "CREATE INDEX IF NOT EXISTS idx_varianzas_atipicas ON varianzas (fecha_hora DESC) WHERE es_atipico",
+        # Claves (almacén, código) cuyas varianzas hay que recalcular
+        """
+        CREATE TABLE IF NOT EXISTS varianzas_pendientes (
+            almacen VARCHAR(100) NOT NULL,
+            codigo VARCHAR(100) NOT NULL,
+            PRIMARY KEY (almacen, codigo)
+        )
+        """,
+        """
+        CREATE OR REPLACE FUNCTION marcar_varianzas_pendientes() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP IN ('INSERT', 'UPDATE') THEN
+                INSERT INTO varianzas_pendientes (almacen, codigo)
+                SELECT DISTINCT almacen, codigo FROM nuevos WHERE almacen IS NOT NULL AND codigo IS NOT NULL
+                ON CONFLICT DO NOTHING;
+            END IF;
+            IF TG_OP IN ('DELETE', 'UPDATE') THEN
+                INSERT INTO varianzas_pendientes (almacen, codigo)
+                SELECT DISTINCT almacen, codigo FROM viejos WHERE almacen IS NOT NULL AND codigo IS NOT NULL
+                ON CONFLICT DO NOTHING;
+            END IF;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+        """,
+        """
+        CREATE TRIGGER trg_inventario_varianzas_insert
+        AFTER INSERT ON inventario REFERENCING NEW TABLE AS nuevos
+        FOR EACH STATEMENT EXECUTE FUNCTION marcar_varianzas_pendientes()
+        """,
+        """
+        CREATE TRIGGER trg_inventario_varianzas_delete
+        AFTER DELETE ON inventario REFERENCING OLD TABLE AS viejos
+        FOR EACH STATEMENT EXECUTE FUNCTION marcar_varianzas_pendientes()
+        """,
+        """
+        CREATE TRIGGER trg_inventario_varianzas_update
+        AFTER UPDATE ON inventario REFERENCING OLD TABLE AS viejos NEW TABLE AS nuevos
+        FOR EACH STATEMENT EXECUTE FUNCTION marcar_varianzas_pendientes()
+        """,
+        """
+        INSERT INTO varianzas_pendientes (almacen, codigo)
+        SELECT DISTINCT almacen, codigo FROM inventario WHERE almacen IS NOT NULL AND codigo IS NOT NULL
+        ON CONFLICT DO NOTHING
+        """,
+    ]),
+    (8, "Plan de conteo cíclico ABC", [
+        """
+        CREATE TABLE IF NOT EXISTS plan_conteo (
+            fecha DATE NOT NULL,
+            almacen VARCHAR(100) NOT NULL,
+            posicion INTEGER NOT NULL,
+            codigo VARCHAR(100) NOT NULL,
+            producto VARCHAR(255),
+            clase CHAR(1) NOT NULL,
+            ultima_fecha TIMESTAMP,
+            dias_atraso NUMERIC,
+            PRIMARY KEY (fecha, almacen, codigo)
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_plan_conteo_posicion ON plan_conteo (fecha, almacen, posicion)",
+        # Un registro por (fecha, almacén) con plan ya generado, aunque quede vacío
+        """
+        CREATE TABLE IF NOT EXISTS plan_conteo_generado (
+            fecha DATE NOT NULL,
+            almacen VARCHAR(100) NOT NULL,
+            generado_en TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (fecha, almacen)
+        )
+        """,
+    ]),
+    (9, "Clave de idempotencia por registro", [
+        "ALTER TABLE inventario ADD COLUMN IF NOT EXISTS id_cliente UUID",
+        # En una tabla particionada la unicidad debe incluir la columna de partición;
+        # la fecha la fija el cliente, así que un reintento repite ambos valores
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_inventario_id_cliente ON inventario (id_cliente, fecha_hora)",
+    ]),
+    (10, "Esquema normalizado: conteos con dimensiones y vista inventario", [
+        # Los textos que se repetían en cada fila pasan a tablas de dimensión y
+        # la tabla de hechos guarda solo sus ids. Los atributos del producto se
+        # guardan tal como se registraron (un id por combinación), así el
+        # historial no cambia cuando se edita el catálogo. Un texto NULL se
+        # guarda como cadena vacía.
+        "ALTER TABLE inventario RENAME TO inventario_sin_normalizar",
+        "ALTER SEQUENCE inventario_id_seq OWNED BY NONE",
+        """
+        CREATE TABLE dim_producto (
+            id SERIAL PRIMARY KEY,
+            codigo VARCHAR(100) NOT NULL,
+            producto VARCHAR(255) NOT NULL,
+            clasificacion VARCHAR(100) NOT NULL,
+            linea VARCHAR(100) NOT NULL,
+            presentacion VARCHAR(100) NOT NULL,
+            unidad_medida VARCHAR(50) NOT NULL,
+            UNIQUE (codigo, producto, clasificacion, linea, presentacion, unidad_medida)
+        )
+        """,
+        """
+        CREATE TABLE dim_almacen (
+            id SMALLSERIAL PRIMARY KEY,
+            almacen VARCHAR(100) NOT NULL UNIQUE
+        )
+        """,
+        """
+        CREATE TABLE dim_responsable (
+            id SERIAL PRIMARY KEY,
+            responsable VARCHAR(100) NOT NULL UNIQUE
+        )
+        """,
+        # Columnas de ancho fijo primero, de mayor a menor alineación, para no
+        # desperdiciar relleno en cada fila
+        """
+        CREATE TABLE conteos (
+            fecha_hora TIMESTAMP NOT NULL,
+            id_cliente UUID,
+            id INTEGER NOT NULL DEFAULT nextval('inventario_id_seq'),
+            producto_id INTEGER NOT NULL REFERENCES dim_producto (id),
+            responsable_id INTEGER REFERENCES dim_responsable (id),
+            cantidad_unidades INTEGER,
+            almacen_id SMALLINT REFERENCES dim_almacen (id),
+            total_kg_lt NUMERIC,
+            observaciones TEXT,
+            estado VARCHAR(50) DEFAULT 'Pendiente',
+            PRIMARY KEY (id, fecha_hora)
+        ) PARTITION BY RANGE (fecha_hora)
+        """,
+        "ALTER SEQUENCE inventario_id_seq OWNED BY conteos.id",
+        "CREATE TABLE conteos_default PARTITION OF conteos DEFAULT",
+        """
+        CREATE OR REPLACE FUNCTION asegurar_particiones_inventario(p_desde DATE, p_hasta DATE)
+        RETURNS void AS $$
+        DECLARE
+            mes DATE := date_trunc('month', p_desde);
+            particion TEXT;
+        BEGIN
+            WHILE mes <= p_hasta LOOP
+                particion := 'conteos_' || to_char(mes, 'YYYY_MM');
+                IF to_regclass(particion) IS NULL THEN
+                    EXECUTE format(
+                        'CREATE TABLE %I PARTITION OF conteos FOR VALUES FROM (%L) TO (%L)',
+                        particion, mes, (mes + interval '1 month')::date
+                    );
+                END IF;
+                mes := (mes + interval '1 month')::date;
+            END LOOP;
+        END;
+        $$ LANGUAGE plpgsql
+        """,
+        # Solo fechas reales: los conteos sin fecha de la migración 6 (fecha
+        # 2000-01-01) quedan en la partición DEFAULT
+        """
+        SELECT asegurar_particiones_inventario(
+            COALESCE(
+                (SELECT MIN(fecha_hora)::date FROM inventario_sin_normalizar
+                 WHERE fecha_hora <> TIMESTAMP '2000-01-01'),
+                CURRENT_DATE
+            ),
+            CURRENT_DATE + 62
+        )
+        """,
+        # Copia del historial en SQL fijo (no con integrar_conteos) para que la
+        # migración no cambie si cambia el código de guardado
+        """
+        INSERT INTO dim_producto (codigo, producto, clasificacion, linea, presentacion, unidad_medida)
+        SELECT DISTINCT COALESCE(codigo, ''), COALESCE(producto, ''), COALESCE(clasificacion, ''),
+               COALESCE(linea, ''), COALESCE(presentacion, ''), COALESCE(unidad_medida, '')
+        FROM inventario_sin_normalizar
+        """,
+        """
+        INSERT INTO dim_almacen (almacen)
+        SELECT DISTINCT almacen FROM inventario_sin_normalizar WHERE almacen IS NOT NULL
+        """,
+        """
+        INSERT INTO dim_responsable (responsable)
+        SELECT DISTINCT responsable FROM inventario_sin_normalizar WHERE responsable IS NOT NULL
+        """,
+        """
+        INSERT INTO conteos (
+            id, estado, id_cliente, fecha_hora, producto_id, almacen_id, responsable_id,
+            cantidad_unidades, total_kg_lt, observaciones
+        )
+        SELECT o.id, o.estado, o.id_cliente, o.fecha_hora, p.id, a.id, r.id,
+               o.cantidad_unidades, o.total_kg_lt, o.observaciones
+        FROM inventario_sin_normalizar o
+        JOIN dim_producto p
+          ON (p.codigo, p.producto, p.clasificacion, p.linea, p.presentacion, p.unidad_medida)
+           = (COALESCE(o.codigo, ''), COALESCE(o.producto, ''), COALESCE(o.clasificacion, ''),
+              COALESCE(o.linea, ''), COALESCE(o.presentacion, ''), COALESCE(o.unidad_medida, ''))
+        LEFT JOIN dim_almacen a ON a.almacen = o.almacen
+        LEFT JOIN dim_responsable r ON r.responsable = o.responsable
+        """,
+        "DROP TABLE inventario_sin_normalizar",
+        "CREATE INDEX idx_conteos_fecha ON conteos (fecha_hora DESC, id DESC)",
+        "CREATE INDEX idx_conteos_almacen_fecha ON conteos (almacen_id, fecha_hora DESC, id DESC)",
+        """
+        CREATE INDEX idx_conteos_producto
+        ON conteos (producto_id, almacen_id, fecha_hora DESC)
+        INCLUDE (cantidad_unidades, total_kg_lt)
+        """,
+        "CREATE UNIQUE INDEX idx_conteos_id_cliente ON conteos (id_cliente, fecha_hora)",
+        # Los filtros de línea y clasificación del historial eligen productos en
+        # dim_producto y de ahí bajan a conteos por producto, en orden de fecha
+        "CREATE INDEX idx_dim_producto_linea ON dim_producto (linea)",
+        "CREATE INDEX idx_dim_producto_clasificacion ON dim_producto (clasificacion)",
+        "CREATE INDEX idx_conteos_producto_fecha ON conteos (producto_id, fecha_hora DESC, id DESC)",
+        "CREATE VIEW inventario AS " + SQL_VISTA_INVENTARIO.format(tabla="conteos"),
+        # Los triggers pasan a conteos y traducen los ids de dimensión a (almacén, código)
+        """
+        CREATE OR REPLACE FUNCTION stock_actual_tras_cambio() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP = 'INSERT' THEN
+                PERFORM refrescar_stock_actual(array_agg(a.almacen::text), array_agg(p.codigo::text))
+                FROM nuevos n
+                JOIN dim_almacen a ON a.id = n.almacen_id
+                JOIN dim_producto p ON p.id = n.producto_id AND p.codigo <> '';
+            ELSIF TG_OP = 'DELETE' THEN
+                PERFORM refrescar_stock_actual(array_agg(a.almacen::text), array_agg(p.codigo::text))
+                FROM viejos n
+                JOIN dim_almacen a ON a.id = n.almacen_id
+                JOIN dim_producto p ON p.id = n.producto_id AND p.codigo <> '';
+            ELSE
+                PERFORM refrescar_stock_actual(array_agg(a.almacen::text), array_agg(p.codigo::text))
+                FROM (
+                    SELECT almacen_id, producto_id FROM nuevos
+                    UNION SELECT almacen_id, producto_id FROM viejos
+                ) n
+                JOIN dim_almacen a ON a.id = n.almacen_id
+                JOIN dim_producto p ON p.id = n.producto_id AND p.codigo <> '';
+            END IF;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+        """,
+        """
+        CREATE OR REPLACE FUNCTION marcar_varianzas_pendientes() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP IN ('INSERT', 'UPDATE') THEN
+                INSERT INTO varianzas_pendientes (almacen, codigo)
+                SELECT DISTINCT a.almacen, p.codigo
+                FROM nuevos n
+                JOIN dim_almacen a ON a.id = n.almacen_id
+                JOIN dim_producto p ON p.id = n.producto_id AND p.codigo <> ''
+                ON CONFLICT DO NOTHING;
+            END IF;
+            IF TG_OP IN ('DELETE', 'UPDATE') THEN
+                INSERT INTO varianzas_pendientes (almacen, codigo)
+                SELECT DISTINCT a.almacen, p.codigo
+                FROM viejos n
+                JOIN dim_almacen a ON a.id = n.almacen_id
+                JOIN dim_producto p ON p.id = n.producto_id AND p.codigo <> ''
+                ON CONFLICT DO NOTHING;
+            END IF;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+        """,
+        """
+        CREATE TRIGGER trg_conteos_version
+        AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON conteos
+        FOR EACH STATEMENT EXECUTE FUNCTION incrementar_version('inventario')
+        """,
+        """
+        CREATE TRIGGER trg_conteos_stock_insert
+        AFTER INSERT ON conteos REFERENCING NEW TABLE AS nuevos
+        FOR EACH STATEMENT EXECUTE FUNCTION stock_actual_tras_cambio()
+        """,
+        """
+        CREATE TRIGGER trg_conteos_stock_delete
+        AFTER DELETE ON conteos REFERENCING OLD TABLE AS viejos
+        FOR EACH STATEMENT EXECUTE FUNCTION stock_actual_tras_cambio()
+        """,
+        """
+        CREATE TRIGGER trg_conteos_stock_update
+        AFTER UPDATE ON conteos REFERENCING OLD TABLE AS viejos NEW TABLE AS nuevos
+        FOR EACH STATEMENT EXECUTE FUNCTION stock_actual_tras_cambio()
+        """,
+        """
+        CREATE TRIGGER trg_conteos_varianzas_insert
+        AFTER INSERT ON conteos REFERENCING NEW TABLE AS nuevos
+        FOR EACH STATEMENT EXECUTE FUNCTION marcar_varianzas_pendientes()
+        """,
+        """
+        CREATE TRIGGER trg_conteos_varianzas_delete
+        AFTER DELETE ON conteos REFERENCING OLD TABLE AS viejos
+        FOR EACH STATEMENT EXECUTE FUNCTION marcar_varianzas_pendientes()
+        """,
+        """
+        CREATE TRIGGER trg_conteos_varianzas_update
+        AFTER UPDATE ON conteos REFERENCING OLD TABLE AS viejos NEW TABLE AS nuevos
+        FOR EACH STATEMENT EXECUTE FUNCTION marcar_varianzas_pendientes()
+        """,
+        "UPDATE versiones SET version = version + 1 WHERE nombre = 'inventario'",
+        "ANALYZE conteos",
+        "ANALYZE dim_producto",
+        "ANALYZE dim_almacen",
+        "ANALYZE dim_responsable",
+    ]),
+    (11, "Registro de cambios de conteos para refrescos incrementales", [
+        # Cada fila insertada, modificada o borrada deja su id con la transacción
+        # que la cambió. Una sesión guarda el snapshot con el que leyó y después
+        # pide solo los cambios que ese snapshot no veía (requiere PostgreSQL 13+)
+        """
+        CREATE TABLE IF NOT EXISTS cambios_inventario (
+            xid XID8 NOT NULL DEFAULT pg_current_xact_id(),
+            registrado_en TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            operacion CHAR(1) NOT NULL,
+            id INTEGER NOT NULL
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_cambios_inventario_xid ON cambios_inventario (xid)",
+        "CREATE INDEX IF NOT EXISTS idx_cambios_inventario_registrado ON cambios_inventario (registrado_en)",
+        """
+        CREATE OR REPLACE FUNCTION registrar_cambios_inventario() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP = 'INSERT' THEN
+                INSERT INTO cambios_inventario (operacion, id) SELECT 'I', id FROM nuevos;
+            ELSIF TG_OP = 'UPDATE' THEN
+                INSERT INTO cambios_inventario (operacion, id) SELECT 'U', id FROM nuevos;
+            ELSIF TG_OP = 'DELETE' THEN
+                INSERT INTO cambios_inventario (operacion, id) SELECT 'D', id FROM viejos;
+            ELSE
+                -- TRUNCATE: las sesiones vuelven a leer todo
+                INSERT INTO cambios_inventario (operacion, id) VALUES ('T', 0);
+            END IF;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+        """,
+        """
+        CREATE TRIGGER trg_conteos_cambios_insert
+        AFTER INSERT ON conteos REFERENCING NEW TABLE AS nuevos
+        FOR EACH STATEMENT EXECUTE FUNCTION registrar_cambios_inventario()
+        """,
+        """
+        CREATE TRIGGER trg_conteos_cambios_update
+        AFTER UPDATE ON conteos REFERENCING NEW TABLE AS nuevos
+        FOR EACH STATEMENT EXECUTE FUNCTION registrar_cambios_inventario()
+        """,
+        """
+        CREATE TRIGGER trg_conteos_cambios_delete
+        AFTER DELETE ON conteos REFERENCING OLD TABLE AS viejos
+        FOR EACH STATEMENT EXECUTE FUNCTION registrar_cambios_inventario()
+        """,
+        """
+        CREATE TRIGGER trg_conteos_cambios_truncate
+        AFTER TRUNCATE ON conteos
+        FOR EACH STATEMENT EXECUTE FUNCTION registrar_cambios_inventario()
+        """,
+    ]),
+    (12, "Notificaciones de conteos para el tablero en vivo", [
+        # Al confirmarse la transacción se avisa por el canal conteos con los
+        # ids insertados o borrados; sentencias grandes solo piden recargar
+        # para no pasar el límite de 8000 bytes del mensaje
+        """
+        CREATE OR REPLACE FUNCTION notificar_conteos() RETURNS trigger AS $$
+        DECLARE
+            ids INTEGER[];
+        BEGIN
+            IF TG_OP = 'INSERT' THEN
+                SELECT array_agg(id) INTO ids FROM nuevos;
+            ELSE
+                SELECT array_agg(id) INTO ids FROM viejos;
+            END IF;
+            IF ids IS NULL THEN
+                RETURN NULL;
+            END IF;
+            IF cardinality(ids) > 200 THEN
+                PERFORM pg_notify('conteos', json_build_object('op', left(TG_OP, 1), 'recargar', true)::text);
+            ELSE
+                PERFORM pg_notify('conteos', json_build_object('op', left(TG_OP, 1), 'ids', ids)::text);
+            END IF;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+        """,
+        """
+        CREATE TRIGGER trg_conteos_notificar_insert
+        AFTER INSERT ON conteos REFERENCING NEW TABLE AS nuevos
+        FOR EACH STATEMENT EXECUTE FUNCTION notificar_conteos()
+        """,
+        """
+        CREATE TRIGGER trg_conteos_notificar_delete
+        AFTER DELETE ON conteos REFERENCING OLD TABLE AS viejos
+        FOR EACH STATEMENT EXECUTE FUNCTION notificar_conteos()
+        """,
+    ]),
+    (13, "Volumen histórico por producto para el plan ABC", [
+        # Suma de kg/lt contados y cantidad de conteos por (almacén, código) en
+        # todo el historial, mantenidas por diferencias en cada escritura; el
+        # plan ABC usa su cociente (volumen promedio por conteo) sin recorrer
+        # conteos
+        """
+        CREATE TABLE volumen_conteos (
+            almacen VARCHAR(100) NOT NULL,
+            codigo VARCHAR(100) NOT NULL,
+            volumen NUMERIC NOT NULL DEFAULT 0,
+            conteos INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (almacen, codigo)
+        )
+        """,
+        """
+        CREATE OR REPLACE FUNCTION acumular_volumen_conteos() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP IN ('DELETE', 'UPDATE') THEN
+                UPDATE volumen_conteos v
+                SET volumen = v.volumen - d.volumen, conteos = v.conteos - d.conteos
+                FROM (
+                    SELECT a.almacen, p.codigo, SUM(ABS(COALESCE(n.total_kg_lt, 0))) AS volumen, count(*) AS conteos
+                    FROM viejos n
+                    JOIN dim_almacen a ON a.id = n.almacen_id
+                    JOIN dim_producto p ON p.id = n.producto_id AND p.codigo <> ''
+                    GROUP BY a.almacen, p.codigo
+                ) d
+                WHERE v.almacen = d.almacen AND v.codigo = d.codigo;
+            END IF;
+            IF TG_OP IN ('INSERT', 'UPDATE') THEN
+                INSERT INTO volumen_conteos (almacen, codigo, volumen, conteos)
+                SELECT a.almacen, p.codigo, SUM(ABS(COALESCE(n.total_kg_lt, 0))), count(*)
+                FROM nuevos n
+                JOIN dim_almacen a ON a.id = n.almacen_id
+                JOIN dim_producto p ON p.id = n.producto_id AND p.codigo <> ''
+                GROUP BY a.almacen, p.codigo
+                ORDER BY a.almacen, p.codigo
+                ON CONFLICT (almacen, codigo) DO UPDATE SET
+                    volumen = volumen_conteos.volumen + EXCLUDED.volumen,
+                    conteos = volumen_conteos.conteos + EXCLUDED.conteos;
+            END IF;
+            IF TG_OP = 'DELETE' THEN
+                DELETE FROM volumen_conteos WHERE conteos <= 0;
+            END IF;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+        """,
+        """
+        CREATE TRIGGER trg_conteos_volumen_insert
+        AFTER INSERT ON conteos REFERENCING NEW TABLE AS nuevos
+        FOR EACH STATEMENT EXECUTE FUNCTION acumular_volumen_conteos()
+        """,
+        """
+        CREATE TRIGGER trg_conteos_volumen_delete
+        AFTER DELETE ON conteos REFERENCING OLD TABLE AS viejos
+        FOR EACH STATEMENT EXECUTE FUNCTION acumular_volumen_conteos()
+        """,
+        """
+        CREATE TRIGGER trg_conteos_volumen_update
+        AFTER UPDATE ON conteos REFERENCING OLD TABLE AS viejos NEW TABLE AS nuevos
+        FOR EACH STATEMENT EXECUTE FUNCTION acumular_volumen_conteos()
+        """,
+        # Carga inicial con el historial existente
+        """
+        INSERT INTO volumen_conteos (almacen, codigo, volumen, conteos)
+        SELECT almacen, codigo, SUM(ABS(COALESCE(total_kg_lt, 0))), count(*)
+        FROM inventario
+        WHERE almacen IS NOT NULL AND codigo <> ''
+        GROUP BY almacen, codigo
+        """,
+    ]),
+    (14, "Stock actual leído de conteos por índice", [
+        # A través de la vista, ORDER BY fecha_hora recorría todas las
+        # particiones filtrando por los textos de las dimensiones. Ahora se
+        # resuelven primero los ids del almacén y de los productos del código
+        # (un código puede tener varios ids de producto) y cada par se busca
+        # en este índice, tomando el último conteo y el anterior
+        """
+        CREATE INDEX idx_conteos_almacen_producto
+        ON conteos (almacen_id, producto_id, fecha_hora DESC, id DESC)
+        INCLUDE (cantidad_unidades, total_kg_lt)
+        """,
+        """
+        CREATE OR REPLACE FUNCTION refrescar_stock_actual(p_almacenes TEXT[], p_codigos TEXT[])
+        RETURNS void AS $$
+        BEGIN
+            -- Serializa por clave para que escrituras concurrentes no se pisen
+            PERFORM pg_advisory_xact_lock(hashtext(k.almacen || '|' || k.codigo))
+            FROM (
+                SELECT DISTINCT almacen, codigo FROM unnest(p_almacenes, p_codigos) AS t(almacen, codigo)
+                ORDER BY almacen, codigo
+            ) k;
+            
+            INSERT INTO stock_actual (
+                almacen, codigo, producto, linea, unidad_medida,
+                ultimo_id, ultima_fecha, ultimo_conteo, ultimo_total,
+                fecha_anterior, conteo_anterior, total_anterior,
+                delta_unidades, delta_total
+            )
+            SELECT
+                k.almacen, k.codigo, p.producto, p.linea, p.unidad_medida,
+                u.id, u.fecha_hora, u.cantidad_unidades, u.total_kg_lt,
+                a.fecha_hora, a.cantidad_unidades, a.total_kg_lt,
+                u.cantidad_unidades - a.cantidad_unidades, u.total_kg_lt - a.total_kg_lt
+            FROM (
+                SELECT DISTINCT almacen, codigo FROM unnest(p_almacenes, p_codigos) AS t(almacen, codigo)
+            ) k
+            JOIN dim_almacen d ON d.almacen = k.almacen
+            CROSS JOIN LATERAL (
+                SELECT array_agg(dp.id) AS ids FROM dim_producto dp WHERE dp.codigo = k.codigo
+            ) productos
+            CROSS JOIN LATERAL (
+                SELECT ultimo.* FROM unnest(productos.ids) AS pid(id)
+                CROSS JOIN LATERAL (
+                    SELECT c.id, c.fecha_hora, c.producto_id, c.cantidad_unidades, c.total_kg_lt
+                    FROM conteos c
+                    WHERE c.almacen_id = d.id AND c.producto_id = pid.id
+                    ORDER BY c.fecha_hora DESC, c.id DESC
+                    LIMIT 1
+                ) ultimo
+                ORDER BY ultimo.fecha_hora DESC, ultimo.id DESC
+                LIMIT 1
+            ) u
+            JOIN dim_producto p ON p.id = u.producto_id
+            LEFT JOIN LATERAL (
+                SELECT previo.* FROM unnest(productos.ids) AS pid(id)
+                CROSS JOIN LATERAL (
+                    SELECT c.id, c.fecha_hora, c.cantidad_unidades, c.total_kg_lt
+                    FROM conteos c
+                    WHERE c.almacen_id = d.id AND c.producto_id = pid.id
+                      AND (c.fecha_hora, c.id) < (u.fecha_hora, u.id)
+                    ORDER BY c.fecha_hora DESC, c.id DESC
+                    LIMIT 1
+                ) previo
+                ORDER BY previo.fecha_hora DESC, previo.id DESC
+                LIMIT 1
+            ) a ON TRUE
+            ON CONFLICT (almacen, codigo) DO UPDATE SET
+                producto = EXCLUDED.producto,
+                linea = EXCLUDED.linea,
+                unidad_medida = EXCLUDED.unidad_medida,
+                ultimo_id = EXCLUDED.ultimo_id,
+                ultima_fecha = EXCLUDED.ultima_fecha,
+                ultimo_conteo = EXCLUDED.ultimo_conteo,
+                ultimo_total = EXCLUDED.ultimo_total,
+                fecha_anterior = EXCLUDED.fecha_anterior,
+                conteo_anterior = EXCLUDED.conteo_anterior,
+                total_anterior = EXCLUDED.total_anterior,
+                delta_unidades = EXCLUDED.delta_unidades,
+                delta_total = EXCLUDED.delta_total;
+            
+            -- Claves que se quedaron sin conteos (o cuyo almacén o código ya
+            -- no existe): se descartan sin recorrer el historial
+            DELETE FROM stock_actual s
+            USING unnest(p_almacenes, p_codigos) AS k(almacen, codigo)
+            WHERE s.almacen = k.almacen AND s.codigo = k.codigo
+              AND NOT EXISTS (
+                  SELECT 1
+                  FROM dim_almacen d
+                  JOIN dim_producto dp ON dp.codigo = k.codigo
+                  JOIN LATERAL (
+                      SELECT 1 FROM conteos c
+                      WHERE c.almacen_id = d.id AND c.producto_id = dp.id
+                      LIMIT 1
+                  ) c ON TRUE
+                  WHERE d.almacen = k.almacen
+              );
+        END;
+        $$ LANGUAGE plpgsql
+        """,
+    ]),
+    (15, "Conteos sin fecha marcados y en la partición DEFAULT", [
+        # La migración 6 guardó los conteos antiguos sin fecha con la fecha
+        # 2000-01-01, y la 10 creaba particiones mensuales vacías desde ahí.
+        # Esos conteos quedan marcados con fecha_desconocida y pasan a la
+        # partición DEFAULT; se eliminan las particiones anteriores al primer
+        # conteo con fecha real. Los movimientos se hacen directo sobre las
+        # particiones para no disparar los triggers de conteos.
+        "ALTER TABLE conteos ADD COLUMN fecha_desconocida BOOLEAN NOT NULL DEFAULT FALSE",
+        """
+        DO $$
+        DECLARE
+            primer_mes DATE;
+            particion TEXT;
+        BEGIN
+            SELECT date_trunc('month', MIN(fecha_hora))::date INTO primer_mes
+            FROM conteos WHERE fecha_hora <> TIMESTAMP '2000-01-01';
+            FOR particion IN
+                SELECT c.relname
+                FROM pg_inherits i
+                JOIN pg_class c ON c.oid = i.inhrelid
+                WHERE i.inhparent = 'conteos'::regclass
+                  AND c.relname ~ '^conteos_[0-9]{4}_[0-9]{2}$'
+                  AND to_date(substr(c.relname, 9), 'YYYY_MM')
+                      < COALESCE(primer_mes, date_trunc('month', CURRENT_DATE)::date)
+                ORDER BY c.relname
+            LOOP
+                EXECUTE format('ALTER TABLE conteos DETACH PARTITION %I', particion);
+                EXECUTE format(
+                    'INSERT INTO conteos_default (
+                         fecha_hora, id_cliente, id, producto_id, responsable_id, cantidad_unidades,
+                         almacen_id, total_kg_lt, observaciones, estado
+                     )
+                     SELECT fecha_hora, id_cliente, id, producto_id, responsable_id, cantidad_unidades,
+                            almacen_id, total_kg_lt, observaciones, estado
+                     FROM %I',
+                    particion
+                );
+                EXECUTE format('DROP TABLE %I', particion);
+            END LOOP;
+        END;
+        $$
+        """,
+        "UPDATE conteos_default SET fecha_desconocida = TRUE WHERE fecha_hora = TIMESTAMP '2000-01-01'",
+    ]),
+    (16, "Productos descartados al sembrar el catálogo", [
+        # La migración 4 la crea solo si hubo descartes; aquí se asegura que
+        # exista para que la administración pueda consultarla
+        SQL_CATALOGO_DESCARTADOS,
+    ]),
+]
+
+# Clave del advisory lock que serializa las migraciones entre réplicas
+MIGRACIONES_LOCK = 7245001
+
+def version_esquema(conn):
+    """Devuelve la última versión de esquema aplicada (0 si no hay ninguna)"""
+    conn.execute(text("""
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            descripcion TEXT,
+            aplicada_en TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """))
+    return conn.execute(text("SELECT COALESCE(MAX(version), 0) FROM schema_version")).scalar()
+
+@st.cache_resource(show_spinner=False)
+def init_db():
+    """Aplica en PostgreSQL las migraciones de esquema pendientes (una vez por proceso)"""
+    ultima = MIGRACIONES[-1][0]
+    with engine.begin() as conn:
+        if version_esquema(conn) >= ultima:
+            return
+    
+    with engine.begin() as conn:
+        sin_timeout(conn)
+        # Otra réplica puede estar migrando: esperar y volver a comprobar
+        conn.execute(text("SELECT pg_advisory_xact_lock(:clave)"), {"clave": MIGRACIONES_LOCK})
+        actual = version_esquema(conn)
+        for version, descripcion, sentencias in MIGRACIONES:
+            if version <= actual:
+                continue
+            for sentencia in sentencias:
+                if callable(sentencia):
+                    sentencia(conn)
+                else:
+                    conn.execute(text(sentencia))
+            conn.execute(
+                text("INSERT INTO schema_version (version, descripcion) VALUES (:version, :descripcion)"),
+                {"version": version, "descripcion": descripcion}
+            )
+
+@st.cache_resource(ttl=86400, show_spinner=False)
+def asegurar_particiones():
+    """Crea las particiones del mes actual y los dos siguientes (una vez al día por proceso)"""
+    with engine.begin() as conn:
+        conn.execute(text("SELECT asegurar_particiones_inventario(CURRENT_DATE, CURRENT_DATE + 62)"))
+
+@st.cache_resource(ttl=3600, show_spinner=False)
+def podar_cambios():
+    """Borra del registro de cambios lo anterior a CAMBIOS_RETENCION_HORAS (una vez por hora por proceso)"""
+    with engine.begin() as conn:
+        conn.execute(
+            text("DELETE FROM cambios_inventario WHERE registrado_en < CURRENT_TIMESTAMP - make_interval(hours => :horas)"),
+            {"horas": CAMBIOS_RETENCION_HORAS}
+        )
+
+# --- FUNCIONES DEL CATÁLOGO ---
+@st.cache_resource(max_entries=2, show_spinner=False)
+def _catalogo_por_version(version):
+    """Lee el catálogo de la base de datos; se comparte entre sesiones por versión"""
+    with engine.connect() as conn:
+        filas = conn.execute(text("""
+            SELECT nombre, codigo, presentacion, factor, unidad, clasificacion, linea
+            FROM catalogo
+            ORDER BY orden
+        """)).mappings().all()
+    return {
+        fila["nombre"]: {
+            "codigo": fila["codigo"],
+            "presentacion": fila["presentacion"],
+            "factor": fila["factor"],
+            "unidad": fila["unidad"],
+            "clasificacion": fila["clasificacion"],
+            "linea": fila["linea"]
+        }
+        for fila in filas
+    }
+
+def cargar_catalogo():
+    """Devuelve el catálogo vigente, releyéndolo solo cuando cambia su versión
+
+    El diccionario devuelto es compartido entre sesiones y no debe modificarse;
+    los cambios se hacen con agregar_producto(), editar_producto() y
+    eliminar_producto().
+    """
+    return _catalogo_por_version(version_datos("catalogo"))
+
+# Índice inmutable del catálogo, construido una vez por versión:
+#   por_linea: línea -> nombres en orden ("Todas" incluye todos)
+#   posicion: línea -> {nombre: posición dentro de esa línea}
+#   por_codigo: código -> nombre del producto
+#   claves: tuplas (texto normalizado, nombre) ordenadas para búsqueda por prefijo
+IndiceCatalogo = namedtuple(
+    "IndiceCatalogo",
+    ["catalogo", "nombres", "por_linea", "posicion", "por_codigo", "claves", "normalizados", "tabla"]
+)
+
+def _normalizar(texto):
+    """Pasa un texto a minúsculas y sin tildes para compararlo"""
+    return unicodedata.normalize("NFKD", str(texto)).encode("ascii", "ignore").decode().lower().strip()
+
+def _construir_indice(catalogo):
+    """Construye el índice de un catálogo (ver IndiceCatalogo)"""
+    nombres = tuple(catalogo)
+    
+    lineas = {"Todas": list(nombres)}
+    for nombre, datos in catalogo.items():
+        lineas.setdefault(datos.get("linea"), []).append(nombre)
+    por_linea = MappingProxyType({linea: tuple(lista) for linea, lista in lineas.items()})
+    posicion = MappingProxyType({
+        linea: MappingProxyType({nombre: i for i, nombre in enumerate(lista)})
+        for linea, lista in por_linea.items()
+    })
+    por_codigo = MappingProxyType({datos["codigo"]: nombre for nombre, datos in catalogo.items()})
+    
+    # Cada producto se indexa por su código y por cada sufijo de palabras del
+    # nombre, así "hepta" encuentra "Sulfato de Zinc Heptahidratado"
+    claves = []
+    for nombre, datos in catalogo.items():
+        claves.append((_normalizar(datos["codigo"]), nombre))
+        palabras = _normalizar(nombre).split()
+        for i in range(len(palabras)):
+            claves.append((" ".join(palabras[i:]), nombre))
+    
+    return IndiceCatalogo(
+        catalogo=catalogo,
+        nombres=nombres,
+        por_linea=por_linea,
+        posicion=posicion,
+        por_codigo=por_codigo,
+        claves=tuple(sorted(claves)),
+        normalizados=MappingProxyType({_normalizar(nombre): nombre for nombre in nombres}),
+        tabla=pd.DataFrame.from_dict(catalogo, orient='index')
+    )
+
+@st.cache_resource(max_entries=2, show_spinner=False)
+def _indice_por_version(version):
+    """Construye el índice del catálogo para una versión dada y guarda una copia local"""
+    catalogo = _catalogo_por_version(version)
+    diario_guardar_catalogo(version, catalogo)
+    return _construir_indice(catalogo)
+
+def indice_catalogo():
+    """Devuelve el índice del catálogo vigente (ver IndiceCatalogo)"""
+    return _indice_por_version(version_datos("catalogo"))
+
+def indice_catalogo_local():
+    """Devuelve el índice de la última copia local del catálogo, para trabajar sin conexión"""
+    return _construir_indice(diario_leer_catalogo() or CATALOGO_DEFAULT)
+
+def buscar_productos(indice, consulta, limite=20):
+    """Busca productos por prefijo de código o de palabras del nombre
+
+    Si no hay coincidencias por prefijo, recurre a una búsqueda aproximada
+    para tolerar errores de tipeo.
+    """
+    clave = _normalizar(consulta)
+    if not clave:
+        return []
+    encontrados = []
+    i = bisect.bisect_left(indice.claves, (clave,))
+    while i < len(indice.claves) and len(encontrados) < limite:
+        texto, nombre = indice.claves[i]
+        if not texto.startswith(clave):
+            break
+        if nombre not in encontrados:
+            encontrados.append(nombre)
+        i += 1
+    if not encontrados:
+        cercanos = difflib.get_close_matches(clave, indice.normalizados.keys(), n=limite, cutoff=0.6)
+        encontrados = [indice.normalizados[c] for c in cercanos]
+    return encontrados
+
+def _error_catalogo(e, nombre, codigo):
+    """Traduce una violación de unicidad del catálogo a un mensaje para el usuario"""
+    if getattr(getattr(e.orig, "diag", None), "constraint_name", None) == "catalogo_pkey":
+        return ValueError(f"Ya existe un producto con el código '{codigo}'")
+    return ValueError(f"Ya existe otro producto con la descripción '{nombre}'")
+
+def agregar_producto(nombre, datos):
+    """Agrega un producto nuevo al catálogo
+
+    Lanza ValueError si el código o la descripción ya están en uso; un
+    producto existente solo se cambia con editar_producto().
+    """
+    try:
+        with engine.begin() as conn:
+            conn.execute(text("""
+                INSERT INTO catalogo (codigo, nombre, presentacion, factor, unidad, clasificacion, linea)
+                VALUES (:codigo, :nombre, :presentacion, :factor, :unidad, :clasificacion, :linea)
+            """), {"nombre": nombre, **datos})
+    except IntegrityError as e:
+        raise _error_catalogo(e, nombre, datos["codigo"]) from e
+
+def editar_producto(codigo, nombre, datos):
+    """Actualiza la descripción y los atributos del producto con ese código
+
+    El historial no cambia: cada conteo conserva los atributos con que se
+    registró. Lanza ValueError si la descripción ya la usa otro producto.
+    """
+    try:
+        with engine.begin() as conn:
+            conn.execute(text("""
+                UPDATE catalogo SET
+                    nombre = :nombre,
+                    presentacion = :presentacion,
+                    factor = :factor,
+                    unidad = :unidad,
+                    clasificacion = :clasificacion,
+                    linea = :linea
+                WHERE codigo = :codigo
+            """), {**datos, "nombre": nombre, "codigo": codigo})
+    except IntegrityError as e:
+        raise _error_catalogo(e, nombre, codigo) from e
+
+def obtener_productos_descartados():
+    """Devuelve los productos que no entraron al catálogo al sembrarlo"""
+    with engine.connect() as conn:
+        return pd.read_sql(text("""
+            SELECT codigo, nombre, presentacion, clasificacion, linea, motivo, registrado_en
+            FROM catalogo_descartados
+            ORDER BY registrado_en, nombre
+        """), conn)
+
+def eliminar_producto(nombre):
+    """Elimina un producto del catálogo por su nombre"""
+    with engine.begin() as conn:
+        conn.execute(text("DELETE FROM catalogo WHERE nombre = :nombre"), {"nombre": nombre})
+
+# Tope de unidades por conteo, muy por debajo del máximo de INTEGER
+CANTIDAD_MAXIMA = 1_000_000
+
+COLUMNAS_REGISTRO = (
+    "id_cliente", "fecha_hora", "codigo", "producto", "clasificacion", "linea", "presentacion",
+    "cantidad_unidades", "total_kg_lt", "unidad_medida", "almacen",
+    "responsable", "observaciones"
+)
+COLUMNAS_PRODUCTO = ("codigo", "producto", "clasificacion", "linea", "presentacion", "unidad_medida")
+
+# Registros enviados como un arreglo JSON, leídos como filas con alias o
+ORIGEN_JSON = """
+    jsonb_to_recordset(CAST(:filas AS jsonb)) AS o(
+        id_cliente UUID, fecha_hora TIMESTAMP, codigo TEXT, producto TEXT, clasificacion TEXT,
+        linea TEXT, presentacion TEXT, cantidad_unidades INTEGER, total_kg_lt NUMERIC,
+        unidad_medida TEXT, almacen TEXT, responsable TEXT, observaciones TEXT
+    )
+"""
+
+def crear_registro(catalogo, producto, cantidad_unidades, almacen, responsable, observaciones="", fecha_hora=None):
+    """Arma el registro de un conteo con los datos del producto en el catálogo"""
+    datos_producto = catalogo[producto]
+    return {
+        'id_cliente': str(uuid.uuid4()),
+        'fecha_hora': fecha_hora or datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        'codigo': datos_producto["codigo"],
+        'producto': producto,
+        'clasificacion': datos_producto.get("clasificacion", ""),
+        'linea': datos_producto.get("linea", ""),
+        'presentacion': datos_producto["presentacion"],
+        'cantidad_unidades': int(cantidad_unidades),
+        'total_kg_lt': cantidad_unidades * datos_producto.get("factor", 1),
+        'unidad_medida': datos_producto.get("unidad", "kg"),
+        'almacen': almacen,
+        'responsable': responsable,
+        'observaciones': observaciones
+    }
+
+def integrar_conteos(conn, origen, params=None, condicion="TRUE", devolver_ids=False):
+    """Inserta en conteos las filas de origen, agregando antes las dimensiones que falten
+
+    origen es una expresión FROM con alias o que expone las columnas de
+    COLUMNAS_REGISTRO (una tabla o ORIGEN_JSON); condicion filtra las filas.
+    Las dimensiones se insertan en sentencias previas para que el INSERT
+    final las vea, y solo las que faltan, para no consumir la secuencia en
+    cada guardado. Los id_cliente ya guardados se omiten. Devuelve los
+    id_cliente insertados si devolver_ids, si no la cantidad de filas.
+    """
+    params = params or {}
+    columnas_producto = ", ".join(COLUMNAS_PRODUCTO)
+    columnas_dimension = ", ".join(f"p.{c}" for c in COLUMNAS_PRODUCTO)
+    producto = ", ".join(f"COALESCE(o.{c}, '')" for c in COLUMNAS_PRODUCTO)
+    conn.execute(text(f"""
+        INSERT INTO dim_producto ({columnas_producto})
+        SELECT DISTINCT {producto} FROM {origen}
+        WHERE NOT EXISTS (
+            SELECT 1 FROM dim_producto p WHERE ({columnas_dimension}) = ({producto})
+        )
+        ON CONFLICT DO NOTHING
+    """), params)
+    for dimension, columna in (("dim_almacen", "almacen"), ("dim_responsable", "responsable")):
+        conn.execute(text(f"""
+            INSERT INTO {dimension} ({columna})
+            SELECT DISTINCT o.{columna} FROM {origen}
+            WHERE o.{columna} IS NOT NULL
+              AND NOT EXISTS (SELECT 1 FROM {dimension} d WHERE d.{columna} = o.{columna})
+            ON CONFLICT DO NOTHING
+        """), params)
+    
+    resultado = conn.execute(text(f"""
+        INSERT INTO conteos (
+            id_cliente, fecha_hora, producto_id, almacen_id, responsable_id,
+            cantidad_unidades, total_kg_lt, observaciones
+        )
+        SELECT o.id_cliente, o.fecha_hora, p.id, a.id, r.id,
+               o.cantidad_unidades, o.total_kg_lt, o.observaciones
+        FROM {origen}
+        JOIN dim_producto p ON ({columnas_dimension}) = ({producto})
+        LEFT JOIN dim_almacen a ON a.almacen = o.almacen
+        LEFT JOIN dim_responsable r ON r.responsable = o.responsable
+        WHERE {condicion}
+        ON CONFLICT (id_cliente, fecha_hora) DO NOTHING
+        {"RETURNING id_cliente" if devolver_ids else ""}
+    """), params)
+    if devolver_ids:
+        return [str(id_cliente) for id_cliente in resultado.scalars()]
+    return resultado.rowcount
+
+def guardar_registros(registros):
+    """Guarda varios registros en PostgreSQL en una sola transacción
+
+    Los registros viajan como un único arreglo JSON, así que un lote completo
+    cuesta una sola sentencia de inserción. Los registros cuyo id_cliente ya
+    está guardado se omiten, lo que hace seguro reintentar un lote.
+    Devuelve los id_cliente efectivamente insertados.
+    """
+    if not registros:
+        return []
+    filas = json.dumps([{c: registro[c] for c in COLUMNAS_REGISTRO} for registro in registros], default=str)
+    with engine.begin() as conn:
+        return integrar_conteos(conn, ORIGEN_JSON, {"filas": filas}, devolver_ids=True)
+
+def guardar_registro(datos):
+    """Guarda un registro en PostgreSQL"""
+    guardar_registros([datos])
+
+# --- DIARIO LOCAL DE CONTEOS ---
+# Cada conteo se agrega primero a un diario SQLite local y luego se sincroniza
+# con PostgreSQL. Si la conexión se cae, los conteos esperan en el diario.
+DIARIO_RETENCION_DIAS = 7  # días que se conservan los conteos ya sincronizados
+
+def _conectar_diario():
+    """Abre una conexión al diario local"""
+    conn = sqlite3.connect(DIARIO_PATH, timeout=30)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=FULL")
+    return conn
+
+@st.cache_resource
+def init_diario():
+    """Crea las tablas del diario local si no existen (una vez por proceso)"""
+    with closing(_conectar_diario()) as conn, conn:
+        conn.executescript("""
+            CREATE TABLE IF NOT EXISTS diario (
+                id_cliente TEXT PRIMARY KEY,
+                creado_en TEXT NOT NULL,
+                datos TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS sincronizados (
+                id_cliente TEXT PRIMARY KEY,
+                sincronizado_en TEXT NOT NULL,
+                resultado TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS catalogo_local (
+                id INTEGER PRIMARY KEY CHECK (id = 1),
+                version INTEGER NOT NULL,
+                datos TEXT NOT NULL
+            );
+        """)
+
+def diario_guardar_catalogo(version, catalogo):
+    """Guarda una copia local del catálogo para poder registrar conteos sin conexión"""
+    init_diario()
+    with closing(_conectar_diario()) as conn, conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO catalogo_local (id, version, datos) VALUES (1, ?, ?)",
+            (version, json.dumps(catalogo))
+        )
+
+def diario_leer_catalogo():
+    """Devuelve la última copia local del catálogo, o None si no hay"""
+    init_diario()
+    with closing(_conectar_diario()) as conn:
+        fila = conn.execute("SELECT datos FROM catalogo_local WHERE id = 1").fetchone()
+    return json.loads(fila[0]) if fila else None
+
+def diario_agregar(registros):
+    """Agrega registros al diario local; al volver de aquí ya son durables"""
+    init_diario()
+    ahora = datetime.now().isoformat(timespec="seconds")
+    with closing(_conectar_diario()) as conn, conn:
+        conn.executemany(
+            "INSERT OR IGNORE INTO diario (id_cliente, creado_en, datos) VALUES (?, ?, ?)",
+            [(r["id_cliente"], ahora, json.dumps(r, default=str)) for r in registros]
+        )
+
+def diario_pendientes(limite=None):
+    """Devuelve los registros del diario que todavía no se sincronizaron, en orden de llegada"""
+    init_diario()
+    with closing(_conectar_diario()) as conn:
+        filas = conn.execute("""
+            SELECT d.datos FROM diario d
+            LEFT JOIN sincronizados s ON s.id_cliente = d.id_cliente
+            WHERE s.id_cliente IS NULL
+            ORDER BY d.rowid
+            LIMIT ?
+        """, (limite if limite is not None else -1,)).fetchall()
+    return [json.loads(fila[0]) for fila in filas]
+
+def diario_marcar(resultados):
+    """Registra el resultado de sincronización de cada id_cliente"""
+    ahora = datetime.now().isoformat(timespec="seconds")
+    with closing(_conectar_diario()) as conn, conn:
+        conn.executemany(
+            "INSERT OR REPLACE INTO sincronizados (id_cliente, sincronizado_en, resultado) VALUES (?, ?, ?)",
+            [(id_cliente, ahora, resultado) for id_cliente, resultado in resultados.items()]
+        )
+
+def diario_estados(ids_cliente):
+    """Devuelve el estado de sincronización de varios id_cliente"""
+    init_diario()
+    marcadores = ", ".join("?" for _ in ids_cliente)
+    with closing(_conectar_diario()) as conn:
+        filas = conn.execute(
+            f"SELECT id_cliente, resultado FROM sincronizados WHERE id_cliente IN ({marcadores})",
+            list(ids_cliente)
+        ).fetchall()
+    resultados = dict(filas)
+    return {id_cliente: resultados.get(id_cliente, "en cola") for id_cliente in ids_cliente}
+
+def diario_contar_pendientes():
+    """Cuenta los conteos del diario que esperan sincronización"""
+    init_diario()
+    with closing(_conectar_diario()) as conn:
+        return conn.execute("""
+            SELECT count(*) FROM diario d
+            LEFT JOIN sincronizados s ON s.id_cliente = d.id_cliente
+            WHERE s.id_cliente IS NULL
+        """).fetchone()[0]
+
+def diario_compactar():
+    """Elimina del diario los conteos sincronizados hace más de DIARIO_RETENCION_DIAS"""
+    limite = (datetime.now() - timedelta(days=DIARIO_RETENCION_DIAS)).isoformat(timespec="seconds")
+    with closing(_conectar_diario()) as conn, conn:
+        conn.execute("""
+            DELETE FROM diario WHERE id_cliente IN (
+                SELECT id_cliente FROM sincronizados WHERE sincronizado_en < ?
+            )
+        """, (limite,))
+        conn.execute("DELETE FROM sincronizados WHERE sincronizado_en < ?", (limite,))
+
+# --- ESCRITURA ASÍNCRONA ---
+# Un hilo por proceso sincroniza el diario con PostgreSQL en lotes, así la
+# sesión no espera a la base de datos. Una cola acotada solo le avisa que hay
+# conteos nuevos; si está llena, el conteo igual queda en el diario.
+COLA_MAX = 1000          # avisos en espera
+LOTE_MAX_FILAS = 200     # un lote se guarda al llegar a este tamaño...
+LOTE_MAX_MS = 500        # ...o al pasar este tiempo desde el primer aviso
+SYNC_INTERVALO = 15      # segundos entre reintentos sin avisos nuevos
+ENVIOS_VISIBLES = 5      # últimos envíos de cada sesión con su estado en pantalla
+
+EscritorAsincrono = namedtuple("EscritorAsincrono", ["cola", "estado", "hilo"])
+
+def sincronizar_diario(estado):
+    """Envía a PostgreSQL los conteos pendientes del diario, por lotes
+
+    Los conflictos se detectan por id_cliente: un conteo que ya estaba en la
+    base de datos queda marcado como duplicado y no se vuelve a insertar. Solo
+    se marcan como fallidos los conteos que PostgreSQL rechaza por sus datos;
+    cualquier otro error (conexión, failover de solo lectura, migración
+    pendiente) deja los pendientes para el próximo intento.
+    """
+    while True:
+        lote = diario_pendientes(LOTE_MAX_FILAS)
+        if not lote:
+            estado["ultimo_error"] = None
+            return
+        try:
+            _sincronizar_lote(lote, estado)
+        except (OperationalError, InterfaceError) as e:
+            estado["ultimo_error"] = f"Sin conexión con la base de datos: {e.orig or e}"
+            return
+        except Exception as e:
+            estado["ultimo_error"] = str(e)
+            return
+        estado["ultima_sincronizacion"] = datetime.now()
+
+def _sincronizar_lote(lote, estado):
+    """Guarda un lote del diario y marca su resultado
+
+    Si PostgreSQL rechaza algún dato, el lote se divide en mitades hasta
+    aislar las filas inválidas, que son las únicas marcadas como fallidas.
+    """
+    try:
+        insertados = set(guardar_registros(lote))
+    except (DataError, IntegrityError) as e:
+        if len(lote) == 1:
+            estado["ultimo_error"] = str(e.orig or e)
+            diario_marcar({lote[0]["id_cliente"]: f"error: {e.orig or e}"})
+            return
+        mitad = len(lote) // 2
+        _sincronizar_lote(lote[:mitad], estado)
+        _sincronizar_lote(lote[mitad:], estado)
+        return
+    diario_marcar({
+        r["id_cliente"]: "guardado" if r["id_cliente"] in insertados else "duplicado"
+        for r in lote
+    })
+
+def _bucle_escritor(cola, estado):
+    """Espera avisos de conteos nuevos, agrupa los que llegan juntos y sincroniza el diario"""
+    while True:
+        try:
+            cola.get(timeout=SYNC_INTERVALO)
+        except queue.Empty:
+            pass
+        else:
+            limite = time.monotonic() + LOTE_MAX_MS / 1000
+            while cola.qsize() < LOTE_MAX_FILAS and time.monotonic() < limite:
+                time.sleep(0.05)
+            while not cola.empty():
+                cola.get_nowait()
+        try:
+            sincronizar_diario(estado)
+            diario_compactar()
+        except Exception as e:
+            estado["ultimo_error"] = str(e)
+
+@st.cache_resource
+def iniciar_escritor():
+    """Inicia el hilo escritor del proceso, compartido por todas las sesiones"""
+    init_diario()
+    cola = queue.Queue(maxsize=COLA_MAX)
+    estado = {"ultimo_error": None, "ultima_sincronizacion": None}
+    hilo = threading.Thread(target=_bucle_escritor, args=(cola, estado), name="escritor-inventario", daemon=True)
+    hilo.start()
+    return EscritorAsincrono(cola, estado, hilo)
+
+def encolar_registros(registros):
+    """Guarda los registros validados en el diario y avisa al escritor"""
+    diario_agregar(registros)
+    escritor = iniciar_escritor()
+    for _ in registros:
+        try:
+            escritor.cola.put_nowait(True)
+        except queue.Full:
+            break
+
+def encolar_registro(datos):
+    """Guarda un registro validado en el diario y avisa al escritor"""
+    encolar_registros([datos])
+
+def validar_lote(lote, catalogo, almacen, responsable, observaciones=""):
+    """Valida las filas de un lote contra el catálogo
+
+    Devuelve los registros listos para guardar y la lista de errores por fila.
+    Las filas completamente vacías se ignoran.
+    """
+    registros = []
+    errores = []
+    fecha_hora = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    for n, fila in enumerate(lote.itertuples(index=False), start=1):
+        if pd.isna(fila.producto) and pd.isna(fila.cantidad_unidades):
+            continue
+        if fila.producto not in catalogo:
+            errores.append(f"Fila {n}: el producto '{fila.producto}' no está en el catálogo")
+        elif pd.isna(fila.cantidad_unidades) or fila.cantidad_unidades <= 0:
+            errores.append(f"Fila {n}: la cantidad debe ser mayor a 0")
+        elif fila.cantidad_unidades > CANTIDAD_MAXIMA:
+            errores.append(f"Fila {n}: la cantidad no puede superar {CANTIDAD_MAXIMA:,} unidades")
+        else:
+            registros.append(crear_registro(
+                catalogo, fila.producto, fila.cantidad_unidades, almacen, responsable, observaciones, fecha_hora
+            ))
+    return registros, errores
+
+# --- IMPORTACIÓN DE PLANILLAS ---
+COLUMNAS_IMPORTACION = ("codigo", "cantidad", "almacen", "responsable")
+
+def leer_planilla(archivo):
+    """Lee una planilla de conteo CSV o XLSX y normaliza los nombres de columna"""
+    if archivo.name.lower().endswith(".xlsx"):
+        planilla = pd.read_excel(archivo, dtype=str)
+    else:
+        planilla = pd.read_csv(archivo, dtype=str, sep=None, engine="python")
+    planilla.columns = [
+        str(col).strip().lower().replace("é", "e").replace(" ", "_")
+        for col in planilla.columns
+    ]
+    return planilla
+
+def preparar_importacion(planilla, indice):
+    """Resuelve los códigos contra el catálogo y calcula los totales
+
+    Todo el proceso es vectorizado: los códigos se buscan con un join contra
+    el catálogo indexado por código. Devuelve los registros aceptados (con
+    las columnas de inventario) y los rechazados con su número de fila y motivo.
+    """
+    faltantes = [col for col in COLUMNAS_IMPORTACION if col not in planilla.columns]
+    if faltantes:
+        raise ValueError(f"Faltan columnas en la planilla: {', '.join(faltantes)}")
+    
+    df = pd.DataFrame({
+        col: planilla[col].fillna("").astype(str).str.strip() for col in COLUMNAS_IMPORTACION
+    })
+    df["fila"] = np.arange(2, len(df) + 2)  # fila 1 = encabezado
+    df["cantidad_unidades"] = pd.to_numeric(df["cantidad"], errors="coerce")
+    df["observaciones"] = planilla["observaciones"].fillna("").astype(str) if "observaciones" in planilla.columns else ""
+    ahora = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    if "fecha_hora" in planilla.columns:
+        fechas = pd.to_datetime(planilla["fecha_hora"], errors="coerce", dayfirst=True)
+        df["fecha_invalida"] = fechas.isna() & planilla["fecha_hora"].notna()
+        df["fecha_hora"] = fechas.dt.strftime("%Y-%m-%d %H:%M:%S").fillna(ahora)
+    else:
+        df["fecha_invalida"] = False
+        df["fecha_hora"] = ahora
+    
+    catalogo = indice.tabla
+    catalogo = catalogo.rename_axis("producto").reset_index().drop_duplicates("codigo").set_index("codigo")
+    df = df.join(catalogo[["producto", "clasificacion", "linea", "presentacion", "factor", "unidad"]], on="codigo")
+    
+    df["motivo"] = np.select(
+        [
+            df["producto"].isna(),
+            df["cantidad_unidades"].isna() | (df["cantidad_unidades"] <= 0) | (df["cantidad_unidades"] % 1 != 0)
+            | (df["cantidad_unidades"] > CANTIDAD_MAXIMA),
+            ~df["almacen"].isin(ALMACENES),
+            df["responsable"] == "",
+            df["fecha_invalida"],
+        ],
+        [
+            "Código no encontrado en el catálogo",
+            "Cantidad inválida",
+            "Almacén desconocido",
+            "Falta el responsable",
+            "Fecha inválida",
+        ],
+        default=""
+    )
+    rechazados = df.loc[df["motivo"] != "", ["fila", *COLUMNAS_IMPORTACION, "motivo"]]
+    
+    aceptados = df[df["motivo"] == ""].copy()
+    aceptados["cantidad_unidades"] = aceptados["cantidad_unidades"].astype(int)
+    aceptados["total_kg_lt"] = aceptados["cantidad_unidades"] * aceptados["factor"].astype(float)
+    aceptados["unidad_medida"] = aceptados["unidad"]
+    aceptados["id_cliente"] = [str(uuid.uuid4()) for _ in range(len(aceptados))]
+    return aceptados[list(COLUMNAS_REGISTRO)], rechazados
+
+def importar_registros(aceptados):
+    """Carga los registros con COPY FROM STDIN a una tabla temporal y los integra al inventario
+
+    Las filas idénticas a un conteo ya registrado (mismo código, almacén, fecha,
+    cantidad y responsable) no se vuelven a insertar. Devuelve cuántas filas se insertaron.
+    """
+    buffer = io.StringIO()
+    aceptados.to_csv(buffer, index=False, header=False)
+    buffer.seek(0)
+    columnas = ", ".join(COLUMNAS_REGISTRO)
+    
+    with engine.begin() as conn:
+        sin_timeout(conn)
+        conn.execute(text(f"""
+            CREATE TEMP TABLE inventario_staging ON COMMIT DROP AS
+            SELECT {columnas} FROM inventario WITH NO DATA
+        """))
+        cursor = conn.connection.cursor()
+        cursor.copy_expert(f"COPY inventario_staging ({columnas}) FROM STDIN WITH (FORMAT csv)", buffer)
+        # Las planillas pueden traer fechas de meses sin partición
+        conn.execute(text("""
+            SELECT asegurar_particiones_inventario(MIN(fecha_hora)::date, MAX(fecha_hora)::date)
+            FROM inventario_staging
+        """))
+        return integrar_conteos(conn, "inventario_staging o", condicion="""
+            NOT EXISTS (
+                SELECT 1 FROM inventario i
+                WHERE i.codigo = o.codigo
+                  AND i.almacen = o.almacen
+                  AND i.fecha_hora = o.fecha_hora
+                  AND i.cantidad_unidades = o.cantidad_unidades
+                  AND i.responsable = o.responsable
+            )
+        """)
+
+# --- CACHÉ DE CONSULTAS ---
+# Las consultas de lectura se cachean por (versión de datos, filtros). La
+# versión la incrementa un trigger en cada escritura, así que un guardado o
+# una eliminación en cualquier sesión o réplica invalida las entradas.
+CACHE_TTL = 300
+
+def version_datos(nombre="inventario"):
+    """Devuelve la versión actual de los datos registrada en la base de datos"""
+    with engine.connect() as conn:
+        return conn.execute(
+            text("SELECT version FROM versiones WHERE nombre = :nombre"),
+            {"nombre": nombre}
+        ).scalar()
+
+@st.cache_data(ttl=CACHE_TTL, max_entries=4, show_spinner=False)
+def hay_registros(version):
+    """Indica si el inventario tiene al menos un registro"""
+    with engine.connect() as conn:
+        return conn.execute(text("SELECT EXISTS (SELECT 1 FROM inventario)")).scalar()
+
+# --- CONSULTAS DEL HISTORIAL ---
+HISTORIAL_PAGINA = 50
+HISTORIAL_DIAS = 30  # rango de fechas inicial del historial
+
+FiltrosHistorial = namedtuple(
+    "FiltrosHistorial",
+    ["almacenes", "clasificaciones", "lineas", "busqueda", "desde", "hasta"],
+    defaults=((), (), (), "", None, None)
+)
+
+# Las columnas de texto repiten unas pocas decenas de valores (catálogo,
+# almacenes, responsables): como category cada fila guarda solo un código.
+# Las unidades se leen en 32 bits; los totales en kg/lt quedan en float64,
+# porque float32 solo conserva unas 7 cifras significativas.
+TIPOS_HISTORIAL = {
+    "codigo": "category",
+    "producto": "category",
+    "clasificacion": "category",
+    "linea": "category",
+    "presentacion": "category",
+    "unidad_medida": "category",
+    "almacen": "category",
+    "responsable": "category",
+    "estado": "category",
+    "cantidad_unidades": "Int32",
+    "total_kg_lt": "float64",
+}
+
+def _where_historial(filtros):
+    """Traduce los filtros del historial a condiciones SQL parametrizadas"""
+    condiciones = []
+    params = {}
+    for columna, valores in (
+        ("almacen", filtros.almacenes),
+        ("clasificacion", filtros.clasificaciones),
+        ("linea", filtros.lineas),
+    ):
+        if valores:
+            condiciones.append(f"{columna} = ANY(:{columna})")
+            params[columna] = list(valores)
+    # El rango de fechas permite a PostgreSQL descartar particiones enteras
+    if filtros.desde is not None:
+        condiciones.append("fecha_hora >= :desde")
+        params["desde"] = datetime.combine(filtros.desde, datetime.min.time())
+    if filtros.hasta is not None:
+        condiciones.append("fecha_hora < :hasta")
+        params["hasta"] = datetime.combine(filtros.hasta + timedelta(days=1), datetime.min.time())
+    if filtros.busqueda:
+        busqueda = filtros.busqueda.strip()
+        if busqueda.isdigit():
+            condiciones.append("id = :busqueda_id")
+            params["busqueda_id"] = int(busqueda)
+        else:
+            condiciones.append("(producto ILIKE :busqueda OR codigo ILIKE :busqueda OR responsable ILIKE :busqueda)")
+            params["busqueda"] = f"%{busqueda}%"
+    return condiciones, params
+
+def _clave_pagina(df):
+    """Devuelve el cursor (fecha_hora, id) de la última fila de una página"""
+    ultima = df.iloc[-1]
+    return (ultima["fecha_hora"].to_pydatetime(), int(ultima["id"]))
+
+def _leer_historial(filtros, cursor=None, limite=HISTORIAL_PAGINA):
+    """Lee de la base una página del historial (ver obtener_historial)"""
+    condiciones, params = _where_historial(filtros)
+    if cursor is not None:
+        condiciones.append("(fecha_hora, id) < (:cursor_fecha, :cursor_id)")
+        params["cursor_fecha"], params["cursor_id"] = cursor
+    where = f"WHERE {' AND '.join(condiciones)}" if condiciones else ""
+    params["limite"] = limite + 1
+    query = text(f"""
+        SELECT * FROM inventario
+        {where}
+        ORDER BY fecha_hora DESC, id DESC
+        LIMIT :limite
+    """)
+    
+    with engine.connect() as conn:
+        df = pd.read_sql(query, conn, params=params, dtype=TIPOS_HISTORIAL)
+    
+    siguiente = None
+    if len(df) > limite:
+        df = df.iloc[:limite]
+        siguiente = _clave_pagina(df)
+    return df, siguiente
+
+@st.cache_data(ttl=CACHE_TTL, max_entries=256, show_spinner=False)
+def obtener_historial(version, filtros, cursor=None, limite=HISTORIAL_PAGINA):
+    """Obtiene una página del historial paginada por (fecha_hora, id)
+
+    Devuelve el DataFrame de la página y el cursor de la página siguiente,
+    o None si no hay más registros.
+    """
+    return _leer_historial(filtros, cursor, limite)
+
+# --- REFRESCO INCREMENTAL DEL HISTORIAL ---
+# La sesión conserva su primera página junto con el snapshot de PostgreSQL con
+# el que la leyó. Después de una escritura solo pide al registro de cambios
+# lo que ese snapshot no veía y lo combina con la página que ya tiene.
+CAMBIOS_RETENCION_HORAS = 24  # antigüedad máxima del registro de cambios
+CAMBIOS_MAXIMOS = 1000        # con más cambios pendientes conviene releer la página
+
+HistorialSesion = namedtuple(
+    "HistorialSesion", ["filtros", "df", "siguiente", "snapshot", "version", "leido_en"]
+)
+
+def _snapshot_actual(conn):
+    """Devuelve el snapshot actual de PostgreSQL como texto"""
+    return conn.execute(text("SELECT pg_current_snapshot()::text")).scalar()
+
+def _cargar_historial_sesion(filtros, version, limite):
+    """Lee la primera página completa y el snapshot desde el que seguir los cambios
+
+    El snapshot se toma antes de leer la página: una fila que entre en medio
+    se vuelve a pedir como cambio y se descarta por id al combinar.
+    """
+    with engine.connect() as conn:
+        snapshot = _snapshot_actual(conn)
+    df, siguiente = _leer_historial(filtros, None, limite)
+    return HistorialSesion(filtros, df, siguiente, snapshot, version, datetime.now())
+
+def refrescar_historial(estado, filtros, version, limite=HISTORIAL_PAGINA):
+    """Devuelve la primera página del historial de la sesión, al día con la versión dada
+
+    Si la sesión ya tiene la página para estos filtros, lee solo los ids
+    cambiados desde su snapshot: quita los borrados, vuelve a leer los
+    insertados o modificados que cumplen los filtros y reordena. El costo es
+    proporcional a los cambios, no al tamaño del historial. Relee la página
+    completa si cambiaron los filtros, si el snapshot es más viejo que el
+    registro de cambios, si hubo demasiados cambios o si un borrado dejó la
+    página incompleta.
+    """
+    if (estado is None or estado.filtros != filtros or estado.df.empty
+            or datetime.now() - estado.leido_en > timedelta(hours=CAMBIOS_RETENCION_HORAS / 2)):
+        return _cargar_historial_sesion(filtros, version, limite)
+    if estado.version == version:
+        return estado
+    
+    with engine.connect() as conn:
+        snapshot = _snapshot_actual(conn)
+        cambios = conn.execute(text("""
+            SELECT operacion, id FROM cambios_inventario
+            WHERE xid >= pg_snapshot_xmin(CAST(:snapshot AS pg_snapshot))
+              AND NOT pg_visible_in_snapshot(xid, CAST(:snapshot AS pg_snapshot))
+            LIMIT :maximo
+        """), {"snapshot": estado.snapshot, "maximo": CAMBIOS_MAXIMOS + 1}).all()
+        if len(cambios) > CAMBIOS_MAXIMOS or any(operacion == "T" for operacion, _ in cambios):
+            return _cargar_historial_sesion(filtros, version, limite)
+        
+        ids_leer = list({id_registro for operacion, id_registro in cambios if operacion != "D"})
+        nuevos = None
+        if ids_leer:
+            condiciones, params = _where_historial(filtros)
+            condiciones.append("id = ANY(:ids)")
+            params["ids"] = ids_leer
+            nuevos = pd.read_sql(
+                text(f"SELECT * FROM inventario WHERE {' AND '.join(condiciones)}"),
+                conn, params=params, dtype=TIPOS_HISTORIAL
+            )
+    
+    cambiados = {id_registro for _, id_registro in cambios}
+    df = estado.df[~estado.df["id"].isin(cambiados)]
+    if nuevos is not None and not nuevos.empty:
+        df = pd.concat([df, nuevos], ignore_index=True)
+    df = df.sort_values(["fecha_hora", "id"], ascending=False, ignore_index=True)
+    
+    siguiente = estado.siguiente
+    if len(df) > limite:
+        df = df.iloc[:limite]
+        siguiente = _clave_pagina(df)
+    elif siguiente is not None:
+        if len(df) < limite:
+            # Un borrado dejó lugar para filas que esta página no tiene
+            return _cargar_historial_sesion(filtros, version, limite)
+        siguiente = _clave_pagina(df)
+    # concat de categóricas con categorías distintas vuelve a object
+    df = df.astype({c: t for c, t in TIPOS_HISTORIAL.items() if c in df.columns})
+    return HistorialSesion(filtros, df, siguiente, snapshot, version, datetime.now())
+
+def eliminar_registros(ids_registros):
+    """Elimina varios registros de la base de datos por ID en una sola sentencia
+
+    Devuelve la cantidad de registros eliminados.
+    """
+    with engine.begin() as conn:
+        resultado = conn.execute(
+            text("DELETE FROM conteos WHERE id = ANY(:ids)"),
+            {"ids": [int(id_registro) for id_registro in ids_registros]}
+        )
+        return resultado.rowcount
+
+def eliminar_registro(id_registro):
+    """Elimina un registro de la base de datos por ID"""
+    return eliminar_registros([id_registro])
+
+@st.cache_data(ttl=CACHE_TTL, max_entries=32, show_spinner=False)
+def obtener_stock_actual(version, almacen):
+    """Obtiene el último conteo, el anterior y la diferencia por producto de un almacén"""
+    query = text("""
+        SELECT codigo, producto, linea, ultima_fecha, ultimo_conteo, ultimo_total,
+               fecha_anterior, conteo_anterior, total_anterior,
+               delta_unidades, delta_total, unidad_medida
+        FROM stock_actual
+        WHERE almacen = :almacen
+        ORDER BY linea, producto
+    """)
+    with engine.connect() as conn:
+        return pd.read_sql(query, conn, params={"almacen": almacen})
+
+# --- PLAN DE CONTEO CÍCLICO (ABC) ---
+CORTES_ABC = (0.80, 0.95)                   # participación acumulada que cierra las clases A y B
+FRECUENCIA_CONTEO = {"A": 7, "B": 30, "C": 90}  # días entre conteos por clase
+PLAN_DIARIO = 40                             # productos por almacén y día
+
+def clasificar_abc(volumenes):
+    """Clasifica en A, B o C según la participación acumulada en el volumen total
+
+    Un producto entra en una clase si la participación acumulada de los
+    productos más grandes que él todavía no alcanza el corte de esa clase.
+    """
+    orden = volumenes.sort_values(ascending=False)
+    total = orden.sum()
+    if total <= 0:
+        return pd.Series("C", index=volumenes.index)
+    previo = (orden.cumsum() - orden) / total
+    clases = np.select([previo < CORTES_ABC[0], previo < CORTES_ABC[1]], ["A", "B"], default="C")
+    return pd.Series(clases, index=orden.index).reindex(volumenes.index)
+
+def armar_plan(stock, fecha, almacen):
+    """Elige los productos del plan a partir de sus candidatos
+
+    stock tiene una fila por producto con codigo, producto, ultima_fecha
+    (nula si nunca se contó en el almacén) y volumen. Clasifica en ABC por
+    volumen y elige con una cola de prioridad los más atrasados respecto de
+    la frecuencia de su clase; un producto nunca contado es el más atrasado.
+    Devuelve las filas de plan_conteo en orden de prioridad.
+    """
+    plan = []
+    if stock.empty:
+        return plan
+    stock = stock.copy()
+    # Si ningún producto se contó en el almacén la columna llega sin tipo fecha
+    stock["ultima_fecha"] = pd.to_datetime(stock["ultima_fecha"])
+    stock["clase"] = clasificar_abc(stock["volumen"].astype(float))
+    inicio_dia = datetime.combine(fecha, datetime.min.time())
+    dias_sin_contar = (inicio_dia - stock["ultima_fecha"]).dt.total_seconds() / 86400
+    # Sin conteos en el almacén: atraso infinito, va antes que cualquier otro
+    stock["dias_atraso"] = (dias_sin_contar - stock["clase"].map(FRECUENCIA_CONTEO)).fillna(np.inf)
+    
+    # Mayor atraso primero; a igual atraso, la clase más importante
+    cola = [
+        (-fila.dias_atraso, fila.clase, fila.codigo, fila)
+        for fila in stock[stock["dias_atraso"] >= 0].itertuples(index=False)
+    ]
+    heapq.heapify(cola)
+    while cola and len(plan) < PLAN_DIARIO:
+        fila = heapq.heappop(cola)[3]
+        nunca_contado = pd.isna(fila.ultima_fecha)
+        plan.append({
+            "fecha": fecha,
+            "almacen": almacen,
+            "posicion": len(plan) + 1,
+            "codigo": fila.codigo,
+            "producto": fila.producto,
+            "clase": fila.clase,
+            "ultima_fecha": None if nunca_contado else fila.ultima_fecha.to_pydatetime(),
+            "dias_atraso": None if nunca_contado else round(float(fila.dias_atraso), 1),
+        })
+    return plan
+
+def generar_plan(fecha, almacen):
+    """Genera y guarda el plan de conteo de un almacén para una fecha
+
+    Los candidatos son todos los productos del catálogo. De stock_actual y
+    volumen_conteos (por su clave primaria, sin recorrer el historial) toma el
+    último conteo y el volumen promedio por conteo, y armar_plan elige los
+    productos. Se usa el promedio y no la suma: la suma crece con cada
+    conteo y dejaría fijos en la clase A a los productos que más se cuentan. Devuelve la cantidad de productos del plan.
+    """
+    with engine.begin() as conn:
+        # Evita que dos sesiones generen el mismo plan a la vez
+        conn.execute(text("SELECT pg_advisory_xact_lock(hashtext(:clave))"), {"clave": f"plan|{almacen}"})
+        generado = conn.execute(
+            text("SELECT 1 FROM plan_conteo_generado WHERE fecha = :fecha AND almacen = :almacen"),
+            {"fecha": fecha, "almacen": almacen}
+        ).first()
+        if generado:
+            return None
+        
+        stock = pd.read_sql(text("""
+            SELECT c.codigo, c.nombre AS producto, s.ultima_fecha,
+                   COALESCE(v.volumen / NULLIF(v.conteos, 0), 0) AS volumen
+            FROM catalogo c
+            LEFT JOIN stock_actual s ON s.almacen = :almacen AND s.codigo = c.codigo
+            LEFT JOIN volumen_conteos v ON v.almacen = :almacen AND v.codigo = c.codigo
+        """), conn, params={"almacen": almacen}, parse_dates=["ultima_fecha"])
+        
+        plan = armar_plan(stock, fecha, almacen)
+        if plan:
+            conn.execute(text("""
+                INSERT INTO plan_conteo
+                (fecha, almacen, posicion, codigo, producto, clase, ultima_fecha, dias_atraso)
+                VALUES
+                (:fecha, :almacen, :posicion, :codigo, :producto, :clase, :ultima_fecha, :dias_atraso)
+            """), plan)
+        conn.execute(
+            text("INSERT INTO plan_conteo_generado (fecha, almacen) VALUES (:fecha, :almacen)"),
+            {"fecha": fecha, "almacen": almacen}
+        )
+        return len(plan)
+
+@st.cache_data(ttl=CACHE_TTL, max_entries=32, show_spinner=False)
+def obtener_plan(version, fecha, almacen):
+    """Obtiene el plan de conteo del día, generándolo si todavía no existe
+
+    Un producto figura como contado si su último conteo en stock_actual es
+    de la fecha del plan o posterior.
+    """
+    generar_plan(fecha, almacen)
+    query = text("""
+        SELECT p.posicion, p.codigo, p.producto, p.clase, p.ultima_fecha, p.dias_atraso,
+               COALESCE(s.ultima_fecha >= p.fecha, FALSE) AS contado
+        FROM plan_conteo p
+        LEFT JOIN stock_actual s ON s.almacen = p.almacen AND s.codigo = p.codigo
+        WHERE p.fecha = :fecha AND p.almacen = :almacen
+        ORDER BY p.posicion
+    """)
+    with engine.connect() as conn:
+        return pd.read_sql(query, conn, params={"fecha": fecha, "almacen": almacen})
+
+# --- VARIANZAS ENTRE CONTEOS ---
+VARIANZA_PCT_UMBRAL = 20    # variación porcentual a partir de la cual un conteo es atípico
+VARIANZA_ABS_UMBRAL = 500   # y variación absoluta mínima en kg o lt
+VARIANZAS_LOTE = 500        # claves recalculadas por transacción
+VARIANZAS_LIMITE = 200      # filas mostradas en el tablero
+
+def actualizar_varianzas():
+    """Recalcula las varianzas de las claves con conteos nuevos o eliminados
+
+    Solo procesa las claves (almacén, código) marcadas como pendientes por el
+    trigger de inventario: para cada una compara cada conteo con el anterior
+    usando LAG() sobre su historial. Devuelve la cantidad de claves procesadas.
+    """
+    procesadas = 0
+    while True:
+        with engine.begin() as conn:
+            claves = conn.execute(text("""
+                DELETE FROM varianzas_pendientes
+                WHERE (almacen, codigo) IN (
+                    SELECT almacen, codigo FROM varianzas_pendientes
+                    LIMIT :lote FOR UPDATE SKIP LOCKED
+                )
+                RETURNING almacen, codigo
+            """), {"lote": VARIANZAS_LOTE}).all()
+            if not claves:
+                return procesadas
+            params = {
+                "almacenes": [clave.almacen for clave in claves],
+                "codigos": [clave.codigo for clave in claves],
+                "pct": VARIANZA_PCT_UMBRAL,
+                "abs": VARIANZA_ABS_UMBRAL,
+            }
+            conn.execute(text("""
+                DELETE FROM varianzas v
+                USING unnest(CAST(:almacenes AS text[]), CAST(:codigos AS text[])) AS k(almacen, codigo)
+                WHERE v.almacen = k.almacen AND v.codigo = k.codigo
+            """), params)
+            conn.execute(text("""
+                INSERT INTO varianzas (
+                    inventario_id, almacen, codigo, producto, unidad_medida,
+                    fecha_hora, fecha_anterior, cantidad_unidades, cantidad_anterior,
+                    total_kg_lt, total_anterior, delta_unidades, delta_total, delta_pct, es_atipico
+                )
+                SELECT
+                    id, almacen, codigo, producto, unidad_medida,
+                    fecha_hora, fecha_anterior, cantidad_unidades, cantidad_anterior,
+                    total_kg_lt, total_anterior,
+                    cantidad_unidades - cantidad_anterior,
+                    total_kg_lt - total_anterior,
+                    100 * (total_kg_lt - total_anterior) / NULLIF(total_anterior, 0),
+                    ABS(total_kg_lt - total_anterior) >= :abs
+                        AND COALESCE(ABS(100 * (total_kg_lt - total_anterior) / NULLIF(total_anterior, 0)), 100) >= :pct
+                FROM (
+                    SELECT
+                        i.id, i.almacen, i.codigo, i.producto, i.unidad_medida, i.fecha_hora,
+                        i.cantidad_unidades, i.total_kg_lt,
+                        LAG(i.fecha_hora) OVER w AS fecha_anterior,
+                        LAG(i.cantidad_unidades) OVER w AS cantidad_anterior,
+                        LAG(i.total_kg_lt) OVER w AS total_anterior
+                    FROM inventario i
+                    JOIN unnest(CAST(:almacenes AS text[]), CAST(:codigos AS text[])) AS k(almacen, codigo)
+                      ON i.almacen = k.almacen AND i.codigo = k.codigo
+                    WINDOW w AS (PARTITION BY i.almacen, i.codigo ORDER BY i.fecha_hora, i.id)
+                ) conteos
+                WHERE cantidad_anterior IS NOT NULL
+            """), params)
+            procesadas += len(claves)
+
+@st.cache_data(ttl=CACHE_TTL, max_entries=32, show_spinner=False)
+def obtener_varianzas(version, almacen=None, solo_atipicas=False):
+    """Obtiene las varianzas más recientes desde la tabla precalculada
+
+    Antes de leer procesa las claves pendientes; como el resultado se cachea
+    por versión de datos, eso solo ocurre después de una escritura.
+    """
+    actualizar_varianzas()
+    condiciones = []
+    params = {"limite": VARIANZAS_LIMITE}
+    if almacen:
+        condiciones.append("almacen = :almacen")
+        params["almacen"] = almacen
+    if solo_atipicas:
+        condiciones.append("es_atipico")
+    where = f"WHERE {' AND '.join(condiciones)}" if condiciones else ""
+    query = text(f"""
+        SELECT fecha_hora, almacen, codigo, producto, cantidad_anterior, cantidad_unidades,
+               delta_unidades, total_anterior, total_kg_lt, delta_total,
+               ROUND(delta_pct, 1) AS delta_pct, unidad_medida, es_atipico
+        FROM varianzas
+        {where}
+        ORDER BY fecha_hora DESC
+        LIMIT :limite
+    """)
+    with engine.connect() as conn:
+        return pd.read_sql(query, conn, params=params)
+
+def etiquetas_registros(df):
+    """Arma el texto de cada registro para los selectores, indexado por ID"""
+    etiquetas = (
+        "ID " + df["id"].astype(str) + " - " + df["fecha_hora"].astype(str)
+        + " | " + df["producto"].astype(str)
+        + " | " + df["cantidad_unidades"].astype(str) + " unidades"
+        + " | " + df["responsable"].astype(str)
+    )
+    return dict(zip(df["id"].astype(int), etiquetas))
+
+@st.cache_data(ttl=CACHE_TTL, max_entries=64, show_spinner=False)
+def obtener_resumen(version, filtros):
+    """Calcula en SQL las métricas del resumen y su desglose por almacén y línea
+
+    Una sola consulta con GROUPING SETS devuelve la fila de totales (nivel
+    "Total") y una fila por almacén y por línea, con los mismos filtros que
+    el historial.
+    """
+    condiciones, params = _where_historial(filtros)
+    where = f"WHERE {' AND '.join(condiciones)}" if condiciones else ""
+    query = text(f"""
+        SELECT
+            CASE
+                WHEN GROUPING(almacen) = 0 THEN 'Almacén'
+                WHEN GROUPING(linea) = 0 THEN 'Línea'
+                ELSE 'Total'
+            END AS nivel,
+            CASE WHEN GROUPING(almacen) = 0 THEN almacen ELSE linea END AS grupo,
+            COUNT(*) AS registros,
+            COALESCE(SUM(cantidad_unidades), 0) AS total_unidades,
+            COALESCE(SUM(total_kg_lt) FILTER (WHERE unidad_medida = 'kg'), 0) AS total_kg,
+            COALESCE(SUM(total_kg_lt) FILTER (WHERE unidad_medida = 'lt'), 0) AS total_lt
+        FROM inventario
+        {where}
+        GROUP BY GROUPING SETS ((), (almacen), (linea))
+        ORDER BY nivel, grupo
+    """)
+    
+    with engine.connect() as conn:
+        return pd.read_sql(query, conn, params=params)
+
+# --- EXPORTACIÓN ---
+EXPORT_BLOQUE = 5000
+EXPORT_PREFIJO = "inventario_"
+EXPORT_TEMPORAL_HORAS = 1  # los temporales de exportación más viejos se borran
+EXCEL_MAX_FILAS = 1048575  # límite de filas de una hoja, sin contar el encabezado
+
+# Columnas exportadas: id_cliente es una clave interna de reintentos (y un
+# UUID que xlsxwriter no sabe escribir)
+COLUMNAS_EXPORTACION = (
+    "id", "fecha_hora", "codigo", "producto", "clasificacion", "linea", "presentacion",
+    "cantidad_unidades", "total_kg_lt", "unidad_medida", "almacen", "responsable",
+    "observaciones", "estado"
+)
+SQL_EXPORTACION = f"SELECT {', '.join(COLUMNAS_EXPORTACION)} FROM inventario ORDER BY id"
+
+FORMATOS_EXPORTACION = {
+    "Excel (.xlsx)": (".xlsx", "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"),
+    "CSV comprimido (.csv.gz)": (".csv.gz", "application/gzip"),
+}
+
+def convertir_a_excel(ruta):
+    """Escribe el inventario completo en un .xlsx leyendo la tabla por bloques
+
+    Usa un cursor del lado del servidor y el modo constant_memory de xlsxwriter,
+    así que la memoria se mantiene estable aunque la tabla crezca.
+    """
+    workbook = xlsxwriter.Workbook(ruta, {
+        "constant_memory": True,
+        "default_date_format": "yyyy-mm-dd hh:mm:ss"
+    })
+    hoja = workbook.add_worksheet("Inventario")
+    try:
+        with engine.connect() as conn:
+            sin_timeout(conn)
+            resultado = conn.execution_options(stream_results=True, max_row_buffer=EXPORT_BLOQUE).execute(
+                text(SQL_EXPORTACION)
+            )
+            hoja.write_row(0, 0, [col.replace("_", " ").title() for col in resultado.keys()])
+            fila = 1
+            for bloque in resultado.partitions(EXPORT_BLOQUE):
+                if fila + len(bloque) > EXCEL_MAX_FILAS + 1:
+                    raise ValueError("El historial supera el límite de filas de Excel; usa la exportación CSV")
+                for registro in bloque:
+                    hoja.write_row(fila, 0, registro)
+                    fila += 1
+    finally:
+        workbook.close()
+
+def convertir_a_csv_gz(ruta):
+    """Escribe el inventario completo en un CSV comprimido usando COPY TO STDOUT"""
+    with engine.connect() as conn:
+        sin_timeout(conn)
+        cursor = conn.connection.cursor()
+        with gzip.open(ruta, "wb") as archivo:
+            cursor.copy_expert(
+                f"COPY ({SQL_EXPORTACION}) TO STDOUT WITH (FORMAT csv, HEADER)",
+                archivo
+            )
+
+def generar_exportacion(formato):
+    """Genera el archivo de exportación en un temporal y devuelve su ruta"""
+    extension, _ = FORMATOS_EXPORTACION[formato]
+    descriptor, ruta = tempfile.mkstemp(prefix=EXPORT_PREFIJO, suffix=extension)
+    os.close(descriptor)
+    try:
+        if extension == ".xlsx":
+            convertir_a_excel(ruta)
+        else:
+            convertir_a_csv_gz(ruta)
+    except Exception:
+        os.remove(ruta)
+        raise
+    return ruta
+
+@st.cache_resource(ttl=3600, show_spinner=False)
+def limpiar_exportaciones():
+    """Borra los temporales de exportación de más de EXPORT_TEMPORAL_HORAS (una vez por hora por proceso)
+
+    Cubre los archivos que quedan si el proceso se corta entre generar una
+    exportación y enviarla al navegador.
+    """
+    extensiones = tuple(extension for extension, _ in FORMATOS_EXPORTACION.values())
+    limite = time.time() - EXPORT_TEMPORAL_HORAS * 3600
+    with os.scandir(tempfile.gettempdir()) as entradas:
+        for entrada in entradas:
+            if not (entrada.name.startswith(EXPORT_PREFIJO) and entrada.name.endswith(extensiones)):
+                continue
+            try:
+                if entrada.is_file() and entrada.stat().st_mtime < limite:
+                    os.remove(entrada.path)
+            except FileNotFoundError:
+                pass
+
+# --- PARTICIONES Y ARCHIVO ---
+ARCHIVO_DIR = "archivo_inventario"
+RETENCION_MESES = 12  # particiones más antiguas se pueden archivar
+ARCHIVO_LOCK_TIMEOUT = "5s"  # espera máxima del lock exclusivo sobre conteos al separar
+
+def obtener_particiones():
+    """Lista las particiones mensuales de conteos con su tamaño aproximado"""
+    query = text("""
+        SELECT c.relname AS particion,
+               GREATEST(c.reltuples, 0)::bigint AS filas_aprox,
+               pg_size_pretty(pg_total_relation_size(c.oid)) AS tamano
+        FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = 'conteos'::regclass
+          AND c.relname ~ '^conteos_[0-9]{4}_[0-9]{2}$'
+        ORDER BY c.relname
+    """)
+    with engine.connect() as conn:
+        return pd.read_sql(query, conn)
+
+def particiones_archivables(particiones):
+    """Devuelve las particiones anteriores al período de retención"""
+    hoy = datetime.now()
+    mes_limite = hoy.year * 12 + hoy.month - 1 - RETENCION_MESES
+    limite = f"conteos_{mes_limite // 12:04d}_{mes_limite % 12 + 1:02d}"
+    return [p for p in particiones["particion"] if p < limite]
+
+def archivar_particion(particion):
+    """Guarda una partición como Parquet comprimido y luego la separa y la elimina
+
+    El archivo se escribe con la partición todavía adjunta, sin bloquear
+    conteos. Después, una transacción corta toma el lock exclusivo, verifica
+    que la partición no cambió mientras tanto, la separa y la elimina, y
+    recalcula el stock actual y las varianzas de los productos afectados.
+    Devuelve la ruta del archivo generado.
+    """
+    if not re.fullmatch(r"conteos_\d{4}_\d{2}", particion):
+        raise ValueError(f"Nombre de partición inválido: {particion}")
+    os.makedirs(ARCHIVO_DIR, exist_ok=True)
+    ruta = os.path.join(ARCHIVO_DIR, f"{particion}.parquet")
+    temporal = ruta + ".tmp"
+    with engine.connect() as conn:
+        sin_timeout(conn)
+        # El archivo guarda las filas completas, con los textos de las dimensiones
+        df = pd.read_sql(text(SQL_VISTA_INVENTARIO.format(tabla=particion) + " ORDER BY c.id"), conn)
+    df.to_parquet(temporal, compression="zstd", index=False)
+    
+    claves = df[["almacen", "codigo"]].dropna().drop_duplicates()
+    claves = claves[claves["codigo"] != ""]
+    try:
+        with engine.begin() as conn:
+            # Con una partición DEFAULT no se puede usar DETACH CONCURRENTLY; se
+            # limita la espera del lock para no encolar detrás a toda la app
+            conn.execute(text(f"SET LOCAL lock_timeout = '{ARCHIVO_LOCK_TIMEOUT}'"))
+            conn.execute(text(f"ALTER TABLE conteos DETACH PARTITION {particion}"))
+            cantidad, suma_ids = conn.execute(
+                text(f"SELECT count(*), COALESCE(sum(id), 0) FROM {particion}")
+            ).one()
+            if (cantidad, suma_ids) != (len(df), int(df["id"].sum())):
+                raise ValueError(f"La partición {particion} cambió mientras se archivaba; vuelve a intentarlo")
+            conn.execute(text(f"DROP TABLE {particion}"))
+            # DETACH no dispara los triggers de la tabla: reconciliar el stock
+            # actual y las varianzas, e invalidar cachés y páginas de las
+            # sesiones a mano. volumen_conteos conserva el volumen archivado,
+            # que sigue siendo parte del historial para la clasificación ABC.
+            if not claves.empty:
+                params = {"almacenes": claves["almacen"].tolist(), "codigos": claves["codigo"].tolist()}
+                conn.execute(
+                    text("SELECT refrescar_stock_actual(CAST(:almacenes AS text[]), CAST(:codigos AS text[]))"),
+                    params
+                )
+                conn.execute(text("""
+                    INSERT INTO varianzas_pendientes (almacen, codigo)
+                    SELECT * FROM unnest(CAST(:almacenes AS text[]), CAST(:codigos AS text[]))
+                    ON CONFLICT DO NOTHING
+                """), params)
+            conn.execute(text("UPDATE versiones SET version = version + 1 WHERE nombre = 'inventario'"))
+            conn.execute(text("INSERT INTO cambios_inventario (operacion, id) VALUES ('T', 0)"))
+    except Exception:
+        os.remove(temporal)
+        raise
+    os.replace(temporal, ruta)
+    return ruta
+
+# --- TABLERO EN VIVO (LISTEN/NOTIFY) ---
+# Un hilo por proceso escucha el canal conteos con una sola conexión y
+# reparte los cambios a las sesiones suscritas. Cada sesión solo lee de
+# memoria sus eventos pendientes; las filas nuevas se leen una vez por aviso.
+CANAL_CONTEOS = "conteos"
+TABLERO_FILAS = 100           # conteos más recientes que muestra el tablero
+TABLERO_EVENTOS_MAX = 500     # eventos en espera por sesión antes de pedir recarga
+TABLERO_INACTIVO_S = 600      # se descarta la suscripción de una sesión que no lee
+TABLERO_ESPERA_S = 5          # espera máxima de cada select() del hilo
+
+Tablero = namedtuple("Tablero", ["suscriptores", "candado", "estado", "hilo"])
+
+def _publicar(tablero, evento):
+    """Agrega un evento a la cola de cada sesión suscrita"""
+    with tablero.candado:
+        for suscriptor in tablero.suscriptores.values():
+            if len(suscriptor["eventos"]) >= TABLERO_EVENTOS_MAX:
+                # La sesión no alcanza a leer: que recargue en vez de acumular
+                suscriptor["eventos"] = [{"tipo": "recargar"}]
+            else:
+                suscriptor["eventos"].append(evento)
+
+def _podar_suscriptores(tablero):
+    """Descarta las suscripciones de sesiones que dejaron de leer"""
+    limite = time.monotonic() - TABLERO_INACTIVO_S
+    with tablero.candado:
+        for id_sesion in [i for i, s in tablero.suscriptores.items() if s["visto"] < limite]:
+            del tablero.suscriptores[id_sesion]
+
+def _procesar_aviso(tablero, carga):
+    """Convierte un aviso del canal en un evento para las sesiones"""
+    aviso = json.loads(carga)
+    if aviso.get("recargar"):
+        _publicar(tablero, {"tipo": "recargar"})
+    elif aviso["op"] == "D":
+        _publicar(tablero, {"tipo": "borrados", "ids": aviso["ids"]})
+    else:
+        with engine.connect() as conn:
+            filas = pd.read_sql(
+                text("SELECT * FROM inventario WHERE id = ANY(:ids)"),
+                conn, params={"ids": aviso["ids"]}, dtype=TIPOS_HISTORIAL
+            )
+        _publicar(tablero, {"tipo": "nuevos", "filas": filas})
+
+def _bucle_tablero(tablero):
+    """Escucha el canal de conteos y se reconecta con espera creciente si se corta"""
+    motor = create_engine(
+        DATABASE_URL_LISTEN, poolclass=NullPool,
+        connect_args={"application_name": "inventario-ciclico-tablero", "keepalives": 1, "keepalives_idle": 30}
+    )
+    espera = 1
+    while True:
+        conexion = None
+        try:
+            conexion = motor.raw_connection()
+            pg = conexion.driver_connection
+            pg.autocommit = True
+            with pg.cursor() as cursor:
+                cursor.execute(f"LISTEN {CANAL_CONTEOS}")
+            if tablero.estado["reconexiones"]:
+                # Durante el corte se pudieron perder avisos
+                _publicar(tablero, {"tipo": "recargar"})
+            tablero.estado.update(conectado=True, ultimo_error=None)
+            espera = 1
+            while True:
+                if select.select([pg], [], [], TABLERO_ESPERA_S) == ([], [], []):
+                    _podar_suscriptores(tablero)
+                    continue
+                pg.poll()
+                while pg.notifies:
+                    aviso = pg.notifies.pop(0)
+                    tablero.estado["avisos"] += 1
+                    try:
+                        _procesar_aviso(tablero, aviso.payload)
+                    except Exception as e:
+                        tablero.estado["ultimo_error"] = str(e)
+                        _publicar(tablero, {"tipo": "recargar"})
+        except Exception as e:
+            tablero.estado.update(conectado=False, ultimo_error=str(e))
+            tablero.estado["reconexiones"] += 1
+            if conexion is not None:
+                try:
+                    conexion.close()
+                except Exception:
+                    pass
+            time.sleep(espera)
+            espera = min(espera * 2, 60)
+
+@st.cache_resource
+def iniciar_tablero():
+    """Inicia el hilo que escucha los avisos de conteos, compartido por todas las sesiones"""
+    tablero = Tablero(
+        suscriptores={},
+        candado=threading.Lock(),
+        estado={"conectado": False, "ultimo_error": None, "avisos": 0, "reconexiones": 0},
+        hilo=None
+    )
+    hilo = threading.Thread(target=_bucle_tablero, args=(tablero,), name="tablero-inventario", daemon=True)
+    hilo.start()
+    return tablero._replace(hilo=hilo)
+
+def suscribir_tablero(id_sesion):
+    """Suscribe una sesión al tablero; si ya lo estaba, descarta sus eventos pendientes"""
+    tablero = iniciar_tablero()
+    with tablero.candado:
+        tablero.suscriptores[id_sesion] = {"eventos": [], "visto": time.monotonic()}
+
+def leer_eventos_tablero(id_sesion):
+    """Devuelve y vacía los eventos pendientes de una sesión, o None si no está suscrita"""
+    tablero = iniciar_tablero()
+    with tablero.candado:
+        suscriptor = tablero.suscriptores.get(id_sesion)
+        if suscriptor is None:
+            return None
+        eventos, suscriptor["eventos"] = suscriptor["eventos"], []
+        suscriptor["visto"] = time.monotonic()
+    return eventos
+
+def desuscribir_tablero(id_sesion):
+    """Quita la suscripción de una sesión al tablero"""
+    tablero = iniciar_tablero()
+    with tablero.candado:
+        tablero.suscriptores.pop(id_sesion, None)
+
+def aplicar_eventos_tablero(df, eventos, desde):
+    """Aplica los eventos del tablero a sus filas y devuelve las TABLERO_FILAS más recientes
+
+    Las filas nuevas anteriores a desde se ignoran; una fila que ya estaba
+    (llegó por la carga inicial y por un aviso) se conserva una sola vez.
+    """
+    for evento in eventos:
+        if evento["tipo"] == "borrados":
+            df = df[~df["id"].isin(evento["ids"])]
+        elif evento["tipo"] == "nuevos":
+            nuevas = evento["filas"][evento["filas"]["fecha_hora"] >= pd.Timestamp(desde)]
+            if not nuevas.empty:
+                df = pd.concat([df[~df["id"].isin(nuevas["id"])], nuevas], ignore_index=True)
+    df = df.sort_values(["fecha_hora", "id"], ascending=False, ignore_index=True).iloc[:TABLERO_FILAS]
+    return df.astype({c: t for c, t in TIPOS_HISTORIAL.items() if c in df.columns})
@@ -1,14 +1,42 @@
 import streamlit as st
 import pandas as pd
-import json
 import re
-import io
-from datetime import datetime
 import os
-from sqlalchemy import create_engine, text
+import uuid
+from datetime import datetime, timedelta
+from sqlalchemy.exc import OperationalError, InterfaceError
+
+from inventario_datos import (
+    ALMACENES, ARCHIVO_DIR, CANTIDAD_MAXIMA, DB_POOL_PRE_PING, DB_POOL_RECYCLE,
+    DB_STATEMENT_TIMEOUT_MS, ENVIOS_VISIBLES, FiltrosHistorial, FORMATOS_EXPORTACION,
+    HISTORIAL_DIAS, HISTORIAL_PAGINA, LINEAS, PERFILAR, PERFILES_DIR, RETENCION_MESES,
+    TABLERO_FILAS, VARIANZA_ABS_UMBRAL, VARIANZA_PCT_UMBRAL, agregar_producto,
+    aplicar_eventos_tablero, archivar_particion, asegurar_particiones, buscar_productos,
+    cerrar_medicion, crear_registro, desuscribir_tablero, diario_contar_pendientes,
+    diario_estados, editar_producto, eliminar_producto, eliminar_registros, encolar_registro,
+    encolar_registros, estado_pool, etiquetas_registros, generar_exportacion, hay_registros,
+    importar_registros, indice_catalogo, indice_catalogo_local, iniciar_escritor,
+    iniciar_medicion, iniciar_tablero, init_db, leer_eventos_tablero, leer_planilla,
+    limpiar_exportaciones, obtener_historial, obtener_particiones, obtener_plan,
+    obtener_productos_descartados, obtener_resumen, obtener_stock_actual, obtener_varianzas,
+    particiones_archivables, podar_cambios, preparar_importacion, refrescar_historial,
+    registrar_envio, suscribir_tablero, tramo, validar_lote, version_datos
+)
+
+# --- MEDICIÓN DEL RERUN ---
+if 'id_sesion' not in st.session_state:
+    st.session_state.id_sesion = str(uuid.uuid4())
+if st.session_state.get('medicion') is not None:
+    # El rerun anterior se cortó con st.rerun() o st.stop() antes del final
+    cerrar_medicion(st.session_state.medicion, completa=False)
+st.session_state.medicion = iniciar_medicion(
+    st.session_state.id_sesion, perfilar=st.session_state.get('perfilar', PERFILAR)
+)
 
-DATABASE_URL = st.secrets["DATABASE_URL"]
-engine = create_engine(DATABASE_URL)
+def mostrar_tabla(df, **kwargs):
+    """Muestra un DataFrame y suma su tamaño a la medición del rerun"""
+    registrar_envio(df)
+    st.dataframe(df, **kwargs)
 
 # Configuración de la página
 st.set_page_config(page_title="Inventario Cíclico - Sulfatos", page_icon="🏭")
@@ -16,675 +44,92 @@ st.set_page_config(page_title="Inventario Cíclico - Sulfatos", page_icon="🏭"
 st.title("🏭 Sistema de Inventario Cíclico - Sulfatos")
 st.write("Registro de inventario con base de datos permanente")
 
-# --- CONFIGURACIÓN ARCHIVOS ---
-DB_PATH = "inventario.db"
-CATALOGO_PATH = "catalogo_productos.json"
-
-# --- LÍNEAS DISPONIBLES ---
-LINEAS = [
-    "Magnesio", "Magnesio Suelo", "Fierro", "Nitrato de Magnesio", 
-    "Zinc Hepta", "Zinc Mono", "Azufre", "Sulfato de Potasio", 
-    "Nitrato de Calcio", "Manganeso", "Nitrato de Potasio", "Cobre", 
-    "Fosfato Monoamonico", "Acido Borico", "Acido Fosforico", 
-    "Quelatos", "Otras"
-]
-
-# --- FUNCIONES DEL CATÁLOGO ---
-def cargar_catalogo():
-    """Carga el catálogo desde archivo JSON o crea uno por defecto"""
-    try:
-        with open(CATALOGO_PATH, 'r', encoding='utf-8') as f:
-            catalogo = json.load(f)
-            return catalogo
-    except FileNotFoundError:
-        catalogo_default = {
-            "Sulfato de Magnesio Heptahidratado (PT)": {
-                "codigo": "PT0000000093",
-                "presentacion": "Sacos x 25 kg",
-                "factor": 25,
-                "unidad": "kg",
-                "clasificacion": "Producto Terminado",
-                "linea": "Magnesio"
-            },
-            "Oxido de Magnesio (PT)": {
-                "codigo": "PT000000174",
-                "presentacion": "Sacos x 25 kg",
-                "factor": 25,
-                "unidad": "kg",
-                "clasificacion": "Producto Terminado",
-                "linea": "Magnesio"
-            },
-            "Sulfato de Magnesio Heptahidratado SQM (PT)": {
-                "codigo": "PT000000153",
-                "presentacion": "Sacos x 25 kg",
-                "factor": 25,
-                "unidad": "kg",
-                "clasificacion": "Producto Terminado",
-                "linea": "Magnesio"
-            },
-            "Sulfato de Magnesio Heptahidratado - Quiagral (PT)": {
-                "codigo": "PT000000156",
-                "presentacion": "Sacos x 25 kg",
-                "factor": 25,
-                "unidad": "kg",
-                "clasificacion": "Producto Terminado",
-                "linea": "Magnesio"
-            },
-            "Sulfato de Magnesio Heptahidratado - Industrial (PT)": {
-                "codigo": "PT000000191",
-                "presentacion": "Sacos x 25 kg",
-                "factor": 25,
-                "unidad": "kg",
-                "clasificacion": "Producto Terminado",
-                "linea": "Magnesio"
-            },
-            # Magnesio Suelo
-            "Sulfato de Magnesio Suelo (PT)": {
-                "codigo": "PT000000245",
-                "presentacion": "Sacos x 25 kg",
-                "factor": 25,
-                "unidad": "kg",
-                "clasificacion": "Producto Terminado",
-                "linea": "Magnesio Suelo"
-            },
-            "Sulfato de Magnesio Suelo (MRC)": {
-                "codigo": "MRC000000015",
-                "presentacion": "Sacos x 25 kg",
-                "factor": 25,
-                "unidad": "kg",
-                "clasificacion": "Mercaderia",
-                "linea": "Magnesio Suelo"
-            },
-            # Nitrato de Magnesio
-            "Nitrato de Magnesio Hexahidratado (PT)": {
-                "codigo": "PT000000230",
-                "presentacion": "Sacos x 25 kg",
-                "factor": 25,
-                "unidad": "kg",
-                "clasificacion": "Producto Terminado",
-                "linea": "Nitrato de Magnesio"
-            },
-            "Nitrato de Magnesio Hexahidratado (MRC)": {
-                "codigo": "MRC000000053",
-                "presentacion": "Sacos x 25 kg",
-                "factor": 25,
-                "unidad": "kg",
-                "clasificacion": "Mercaderia",
-                "linea": "Nitrato de Magnesio"
-            },
-            # Fierro
-            "Sulfato Ferroso Heptahidratado C/C (PT)": {
-                "codigo": "PT000000130",
-                "presentacion": "Sacos x 25 kg",
-                "factor": 25,
-                "unidad": "kg",
-                "clasificacion": "Producto Terminado",
-                "linea": "Fierro"
-            },
-            "Sulfato Ferroso Tetrahidratado (PT)": {
-                "codigo": "PT0000000117",
-                "presentacion": "Sacos x 25 kg",
-                "factor": 25,
-                "unidad": "kg",
-                "clasificacion": "Producto Terminado",
-                "linea": "Fierro"
-            },
-            "Sulfato Ferroso Heptahidratado S/C (PT)": {
-                "codigo": "PT0000000111",
-                "presentacion": "Sacos x 25 kg",
-                "factor": 25,
-                "unidad": "kg",
-                "clasificacion": "Producto Terminado",
-                "linea": "Fierro"
-            },
-            "Sulfato Ferroso Heptahidratado - Fermagri (PT)": {
-                "codigo": "PT0000000114",
-                "presentacion": "Sacos x 25 kg",
-                "factor": 25,
-                "unidad": "kg",
-                "clasificacion": "Producto Terminado",
-                "linea": "Fierro"
-            },
-            "Sulfato Ferroso Heptahidratado - Quiagral (PT)": {
-                "codigo": "PT000000138",
-                "presentacion": "Sacos x 25 kg",
-                "factor": 25,
-                "unidad": "kg",
-                "clasificacion": "Producto Terminado",
-                "linea": "Fierro"
-            },
-            "Sulfato Ferroso Heptahidratado S/C USP (PT)": {
-                "codigo": "PT0000000113",
-                "presentacion": "Tambor x 25 kg",
-                "factor": 25,
-                "unidad": "kg",
-                "clasificacion": "Producto Terminado",
-                "linea": "Fierro"
-            },
-            "Sulfato Ferroso Monohidratado USP (PT)": {
-                "codigo": "PT0000000116",
-                "presentacion": "Tambor x 25 kg",
-                "factor": 25,
-                "unidad": "kg",
-                "clasificacion": "Producto Terminado",
-                "linea": "Fierro"
-            },
-            "Sulfato Ferroso Monohidratado (MRC)": {
-                "codigo": "MRC000000048",
-                "presentacion": "Sacos x 25 kg",
-                "factor": 25,
-                "unidad": "kg",
-                "clasificacion": "Mercaderia",
-                "linea": "Fierro"
-            },
-            "Sulfato Ferroso Heptahidratado Paletizado (PT)": {
-                "codigo": "PT000000189",
-                "presentacion": "Sacos x 25 kg",
-                "factor": 25,
-                "unidad": "kg",
-                "clasificacion": "Producto Terminado",
-                "linea": "Fierro"
-            },
-            # Zinc Hepta
-            "Sulfato de Zinc Heptahidratado (MRC)": {
-                "codigo": "MRC000000021",
-                "presentacion": "Sacos x 25 kg",
-                "factor": 25,
-                "unidad": "kg",
-                "clasificacion": "Mercaderia",
-                "linea": "Zinc Hepta"
-            },
-            "Sulfato de Zinc Heptahidratado - Nexa el Porvenir (PT)": {
-                "codigo": "PT0000000104",
-                "presentacion": "Sacos x 25 kg",
-                "factor": 25,
-                "unidad": "kg",
-                "clasificacion": "Producto Terminado",
-                "linea": "Zinc Hepta"
-            },
-            "Sulfato de Zinc Heptahidratado (PT)": {
-                "codigo": "PT0000000173",
-                "presentacion": "Sacos x 25 kg",
-                "factor": 25,
-                "unidad": "kg",
-                "clasificacion": "Producto Terminado",
-                "linea": "Zinc Hepta"
-            },
-            "Sulfato de Zinc Heptahidratado PT Bigbag x 1 TM (PT)": {
-                "codigo": "PT0000000145",
-                "presentacion": "Bigbag x 1000 kg",
-                "factor": 1000,
-                "unidad": "kg",
-                "clasificacion": "Producto Terminado",
-                "linea": "Zinc Hepta"
-            },
-            "Sulfato de Zinc Heptahidratado PT Bigbag x 1.5 TM (PT)": {
-                "codigo": "PT0000000174",
-                "presentacion": "Bigbag x 1500 kg",
-                "factor": 1500,
-                "unidad": "kg",
-                "clasificacion": "Producto Terminado",
-                "linea": "Zinc Hepta"
-            },
-            "Sulfato de Zinc Heptahidratado - Diamond (PT)": {
-                "codigo": "PT0000000163",
-                "presentacion": "Sacos x 25 kg",
-                "factor": 25,
-                "unidad": "kg",
-                "clasificacion": "Producto Terminado",
-                "linea": "Zinc Hepta"
-            },
-            "Sulfato de Zinc Heptahidratado - Quiagral (PT)": {
-                "codigo": "PT0000000140",
-                "presentacion": "Sacos x 25 kg",
-                "factor": 25,
-                "unidad": "kg",
-                "clasificacion": "Producto Terminado",
-                "linea": "Zinc Hepta"
-            },
-            # Zinc Mono
-            "Sulfato de Zinc Monohidratado 1 TM - Exportacion (PT)": {
-                "codigo": "PT0000000126",
-                "presentacion": "Bigbag x 1000 kg",
-                "factor": 1000,
-                "unidad": "kg",
-                "clasificacion": "Producto Terminado",
-                "linea": "Zinc Mono"
-            },
-            "Sulfato de Zinc Monohidratado - Antamina (PT)": {
-                "codigo": "PT000000182",
-                "presentacion": "Bigbag x 1000 kg",
-                "factor": 1000,
-                "unidad": "kg",
-                "clasificacion": "Producto Terminado",
-                "linea": "Zinc Mono"
-            },
-            "Sulfato de Zinc Monohidratado AFG (MRC)": {
-                "codigo": "MRC000000024",
-                "presentacion": "Sacos x 25 kg",
-                "factor": 25,
-                "unidad": "kg",
-                "clasificacion": "Mercaderia",
-                "linea": "Zinc Mono"
-            },
-            "Sulfato de Zinc Monohidratado (PT)": {
-                "codigo": "PT000000181",
-                "presentacion": "Sacos x 25 kg",
-                "factor": 25,
-                "unidad": "kg",
-                "clasificacion": "Producto Terminado",
-                "linea": "Zinc Mono"
-            },
-            # Azufre
-            "Azufre Puro Granulado (PT)": {
-                "codigo": "PT000000209",
-                "presentacion": "Sacos x 25 kg",
-                "factor": 25,
-                "unidad": "kg",
-                "clasificacion": "Producto Terminado",
-                "linea": "Azufre"
-            },
-            "Fungisulf WP (PT)": {
-                "codigo": "PT000000188",
-                "presentacion": "Sacos x 25 kg",
-                "factor": 25,
-                "unidad": "kg",
-                "clasificacion": "Producto Terminado",
-                "linea": "Azufre"
-            },
-            "Fungisulf DP-400 (PT)": {
-                "codigo": "PT000000187",
-                "presentacion": "Sacos x 25 kg",
-                "factor": 25,
-                "unidad": "kg",
-                "clasificacion": "Producto Terminado",
-                "linea": "Azufre"
-            },
-            "Azufre Puro Micronizado (PT)": {
-                "codigo": "PT000000216",
-                "presentacion": "Sacos x 25 kg",
-                "factor": 25,
-                "unidad": "kg",
-                "clasificacion": "Producto Terminado",
-                "linea": "Azufre"
-            },
-            # Sulfato de Potasio
-            "Sulfato de potasio (MRC)": {
-                "codigo": "MRC000000019",
-                "presentacion": "Sacos x 25 kg",
-                "factor": 25,
-                "unidad": "kg",
-                "clasificacion": "Mercaderia",
-                "linea": "Sulfato de Potasio"
-            },
-            "Sulfato de potasio (PT)": {
-                "codigo": "PT000000134",
-                "presentacion": "Sacos x 25 kg",
-                "factor": 25,
-                "unidad": "kg",
-                "clasificacion": "Producto Terminado",
-                "linea": "Sulfato de Potasio"
-            },
-            # Nitrato de Calcio
-            "Nitrato de Calcio/Granular (PT)": {
-                "codigo": "PT000000173",
-                "presentacion": "Sacos x 25 kg",
-                "factor": 25,
-                "unidad": "kg",
-                "clasificacion": "Producto Terminado",
-                "linea": "Nitrato de Calcio"
-            },
-            "Nitrato de Calcio Tetrahidratado Cristalizado (PT)": {
-                "codigo": "PT000000171",
-                "presentacion": "Sacos x 25 kg",
-                "factor": 25,
-                "unidad": "kg",
-                "clasificacion": "Producto Terminado",
-                "linea": "Nitrato de Calcio"
-            },
-            "Nitrato de Calcio/Amonio (MRC)": {
-                "codigo": "MRC000000029",
-                "presentacion": "Sacos x 25 kg",
-                "factor": 25,
-                "unidad": "kg",
-                "clasificacion": "Mercaderia",
-                "linea": "Nitrato de Calcio"
-            },
-            # Manganeso
-            "Sulfato de Manganeso Monohidratado (PT)": {
-                "codigo": "PT0000000094",
-                "presentacion": "Sacos x 25 kg",
-                "factor": 25,
-                "unidad": "kg",
-                "clasificacion": "Producto Terminado",
-                "linea": "Manganeso"
-            },
-            "Sulfato de Manganeso Monohidratado al 31% (MRC)": {
-                "codigo": "MRC000000018",
-                "presentacion": "Bigbag x 1000 kg",
-                "factor": 1000,
-                "unidad": "kg",
-                "clasificacion": "Mercaderia",
-                "linea": "Manganeso"
-            },
-            # Nitrato de Potasio
-            "Nitrato de Potasio (MRC)": {
-                "codigo": "MRC000000030",
-                "presentacion": "Sacos x 25 kg",
-                "factor": 25,
-                "unidad": "kg",
-                "clasificacion": "Mercaderia",
-                "linea": "Nitrato de Potasio"
-            },
-            "Nitrato de Potasio (PT)": {
-                "codigo": "PT000000195",
-                "presentacion": "Sacos x 25 kg",
-                "factor": 25,
-                "unidad": "kg",
-                "clasificacion": "Producto Terminado",
-                "linea": "Nitrato de Potasio"
-            },
-            # Cobre
-            "Oxicloruro de Cobre (MRC)": {
-                "codigo": "MRC000000009",
-                "presentacion": "Sacos x 25 kg",
-                "factor": 25,
-                "unidad": "kg",
-                "clasificacion": "Mercaderia",
-                "linea": "Cobre"
-            },
-            "Sulfato de Cobre Pentahidratado - Marcobre (MRC)": {
-                "codigo": "MRC000000010",
-                "presentacion": "Sacos x 25 kg",
-                "factor": 25,
-                "unidad": "kg",
-                "clasificacion": "Mercaderia",
-                "linea": "Cobre"
-            },
-            "Sulfato de Cobre Pentahidratado (PT)": {
-                "codigo": "PT000000231",
-                "presentacion": "Sacos x 25 kg",
-                "factor": 25,
-                "unidad": "kg",
-                "clasificacion": "Producto Terminado",
-                "linea": "Cobre"
-            },
-            "Sulfato de Cobre Pentahidratado - Nacol (MRC)": {
-                "codigo": "MRC000000011",
-                "presentacion": "Sacos x 25 kg",
-                "factor": 25,
-                "unidad": "kg",
-                "clasificacion": "Mercaderia",
-                "linea": "Cobre"
-            },
-            # Fosfato Monoamonico
-            "Fosfato Monoamonico (PT)": {
-                "codigo": "PT000000229",
-                "presentacion": "Sacos x 25 kg",
-                "factor": 25,
-                "unidad": "kg",
-                "clasificacion": "Producto Terminado",
-                "linea": "Fosfato Monoamonico"
-            },
-            "Fosfato Monoamonico (MRC)": {
-                "codigo": "MRC000000036",
-                "presentacion": "Sacos x 25 kg",
-                "factor": 25,
-                "unidad": "kg",
-                "clasificacion": "Mercaderia",
-                "linea": "Fosfato Monoamonico"
-            },
-            # Acido Borico
-            "Acido Borico Granulado (MRC)": {
-                "codigo": "MRC000000043",
-                "presentacion": "Sacos x 25 kg",
-                "factor": 25,
-                "unidad": "kg",
-                "clasificacion": "Mercaderia",
-                "linea": "Acido Borico"
-            },
-            "Acido Borico (PT)": {
-                "codigo": "PT000000244",
-                "presentacion": "Sacos x 25 kg",
-                "factor": 25,
-                "unidad": "kg",
-                "clasificacion": "Producto Terminado",
-                "linea": "Acido Borico"
-            },
-            # Acido Fosforico
-            "Acido Fosforico al 85 % - Grado Tecnico (MRC)": {
-                "codigo": "MRC000000040",
-                "presentacion": "Bidon x 35 kg",
-                "factor": 35,
-                "unidad": "kg",
-                "clasificacion": "Mercaderia",
-                "linea": "Acido Fosforico"
-            },
-            "Acido Fosforico (PT)": {
-                "codigo": "PT000000133",
-                "presentacion": "Bidon x 33.65 kg",
-                "factor": 33.65,
-                "unidad": "kg",
-                "clasificacion": "Producto Terminado",
-                "linea": "Acido Fosforico"
-            },
-            "Acido Fosforico al 85 % - Grado Alimenticio (MRC)": {
-                "codigo": "MRC000000001",
-                "presentacion": "Bidon x 35 kg",
-                "factor": 35,
-                "unidad": "kg",
-                "clasificacion": "Mercaderia",
-                "linea": "Acido Fosforico"
-            },
-            # Quelatos
-            "Organikel Vida Plus (20 lt)": {
-                "codigo": "PT000000200",
-                "presentacion": "Bidon x 20 lt",
-                "factor": 20,
-                "unidad": "lt",
-                "clasificacion": "Producto Terminado",
-                "linea": "Quelatos"
-            },
-            "Organikel Vida Plus (1 lt)": {
-                "codigo": "PT000000199",
-                "presentacion": "Frasco x 1 lt",
-                "factor": 1,
-                "unidad": "lt",
-                "clasificacion": "Producto Terminado",
-                "linea": "Quelatos"
-            },
-            "Citrato de Magnesio (1 lt)": {
-                "codigo": "PT0000000001",
-                "presentacion": "Frasco x 1 lt",
-                "factor": 1,
-                "unidad": "lt",
-                "clasificacion": "Producto Terminado",
-                "linea": "Quelatos"
-            },
-            "Sulcopenta F-4 (20 lt)": {
-                "codigo": "PT000000263",
-                "presentacion": "Bidon x 20 lt",
-                "factor": 20,
-                "unidad": "lt",
-                "clasificacion": "Producto Terminado",
-                "linea": "Quelatos"
-            },
-            "Sulcopenta (20 lt)": {
-                "codigo": "PT0000000070",
-                "presentacion": "Bidon x 20 lt",
-                "factor": 20,
-                "unidad": "lt",
-                "clasificacion": "Producto Terminado",
-                "linea": "Quelatos"
-            },
-            "Sulcopenta F-4 (1 lt)": {
-                "codigo": "PT000000264",
-                "presentacion": "Frasco x 1 lt",
-                "factor": 1,
-                "unidad": "lt",
-                "clasificacion": "Producto Terminado",
-                "linea": "Quelatos"
-            },
-            "Sulcopenta F-3 (1 lt)": {
-                "codigo": "PT000000206",
-                "presentacion": "Frasco x 1 lt",
-                "factor": 1,
-                "unidad": "lt",
-                "clasificacion": "Producto Terminado",
-                "linea": "Quelatos"
-            },
-            "Organikel Zinc Plus 25% (1 lt)": {
-                "codigo": "PT000000236",
-                "presentacion": "Frasco x 1 lt",
-                "factor": 1,
-                "unidad": "lt",
-                "clasificacion": "Producto Terminado",
-                "linea": "Quelatos"
-            },
-            "Organikel NPK 5-50-5 (1 lt)": {
-                "codigo": "PT0000000057",
-                "presentacion": "Frasco x 1 lt",
-                "factor": 1,
-                "unidad": "lt",
-                "clasificacion": "Producto Terminado",
-                "linea": "Quelatos"
-            },
-            "Organikel NPK 5-50-5 (20 lt)": {
-                "codigo": "PT0000000044",
-                "presentacion": "Bidon x 20 lt",
-                "factor": 20,
-                "unidad": "lt",
-                "clasificacion": "Producto Terminado",
-                "linea": "Quelatos"
-            },
-            "Organikel PK 0-40-40 (1 lt)": {
-                "codigo": "PT000000148",
-                "presentacion": "Frasco x 1 lt",
-                "factor": 1,
-                "unidad": "lt",
-                "clasificacion": "Producto Terminado",
-                "linea": "Quelatos"
-            },
-            "Organikel PK 0-40-40 (20 lt)": {
-                "codigo": "PT0000000047",
-                "presentacion": "Bidon x 20 lt",
-                "factor": 20,
-                "unidad": "lt",
-                "clasificacion": "Producto Terminado",
-                "linea": "Quelatos"
-            },
-            "Organikel Magnesio 14.5% (20 lt)": {
-                "codigo": "PT000000221",
-                "presentacion": "Bidon x 20 lt",
-                "factor": 20,
-                "unidad": "lt",
-                "clasificacion": "Producto Terminado",
-                "linea": "Quelatos"
-            }
-        }
-        guardar_catalogo(catalogo_default)
-        return catalogo_default
-
-def guardar_catalogo(catalogo):
-    """Guarda el catálogo en archivo JSON"""
-    with open(CATALOGO_PATH, 'w', encoding='utf-8') as f:
-        json.dump(catalogo, f, ensure_ascii=False, indent=2)
-
-# Cargar catálogo
-CATALOGO_PRODUCTOS = cargar_catalogo()
-
-# --- CONFIGURACIÓN SQLITE ---
-def get_connection():
-    """Devuelve una conexión a PostgreSQL"""
-    return engine.connect()
-
-def init_db():
-    """Crea la tabla en PostgreSQL si no existe"""
-    with engine.connect() as conn:
-        conn.execute(text("""
-            CREATE TABLE IF NOT EXISTS inventario (
-                id SERIAL PRIMARY KEY,
-                fecha_hora TIMESTAMP,
-                codigo VARCHAR(100),
-                producto VARCHAR(255),
-                clasificacion VARCHAR(100),
-                linea VARCHAR(100),
-                presentacion VARCHAR(100),
-                cantidad_unidades INTEGER,
-                total_kg_lt NUMERIC,
-                unidad_medida VARCHAR(50),
-                almacen VARCHAR(100),
-                responsable VARCHAR(100),
-                observaciones TEXT,
-                estado VARCHAR(50) DEFAULT 'Pendiente'
-            )
-        """))
-        conn.commit()
-
-def guardar_registro(datos):
-    """Guarda un registro en PostgreSQL"""
-    with engine.connect() as conn:
-        conn.execute(text("""
-            INSERT INTO inventario 
-            (fecha_hora, codigo, producto, clasificacion, linea, presentacion, 
-             cantidad_unidades, total_kg_lt, unidad_medida, almacen, 
-             responsable, observaciones)
-            VALUES 
-            (:fecha_hora, :codigo, :producto, :clasificacion, :linea, :presentacion,
-             :cantidad_unidades, :total_kg_lt, :unidad_medida, :almacen,
-             :responsable, :observaciones)
-        """), {
-            "fecha_hora": datos['fecha_hora'],
-            "codigo": datos['codigo'],
-            "producto": datos['producto'],
-            "clasificacion": datos['clasificacion'],
-            "linea": datos['linea'],
-            "presentacion": datos['presentacion'],
-            "cantidad_unidades": datos['cantidad_unidades'],
-            "total_kg_lt": datos['total_kg_lt'],
-            "unidad_medida": datos['unidad_medida'],
-            "almacen": datos['almacen'],
-            "responsable": datos['responsable'],
-            "observaciones": datos['observaciones']
-        })
-        conn.commit()
-
-def obtener_inventario():
-    """Obtiene todos los registros desde PostgreSQL"""
-    query = text("SELECT * FROM inventario ORDER BY fecha_hora DESC")
-    
-    with engine.connect() as conn:
-        df = pd.read_sql(query, conn)
-    
-    return df
-
-def eliminar_registro(id_registro):
-    """Elimina un registro de la base de datos por ID"""
-    with get_connection() as conn:
-        cursor = conn.cursor()
-        cursor.execute("DELETE FROM inventario WHERE id = ?", (id_registro,))
-        conn.commit()
-
-# Inicializar base de datos
-init_db()
-
-# --- DATOS PERSONALIZADOS ---
-ALMACENES = [
-    "Almacen A", "Almacen D", "Almacen E", "Almacen F", "Almacen G",
-    "Almacen 13 (Sullana)", "Almacen 3 (Ica)", "Ferrofert (Paita)"
-]
+# Inicializar base de datos y cargar catálogo. Sin conexión, la app sigue
+# registrando conteos en el diario local con la última copia del catálogo.
+SIN_CONEXION = None
+limpiar_exportaciones()
+try:
+    with tramo("init_db"):
+        init_db()
+        asegurar_particiones()
+        podar_cambios()
+    with tramo("catalogo"):
+        INDICE_CATALOGO = indice_catalogo()
+except (OperationalError, InterfaceError) as e:
+    SIN_CONEXION = e.orig or e
+    INDICE_CATALOGO = indice_catalogo_local()
+CATALOGO_PRODUCTOS = INDICE_CATALOGO.catalogo
 
 # --- INICIALIZAR SESSION STATE ---
 if 'linea_filtro' not in st.session_state:
     st.session_state.linea_filtro = "Todas"
-if 'producto_sel' not in st.session_state:
-    st.session_state.producto_sel = list(CATALOGO_PRODUCTOS.keys())[0]
+if st.session_state.get('producto_sel') not in CATALOGO_PRODUCTOS:
+    # Sesión nueva, o el producto fue eliminado del catálogo
+    st.session_state.producto_sel = INDICE_CATALOGO.nombres[0]
 if 'cantidad_val' not in st.session_state:
     st.session_state.cantidad_val = 0
+if 'envios' not in st.session_state:
+    st.session_state.envios = []
 
 # --- SECCIÓN 1: AGREGAR PRODUCTO ---
 st.header("➕ Registrar nuevo conteo")
 
+# PLAN DEL DÍA
+st.subheader("🗓️ Plan de conteo del día")
+if SIN_CONEXION is not None:
+    st.warning(
+        "📡 Sin conexión con la base de datos: los conteos se guardan en este equipo "
+        "y se sincronizan automáticamente al volver la conexión."
+    )
+almacen_plan = st.selectbox("Almacén del plan", ALMACENES, key="plan_almacen")
+if SIN_CONEXION is None:
+    with tramo("plan"):
+        plan_hoy = obtener_plan(version_datos(), datetime.now().date(), almacen_plan)
+else:
+    plan_hoy = pd.DataFrame(columns=["producto", "clase", "dias_atraso", "contado"])
+pendientes_plan = plan_hoy[~plan_hoy["contado"]]
+siguiente_plan = None
+if not pendientes_plan.empty and pendientes_plan.iloc[0]["producto"] in CATALOGO_PRODUCTOS:
+    siguiente_plan = pendientes_plan.iloc[0]
+
+# Una sesión nueva abre directamente en el siguiente producto del plan
+if 'plan_inicial' not in st.session_state:
+    st.session_state.plan_inicial = True
+    if siguiente_plan is not None:
+        st.session_state.producto_sel = siguiente_plan["producto"]
+        st.session_state.form_almacen = almacen_plan
+
+if plan_hoy.empty:
+    st.info("No hay productos pendientes de conteo para hoy en este almacén.")
+else:
+    st.progress(
+        (len(plan_hoy) - len(pendientes_plan)) / len(plan_hoy),
+        text=f"{len(plan_hoy) - len(pendientes_plan)} de {len(plan_hoy)} productos contados"
+    )
+    if siguiente_plan is not None:
+        col_p1, col_p2 = st.columns([3, 1])
+        with col_p1:
+            if pd.isna(siguiente_plan['dias_atraso']):
+                atraso_plan = "nunca contado en este almacén"
+            else:
+                atraso_plan = f"{siguiente_plan['dias_atraso']:.0f} días de atraso"
+            st.write(
+                f"**Siguiente:** {siguiente_plan['producto']} (clase {siguiente_plan['clase']}, {atraso_plan})"
+            )
+        with col_p2:
+            if st.button("📍 Contar ahora", key="plan_contar"):
+                # Los selectores conservan su valor propio: se alinean antes de crearlos
+                st.session_state.linea_filtro = "Todas"
+                st.session_state.linea_select = "Todas"
+                st.session_state.buscar_producto = ""
+                st.session_state.producto_sel = siguiente_plan["producto"]
+                st.session_state.producto_select = siguiente_plan["producto"]
+                st.session_state.form_almacen = almacen_plan
+                st.session_state.cantidad_val = 0
+                st.rerun()
+    with st.expander("Ver plan completo"):
+        mostrar_tabla(plan_hoy, hide_index=True, use_container_width=True)
+
 # FILTRO POR LÍNEA
 st.subheader("Paso 1: Selecciona la línea de producción")
 
@@ -708,22 +153,13 @@ linea_seleccionada = st.selectbox(
 # Si cambió la línea, actualizar
 if linea_seleccionada != linea_anterior:
     st.session_state.linea_filtro = linea_seleccionada
-    if linea_seleccionada == "Todas":
-        st.session_state.producto_sel = list(CATALOGO_PRODUCTOS.keys())[0]
-    else:
-        productos_linea = [n for n, d in CATALOGO_PRODUCTOS.items() if d.get("linea") == linea_seleccionada]
-        if productos_linea:
-            st.session_state.producto_sel = productos_linea[0]
+    productos_linea = INDICE_CATALOGO.por_linea.get(linea_seleccionada, ())
+    if productos_linea:
+        st.session_state.producto_sel = productos_linea[0]
     st.rerun()
 
 # Filtrar productos por línea
-if st.session_state.linea_filtro == "Todas":
-    productos_filtrados = list(CATALOGO_PRODUCTOS.keys())
-else:
-    productos_filtrados = [
-        nombre for nombre, datos in CATALOGO_PRODUCTOS.items() 
-        if datos.get("linea") == st.session_state.linea_filtro
-    ]
+productos_filtrados = INDICE_CATALOGO.por_linea.get(st.session_state.linea_filtro, ())
 
 if not productos_filtrados:
     st.warning(f"No hay productos en la línea '{st.session_state.linea_filtro}'")
@@ -732,15 +168,25 @@ if not productos_filtrados:
 # SELECCIONAR PRODUCTO
 st.subheader("Paso 2: Selecciona el producto")
 
+busqueda_producto = st.text_input(
+    "Buscar por nombre o código (busca en todas las líneas)", key="buscar_producto"
+)
+if busqueda_producto:
+    opciones_producto = buscar_productos(INDICE_CATALOGO, busqueda_producto)
+    if not opciones_producto:
+        st.warning(f"No se encontraron productos para '{busqueda_producto}'")
+        opciones_producto = productos_filtrados
+    posiciones = {nombre: i for i, nombre in enumerate(opciones_producto)}
+else:
+    opciones_producto = productos_filtrados
+    posiciones = INDICE_CATALOGO.posicion[st.session_state.linea_filtro]
+
 producto_anterior = st.session_state.producto_sel
-try:
-    index_producto = productos_filtrados.index(st.session_state.producto_sel)
-except ValueError:
-    index_producto = 0
+index_producto = posiciones.get(st.session_state.producto_sel, 0)
 
 producto_desc = st.selectbox(
     "Producto", 
-    options=productos_filtrados,
+    options=opciones_producto,
     index=index_producto,
     key="producto_select"
 )
@@ -766,6 +212,7 @@ with col_cant:
     cantidad_unidades = st.number_input(
         "Cantidad de unidades contadas *", 
         min_value=0, 
+        max_value=CANTIDAD_MAXIMA,
         value=st.session_state.cantidad_val,
         key="cantidad_input"
     )
@@ -797,33 +244,253 @@ if guardar:
     elif cantidad_unidades <= 0:
         st.error("❌ La cantidad debe ser mayor a 0")
     else:
-        datos = {
-            'fecha_hora': datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-            'codigo': datos_producto["codigo"],
-            'producto': st.session_state.producto_sel,
-            'clasificacion': clasificacion_auto,
-            'linea': linea_auto,
-            'presentacion': datos_producto["presentacion"],
-            'cantidad_unidades': cantidad_unidades,
-            'total_kg_lt': total_calculado,
-            'unidad_medida': unidad_label,
-            'almacen': almacen,
-            'responsable': responsable,
-            'observaciones': observaciones
-        }
-        guardar_registro(datos)
-        st.success(f"✅ Guardado: {st.session_state.producto_sel} | {cantidad_unidades} unidades = {total_calculado} {unidad_label}")
+        datos = crear_registro(
+            CATALOGO_PRODUCTOS, st.session_state.producto_sel, cantidad_unidades,
+            almacen, responsable, observaciones
+        )
+        encolar_registro(datos)
+        st.session_state.envios.append({
+            "ids": [datos["id_cliente"]],
+            "texto": f"{st.session_state.producto_sel} | {cantidad_unidades} unidades = {total_calculado} {unidad_label}"
+        })
+        st.session_state.envios = st.session_state.envios[-ENVIOS_VISIBLES:]
         st.session_state.cantidad_val = 0
         st.rerun()
 
+def estado_envio(envio):
+    """Resume el estado de sincronización de todos los registros de un envío"""
+    estados = diario_estados(envio["ids"]).values()
+    errores = [estado for estado in estados if estado.startswith("error")]
+    if errores:
+        return errores[0]
+    if "en cola" in estados:
+        return "en cola"
+    if all(estado == "duplicado" for estado in estados):
+        return "duplicado"
+    return "guardado"
+
+def mostrar_envios():
+    """Muestra el estado de los últimos envíos de la sesión y de la sincronización
+
+    Devuelve True si alguno sigue en cola.
+    """
+    pendientes = False
+    for envio in reversed(st.session_state.envios):
+        estado = estado_envio(envio)
+        if estado == "en cola":
+            pendientes = True
+            st.caption(f"⏳ En cola: {envio['texto']}")
+        elif estado.startswith("error"):
+            st.caption(f"❌ No se pudo guardar: {envio['texto']} ({estado})")
+        elif estado == "duplicado":
+            st.caption(f"♻️ Ya estaba guardado: {envio['texto']}")
+        else:
+            st.caption(f"✅ Guardado: {envio['texto']}")
+    
+    escritor = iniciar_escritor()
+    en_espera = diario_contar_pendientes()
+    if en_espera:
+        st.caption(f"📡 {en_espera} conteos de este equipo esperan sincronización")
+    if escritor.estado["ultimo_error"]:
+        st.caption(f"⚠️ {escritor.estado['ultimo_error']}")
+    return pendientes
+
+@st.fragment(run_every=1)
+def seguir_envios():
+    """Refresca el estado de los envíos y recarga la página cuando todos se guardaron"""
+    if not mostrar_envios():
+        st.rerun()
+
+if any(estado_envio(envio) == "en cola" for envio in st.session_state.envios):
+    seguir_envios()
+else:
+    mostrar_envios()
+
+# --- REGISTRO POR LOTE ---
+if 'lote_id' not in st.session_state:
+    st.session_state.lote_id = 0
+
+with st.expander("📦 Registrar un lote de conteos (por pasillo)"):
+    st.write("Agrega una fila por producto contado y guarda todo el lote de una vez:")
+    lote = st.data_editor(
+        pd.DataFrame({
+            "producto": pd.Series(dtype="object"),
+            "cantidad_unidades": pd.Series(dtype="Int64")
+        }),
+        num_rows="dynamic",
+        column_config={
+            "producto": st.column_config.SelectboxColumn(
+                "Producto", options=INDICE_CATALOGO.nombres, required=True
+            ),
+            "cantidad_unidades": st.column_config.NumberColumn(
+                "Cantidad de unidades", min_value=0, max_value=CANTIDAD_MAXIMA, step=1, required=True
+            ),
+        },
+        use_container_width=True,
+        key=f"lote_editor_{st.session_state.lote_id}"
+    )
+    
+    col_l1, col_l2 = st.columns(2)
+    with col_l1:
+        almacen_lote = st.selectbox("Almacén", ALMACENES, key="lote_almacen")
+    with col_l2:
+        responsable_lote = st.text_input("Responsable del conteo *", key="lote_responsable")
+    observaciones_lote = st.text_input("Observaciones (opcional)", key="lote_obs")
+    
+    if st.button("💾 Guardar lote en base de datos", key="lote_guardar"):
+        registros_lote, errores_lote = validar_lote(lote, CATALOGO_PRODUCTOS, almacen_lote, responsable_lote, observaciones_lote)
+        if not responsable_lote:
+            st.error("❌ Debes ingresar el responsable del conteo")
+        elif errores_lote:
+            for error in errores_lote:
+                st.error(f"❌ {error}")
+        elif not registros_lote:
+            st.warning("El lote está vacío")
+        else:
+            encolar_registros(registros_lote)
+            st.session_state.envios.append({
+                "ids": [r["id_cliente"] for r in registros_lote],
+                "texto": f"Lote de {len(registros_lote)} registros ({almacen_lote})"
+            })
+            st.session_state.envios = st.session_state.envios[-ENVIOS_VISIBLES:]
+            st.session_state.lote_id += 1
+            st.rerun()
+
+# --- MODO ESCÁNER ---
+if 'cola_escaneo' not in st.session_state:
+    st.session_state.cola_escaneo = []
+
+def registrar_escaneo():
+    """Resuelve el código leído por el escáner y lo agrega a la cola"""
+    codigo = st.session_state.escaneo_codigo.strip()
+    st.session_state.escaneo_codigo = ""
+    st.session_state.escaneo_error = None
+    if not codigo:
+        return
+    nombre = INDICE_CATALOGO.por_codigo.get(codigo) or INDICE_CATALOGO.por_codigo.get(codigo.upper())
+    if nombre is None:
+        st.session_state.escaneo_error = f"El código '{codigo}' no está en el catálogo"
+        return
+    cantidad = st.session_state.escaneo_cantidad
+    cola = st.session_state.cola_escaneo
+    # Lecturas consecutivas del mismo producto se acumulan en una sola fila
+    if cola and cola[-1]["producto"] == nombre:
+        if cola[-1]["cantidad_unidades"] + cantidad > CANTIDAD_MAXIMA:
+            st.session_state.escaneo_error = f"La fila de '{nombre}' no puede superar {CANTIDAD_MAXIMA:,} unidades"
+            return
+        cola[-1]["cantidad_unidades"] += cantidad
+    else:
+        cola.append({"codigo": CATALOGO_PRODUCTOS[nombre]["codigo"], "producto": nombre, "cantidad_unidades": cantidad})
+
+with st.expander("🔫 Modo escáner (código de barras / QR)"):
+    st.write("Escanea el código del producto; cada lectura se agrega a la cola y la cola se guarda de una vez.")
+    col_s1, col_s2 = st.columns([3, 1])
+    with col_s1:
+        st.text_input("Código escaneado", key="escaneo_codigo", on_change=registrar_escaneo)
+    with col_s2:
+        st.number_input("Unidades por lectura", min_value=1, max_value=CANTIDAD_MAXIMA, value=1, key="escaneo_cantidad")
+    if st.session_state.get("escaneo_error"):
+        st.error(f"❌ {st.session_state.escaneo_error}")
+    
+    cola = st.session_state.cola_escaneo
+    if cola:
+        cola_df = pd.DataFrame(cola)
+        cola_df["presentacion"] = [CATALOGO_PRODUCTOS[n]["presentacion"] for n in cola_df["producto"]]
+        cola_df["total"] = [
+            c * CATALOGO_PRODUCTOS[n].get("factor", 1) for n, c in zip(cola_df["producto"], cola_df["cantidad_unidades"])
+        ]
+        cola_df["unidad"] = [CATALOGO_PRODUCTOS[n].get("unidad", "kg") for n in cola_df["producto"]]
+        mostrar_tabla(cola_df, hide_index=True, use_container_width=True)
+        
+        col_s3, col_s4 = st.columns(2)
+        with col_s3:
+            almacen_escaneo = st.selectbox("Almacén", ALMACENES, key="escaneo_almacen")
+        with col_s4:
+            responsable_escaneo = st.text_input("Responsable del conteo *", key="escaneo_responsable")
+        
+        col_s5, col_s6, col_s7 = st.columns(3)
+        with col_s5:
+            if st.button("💾 Guardar cola", type="primary", key="escaneo_guardar"):
+                faltantes = [fila["producto"] for fila in cola if fila["producto"] not in CATALOGO_PRODUCTOS]
+                if not responsable_escaneo:
+                    st.error("❌ Debes ingresar el responsable del conteo")
+                elif faltantes:
+                    st.error(f"❌ Productos eliminados del catálogo: {', '.join(faltantes)}")
+                else:
+                    fecha_hora = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+                    registros_escaneo = [
+                        crear_registro(CATALOGO_PRODUCTOS, fila["producto"], fila["cantidad_unidades"],
+                                       almacen_escaneo, responsable_escaneo, "Modo escáner", fecha_hora)
+                        for fila in cola
+                    ]
+                    encolar_registros(registros_escaneo)
+                    st.session_state.envios.append({
+                        "ids": [r["id_cliente"] for r in registros_escaneo],
+                        "texto": f"Cola del escáner: {len(registros_escaneo)} registros ({almacen_escaneo})"
+                    })
+                    st.session_state.envios = st.session_state.envios[-ENVIOS_VISIBLES:]
+                    st.session_state.cola_escaneo = []
+                    st.rerun()
+        with col_s6:
+            if st.button("↩️ Quitar último", key="escaneo_quitar"):
+                cola.pop()
+                st.rerun()
+        with col_s7:
+            if st.button("🗑️ Vaciar cola", key="escaneo_vaciar"):
+                st.session_state.cola_escaneo = []
+                st.rerun()
+
+# Sin conexión solo se registran conteos; el resto de la app lee PostgreSQL
+if SIN_CONEXION is not None:
+    st.divider()
+    st.info(f"El historial, el stock y la administración vuelven al recuperar la conexión ({SIN_CONEXION}).")
+    if st.button("🔄 Reintentar conexión", key="reintentar_conexion"):
+        st.rerun()
+    st.stop()
+
+# --- IMPORTAR PLANILLA ---
+with st.expander("📤 Importar planilla de conteo (CSV / XLSX)"):
+    st.write(
+        "La planilla debe tener las columnas **codigo**, **cantidad**, **almacen** y **responsable**. "
+        "Opcionalmente **fecha_hora** y **observaciones**."
+    )
+    archivo_planilla = st.file_uploader("Planilla de conteo", type=["csv", "xlsx"], key="import_archivo")
+    if archivo_planilla is not None:
+        try:
+            aceptados, rechazados = preparar_importacion(leer_planilla(archivo_planilla), INDICE_CATALOGO)
+        except ValueError as e:
+            st.error(f"❌ {e}")
+        else:
+            col_i1, col_i2 = st.columns(2)
+            with col_i1:
+                st.metric("Filas válidas", len(aceptados))
+            with col_i2:
+                st.metric("Filas rechazadas", len(rechazados))
+            
+            if not rechazados.empty:
+                mostrar_tabla(rechazados, hide_index=True, use_container_width=True)
+                st.download_button(
+                    label="Descargar filas rechazadas",
+                    data=rechazados.to_csv(index=False).encode("utf-8"),
+                    file_name="filas_rechazadas.csv",
+                    mime="text/csv",
+                    key="import_rechazados"
+                )
+            
+            if st.button(f"Importar {len(aceptados)} registros", disabled=aceptados.empty, key="import_confirmar"):
+                with st.spinner("Importando..."):
+                    insertados = importar_registros(aceptados)
+                omitidos = len(aceptados) - insertados
+                st.success(f"✅ {insertados} registros importados" + (f" ({omitidos} ya existían)" if omitidos else ""))
+
 st.divider()
 
 # --- SECCIÓN 2: MOSTRAR INVENTARIO ---
 st.header("📋 Historial de inventario")
 
-df = obtener_inventario()
+version = version_datos()
 
-if not df.empty:
+if hay_registros(version):
     st.subheader("🔍 Filtros")
     col_f1, col_f2, col_f3 = st.columns(3)
     with col_f1:
@@ -833,90 +500,137 @@ if not df.empty:
     with col_f3:
         filtro_linea_hist = st.multiselect("Filtrar por Línea", LINEAS, key="hist_linea")
     
-    df_filtrado = df.copy()
-    if filtro_almacen:
-        df_filtrado = df_filtrado[df_filtrado["almacen"].isin(filtro_almacen)]
-    if filtro_clasificacion:
-        df_filtrado = df_filtrado[df_filtrado["clasificacion"].isin(filtro_clasificacion)]
-    if filtro_linea_hist:
-        df_filtrado = df_filtrado[df_filtrado["linea"].isin(filtro_linea_hist)]
+    hoy = datetime.now().date()
+    rango_fechas = st.date_input(
+        "Rango de fechas",
+        value=(hoy - timedelta(days=HISTORIAL_DIAS), hoy),
+        key="hist_rango"
+    )
+    # Mientras se elige el rango, date_input devuelve solo la fecha inicial
+    fecha_desde = rango_fechas[0] if len(rango_fechas) > 0 else None
+    fecha_hasta = rango_fechas[1] if len(rango_fechas) > 1 else None
+    
+    filtros = FiltrosHistorial(
+        tuple(filtro_almacen), tuple(filtro_clasificacion), tuple(filtro_linea_hist),
+        desde=fecha_desde, hasta=fecha_hasta
+    )
+    # Al cambiar los filtros se vuelve a la primera página
+    if st.session_state.get("hist_filtros") != filtros:
+        st.session_state.hist_filtros = filtros
+        st.session_state.hist_cursores = [None]
+    
+    with tramo("historial"):
+        if st.session_state.hist_cursores[-1] is None:
+            # La primera página se conserva en la sesión y se actualiza con los cambios
+            st.session_state.hist_sesion = refrescar_historial(
+                st.session_state.get("hist_sesion"), filtros, version
+            )
+            df_pagina = st.session_state.hist_sesion.df
+            cursor_siguiente = st.session_state.hist_sesion.siguiente
+        else:
+            df_pagina, cursor_siguiente = obtener_historial(version, filtros, st.session_state.hist_cursores[-1])
     
     columnas_mostrar = ['fecha_hora', 'codigo', 'producto', 'linea', 'clasificacion', 
                        'presentacion', 'cantidad_unidades', 'total_kg_lt', 'unidad_medida', 
                        'almacen', 'responsable', 'observaciones']
-    df_display = df_filtrado[columnas_mostrar] if all(col in df_filtrado.columns for col in columnas_mostrar) else df_filtrado
+    # column_order elige las columnas sin copiar la página
+    mostrar_tabla(df_pagina, column_order=columnas_mostrar, use_container_width=True)
+    
+    col_pag1, col_pag2, col_pag3 = st.columns([1, 2, 1])
+    with col_pag1:
+        if st.button("⬅️ Anterior", disabled=len(st.session_state.hist_cursores) == 1, key="hist_anterior"):
+            st.session_state.hist_cursores.pop()
+            st.rerun()
+    with col_pag2:
+        st.caption(f"Página {len(st.session_state.hist_cursores)}")
+    with col_pag3:
+        if st.button("Siguiente ➡️", disabled=cursor_siguiente is None, key="hist_siguiente"):
+            st.session_state.hist_cursores.append(cursor_siguiente)
+            st.rerun()
     
-    st.dataframe(df_display, use_container_width=True)
+    with tramo("resumen"):
+        resumen = obtener_resumen(version, filtros)
+    totales = resumen[resumen["nivel"] == "Total"].iloc[0]
     
     st.subheader("📊 Resumen")
     col_r1, col_r2, col_r3, col_r4 = st.columns(4)
     with col_r1:
-        st.metric("Total registros", len(df_filtrado))
+        st.metric("Total registros", int(totales["registros"]))
     with col_r2:
-        total_unidades = df_filtrado["cantidad_unidades"].sum() if "cantidad_unidades" in df_filtrado.columns else 0
-        st.metric("Total unidades", int(total_unidades))
+        st.metric("Total unidades", int(totales["total_unidades"]))
     with col_r3:
-        total_kg = df_filtrado[df_filtrado["unidad_medida"] == "kg"]["total_kg_lt"].sum() if "unidad_medida" in df_filtrado.columns else 0
-        st.metric("Total KG", f"{total_kg:,.0f}")
+        st.metric("Total KG", f"{totales['total_kg']:,.0f}")
     with col_r4:
-        total_lt = df_filtrado[df_filtrado["unidad_medida"] == "lt"]["total_kg_lt"].sum() if "unidad_medida" in df_filtrado.columns else 0
-        st.metric("Total LT", f"{total_lt:,.0f}")
+        st.metric("Total LT", f"{totales['total_lt']:,.0f}")
     
-    def convertir_a_excel(df):
-        output = io.BytesIO()
-        df_export = df.copy()
-        if "id" in df_export.columns:
-            df_export = df_export.sort_values(by="id", ascending=True)
-        df_export.columns = [
-            col.replace("_", " ").title()
-            for col in df_export.columns
-        ]
-        with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
-            df_export.to_excel(writer, index=False, sheet_name='Inventario')
-        output.seek(0)
-        return output
-
-    excel_file = convertir_a_excel(df)
-
-    st.download_button(
-        label="Descargar Excel completo",
-        data=excel_file,
-        file_name="inventario_completo.xlsx",
-        mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+    with st.expander("Desglose por almacén y línea"):
+        columnas_desglose = ["grupo", "registros", "total_unidades", "total_kg", "total_lt"]
+        col_d1, col_d2 = st.columns(2)
+        with col_d1:
+            st.caption("Por almacén")
+            mostrar_tabla(resumen[resumen["nivel"] == "Almacén"][columnas_desglose], hide_index=True, use_container_width=True)
+        with col_d2:
+            st.caption("Por línea")
+            mostrar_tabla(resumen[resumen["nivel"] == "Línea"][columnas_desglose], hide_index=True, use_container_width=True)
+    
+    # --- EXPORTACIÓN BAJO DEMANDA ---
+    st.subheader("📥 Exportar historial completo")
+    formato_export = st.radio(
+        "Formato", list(FORMATOS_EXPORTACION.keys()), horizontal=True, key="export_formato"
     )
+    if st.button("Generar archivo", key="export_generar"):
+        with st.spinner("Generando archivo..."):
+            try:
+                with tramo("exportacion"):
+                    ruta = generar_exportacion(formato_export)
+            except ValueError as e:
+                st.error(f"❌ {e}")
+                ruta = None
+        # El botón de descarga se muestra solo en este rerun: Streamlit copia
+        # el archivo a memoria al crearlo, así que el temporal se borra enseguida
+        if ruta is not None:
+            extension, mime = FORMATOS_EXPORTACION[formato_export]
+            registrar_envio(os.path.getsize(ruta))
+            try:
+                with open(ruta, "rb") as archivo:
+                    st.download_button(
+                        label="Descargar archivo",
+                        data=archivo,
+                        file_name=f"inventario_completo{extension}",
+                        mime=mime
+                    )
+            finally:
+                os.remove(ruta)
     
     # --- SECCIÓN ELIMINAR REGISTRO ---
     st.divider()
     st.subheader("🗑️ Eliminar registro del historial")
     
-    # Crear lista desplegable con registros formateados
-    opciones_registros = []
-    for idx, row in df.iterrows():
-        texto = f"ID {row['id']} - {row['fecha_hora']} | {row['producto']} | {row['cantidad_unidades']} unidades | {row['responsable']}"
-        opciones_registros.append((row['id'], texto))
-    
-    # Mostrar solo los textos en el selectbox
-    registro_seleccionado = st.selectbox(
-        "Selecciona el registro a eliminar",
-        options=[opt[1] for opt in opciones_registros],
-        key="registro_a_eliminar"
+    busqueda_eliminar = st.text_input(
+        "Buscar por ID, producto, código o responsable (respeta los filtros de arriba)",
+        key="buscar_eliminar"
     )
+    with tramo("selector_eliminar"):
+        df_candidatos, cursor_mas = obtener_historial(version, filtros._replace(busqueda=busqueda_eliminar))
+        opciones_registros = etiquetas_registros(df_candidatos)
+    if cursor_mas is not None:
+        st.caption(f"Se muestran los {HISTORIAL_PAGINA} registros más recientes; refina la búsqueda para ver otros")
     
-    # Obtener el ID correspondiente al texto seleccionado
-    id_a_eliminar = None
-    for opt_id, opt_texto in opciones_registros:
-        if opt_texto == registro_seleccionado:
-            id_a_eliminar = opt_id
-            break
+    ids_a_eliminar = st.multiselect(
+        "Selecciona los registros a eliminar",
+        options=list(opciones_registros.keys()),
+        format_func=opciones_registros.get,
+        key="registros_a_eliminar"
+    )
     
     col_del1, col_del2 = st.columns(2)
     with col_del1:
         confirmar = st.checkbox("Confirmar eliminación", key="confirmar_delete")
     with col_del2:
-        if st.button("Eliminar registro seleccionado", type="primary", disabled=not confirmar):
-            if id_a_eliminar:
-                eliminar_registro(id_a_eliminar)
-                st.success(f"✅ Registro ID {id_a_eliminar} eliminado correctamente")
+        if st.button("Eliminar registros seleccionados", type="primary", disabled=not confirmar):
+            if ids_a_eliminar:
+                eliminados = eliminar_registros(ids_a_eliminar)
+                st.success(f"✅ {eliminados} registro(s) eliminado(s) correctamente")
                 st.rerun()
     
     if not confirmar:
@@ -925,6 +639,133 @@ if not df.empty:
 else:
     st.info("Aún no hay registros. Agrega tu primer producto arriba.")
 
+# --- SECCIÓN 3: STOCK ACTUAL ---
+st.divider()
+st.header("📦 Stock actual por almacén")
+st.write("Último conteo de cada producto, el conteo anterior y la diferencia entre ambos.")
+
+almacen_stock = st.selectbox("Almacén", ALMACENES, key="stock_almacen")
+with tramo("stock"):
+    stock = obtener_stock_actual(version, almacen_stock)
+if stock.empty:
+    st.info(f"Aún no hay conteos en {almacen_stock}.")
+else:
+    mostrar_tabla(stock, hide_index=True, use_container_width=True)
+
+# --- SECCIÓN 4: VARIANZAS ---
+st.divider()
+st.header("📉 Varianzas entre conteos")
+st.write(
+    f"Diferencia de cada conteo con el anterior del mismo producto y almacén. Se marcan como atípicas "
+    f"las variaciones de al menos {VARIANZA_PCT_UMBRAL}% y {VARIANZA_ABS_UMBRAL} kg/lt."
+)
+col_v1, col_v2 = st.columns(2)
+with col_v1:
+    almacen_varianzas = st.selectbox("Almacén", ["Todos"] + ALMACENES, key="varianzas_almacen")
+with col_v2:
+    solo_atipicas = st.checkbox("Solo atípicas", value=True, key="varianzas_atipicas")
+
+with tramo("varianzas"):
+    varianzas = obtener_varianzas(
+        version, None if almacen_varianzas == "Todos" else almacen_varianzas, solo_atipicas
+    )
+if varianzas.empty:
+    st.info("No hay varianzas para mostrar.")
+else:
+    mostrar_tabla(varianzas, hide_index=True, use_container_width=True)
+
+# --- SECCIÓN 5: TABLERO EN VIVO ---
+st.divider()
+st.header("📡 Tablero en vivo")
+st.write(
+    f"Los últimos {TABLERO_FILAS} conteos de hoy de todos los usuarios. Se actualiza solo "
+    "cuando alguien guarda o elimina un conteo, sin consultar la base en cada refresco."
+)
+
+def cargar_tablero(dia):
+    """Suscribe la sesión y carga los conteos del día; los avisos siguientes se aplican encima"""
+    # Primero la suscripción: un conteo guardado durante la carga llega igual como aviso
+    suscribir_tablero(st.session_state.id_sesion)
+    df, _ = obtener_historial(version_datos(), FiltrosHistorial(desde=dia, hasta=dia), None, TABLERO_FILAS)
+    st.session_state.tablero = {"dia": dia, "df": df}
+
+@st.fragment(run_every=2)
+def tablero_en_vivo():
+    """Aplica los avisos pendientes de la sesión y muestra el tablero"""
+    dia = datetime.now().date()
+    eventos = leer_eventos_tablero(st.session_state.id_sesion)
+    tablero = st.session_state.get("tablero")
+    if (eventos is None or tablero is None or tablero["dia"] != dia
+            or any(evento["tipo"] == "recargar" for evento in eventos)):
+        cargar_tablero(dia)
+    elif eventos:
+        tablero["df"] = aplicar_eventos_tablero(tablero["df"], eventos, dia)
+    df_tablero = st.session_state.tablero["df"]
+    
+    almacen_tablero = st.selectbox("Almacén", ["Todos"] + ALMACENES, key="tablero_almacen")
+    if almacen_tablero != "Todos":
+        df_tablero = df_tablero[df_tablero["almacen"] == almacen_tablero]
+    
+    col_t1, col_t2, col_t3 = st.columns(3)
+    with col_t1:
+        st.metric("Conteos", len(df_tablero))
+    with col_t2:
+        st.metric("Total kg/lt", f"{df_tablero['total_kg_lt'].sum():,.2f}")
+    with col_t3:
+        st.metric("Responsables", df_tablero["responsable"].nunique())
+    
+    estado_tablero = iniciar_tablero().estado
+    if not estado_tablero["conectado"]:
+        st.caption(f"⚠️ Reconectando con la base de datos: {estado_tablero['ultimo_error'] or 'iniciando'}")
+    mostrar_tabla(
+        df_tablero, column_order=['fecha_hora', 'producto', 'cantidad_unidades', 'total_kg_lt',
+                                  'unidad_medida', 'almacen', 'responsable'],
+        hide_index=True, use_container_width=True
+    )
+
+if st.checkbox("Seguir los conteos en vivo", key="tablero_activo"):
+    tablero_en_vivo()
+elif st.session_state.pop("tablero", None) is not None:
+    desuscribir_tablero(st.session_state.id_sesion)
+
+# --- ADMINISTRACIÓN: CONEXIONES ---
+with st.expander("🔌 Administración: conexiones a la base de datos"):
+    st.write(
+        f"Timeout por sentencia: {DB_STATEMENT_TIMEOUT_MS} ms · reciclado cada {DB_POOL_RECYCLE} s · "
+        f"pre-ping {'activado' if DB_POOL_PRE_PING else 'desactivado'}"
+    )
+    metricas_pool = estado_pool()
+    columnas_pool = st.columns(len(metricas_pool))
+    for columna_pool, (nombre_metrica, valor_metrica) in zip(columnas_pool, metricas_pool.items()):
+        with columna_pool:
+            st.metric(nombre_metrica.capitalize(), valor_metrica)
+
+# --- ADMINISTRACIÓN: PARTICIONES Y ARCHIVO ---
+with st.expander("🗄️ Administración: particiones y archivo histórico"):
+    st.write(
+        f"El historial se guarda en particiones mensuales. Las de más de {RETENCION_MESES} meses "
+        f"se pueden archivar como Parquet comprimido en `{ARCHIVO_DIR}/` y dejan de consultarse."
+    )
+    particiones = obtener_particiones()
+    mostrar_tabla(particiones, hide_index=True, use_container_width=True)
+    
+    archivables = particiones_archivables(particiones)
+    if archivables:
+        particion_archivar = st.selectbox("Partición a archivar", archivables, key="particion_archivar")
+        if st.button("Archivar partición", key="archivar_confirmar"):
+            try:
+                with st.spinner("Archivando..."):
+                    ruta_archivo = archivar_particion(particion_archivar)
+            except ValueError as e:
+                st.error(f"❌ {e}")
+            except OperationalError as e:
+                st.error(f"❌ No se pudo separar la partición, la base está ocupada: {e.orig or e}")
+            else:
+                st.success(f"✅ Partición archivada en {ruta_archivo}")
+                st.rerun()
+    else:
+        st.info("No hay particiones fuera del período de retención.")
+
 # --- ADMINISTRACIÓN: AGREGAR PRODUCTOS ---
 with st.expander("➕ Administración: Agregar nuevos productos al catálogo"):
     st.write("Aquí puedes agregar productos nuevos sin editar el código:")
@@ -964,35 +805,137 @@ with st.expander("➕ Administración: Agregar nuevos productos al catálogo"):
     
     if agregar:
         if nuevo_nombre and nuevo_codigo:
-            CATALOGO_PRODUCTOS[nuevo_nombre] = {
-                "codigo": nuevo_codigo,
-                "presentacion": nueva_presentacion,
-                "factor": factor_nuevo,
-                "unidad": nueva_unidad,
-                "clasificacion": nueva_clasificacion,
-                "linea": nueva_linea
-            }
-            guardar_catalogo(CATALOGO_PRODUCTOS)
-            st.success(f"✅ Producto '{nuevo_nombre}' agregado correctamente")
-            st.rerun()
+            try:
+                agregar_producto(nuevo_nombre, {
+                    "codigo": nuevo_codigo,
+                    "presentacion": nueva_presentacion,
+                    "factor": factor_nuevo,
+                    "unidad": nueva_unidad,
+                    "clasificacion": nueva_clasificacion,
+                    "linea": nueva_linea
+                })
+            except ValueError as e:
+                st.error(f"❌ {e}")
+            else:
+                st.success(f"✅ Producto '{nuevo_nombre}' agregado correctamente")
+                st.rerun()
         else:
             st.error("❌ Debes completar todos los campos obligatorios (*)")
     
+    # Editar producto existente
+    st.subheader("✏️ Editar producto del catálogo")
+    producto_a_editar = st.selectbox(
+        "Selecciona producto a editar",
+        options=INDICE_CATALOGO.nombres,
+        key="edit_producto"
+    )
+    datos_editar = CATALOGO_PRODUCTOS[producto_a_editar]
+    with st.form(f"form_editar_producto_{datos_editar['codigo']}"):
+        st.caption(f"Código: {datos_editar['codigo']} (no se puede cambiar)")
+        editado_nombre = st.text_input("Descripción del producto *", value=producto_a_editar)
+        col_ep1, col_ep2 = st.columns(2)
+        with col_ep1:
+            clasificaciones = ["Producto Terminado", "Mercadería"]
+            editado_clasificacion = st.selectbox(
+                "Clasificación *", clasificaciones,
+                index=clasificaciones.index(datos_editar.get("clasificacion"))
+                if datos_editar.get("clasificacion") in clasificaciones else 0
+            )
+            editado_presentacion = st.text_input("Presentación *", value=datos_editar.get("presentacion") or "")
+            editado_factor = st.number_input(
+                "Cantidad por unidad *", min_value=0.1, value=float(datos_editar.get("factor", 1))
+            )
+        with col_ep2:
+            editado_linea = st.selectbox(
+                "Línea *", LINEAS,
+                index=LINEAS.index(datos_editar.get("linea")) if datos_editar.get("linea") in LINEAS else 0
+            )
+            editado_unidad = st.selectbox(
+                "Unidad de medida *", ["kg", "lt"], index=1 if datos_editar.get("unidad") == "lt" else 0
+            )
+        editar = st.form_submit_button("Guardar cambios")
+    
+    if editar:
+        if editado_nombre and editado_presentacion:
+            try:
+                editar_producto(datos_editar["codigo"], editado_nombre, {
+                    "presentacion": editado_presentacion,
+                    "factor": editado_factor,
+                    "unidad": editado_unidad,
+                    "clasificacion": editado_clasificacion,
+                    "linea": editado_linea
+                })
+            except ValueError as e:
+                st.error(f"❌ {e}")
+            else:
+                st.success(f"✅ Producto '{editado_nombre}' actualizado")
+                st.rerun()
+        else:
+            st.error("❌ Debes completar todos los campos obligatorios (*)")
+    
+    # Productos del catálogo anterior que no se pudieron cargar
+    descartados = obtener_productos_descartados()
+    if not descartados.empty:
+        st.warning(
+            f"⚠️ {len(descartados)} productos del catálogo anterior no se cargaron porque su código o "
+            "descripción ya estaban en uso. Revísalos y agrégalos con otro código o descripción si corresponde."
+        )
+        mostrar_tabla(descartados, hide_index=True, use_container_width=True)
+    
     # Mostrar catálogo actual
     st.subheader("Catálogo actual")
-    catalogo_df = pd.DataFrame.from_dict(CATALOGO_PRODUCTOS, orient='index')
-    st.dataframe(catalogo_df, use_container_width=True)
+    mostrar_tabla(INDICE_CATALOGO.tabla, use_container_width=True)
     
     # Eliminar producto
     st.subheader("🗑️ Eliminar producto del catálogo")
     producto_a_eliminar = st.selectbox(
         "Selecciona producto a eliminar",
-        options=list(CATALOGO_PRODUCTOS.keys()),
+        options=INDICE_CATALOGO.nombres,
         key="del_producto"
     )
     if st.button("Eliminar producto seleccionado", type="secondary"):
         if producto_a_eliminar in CATALOGO_PRODUCTOS:
-            del CATALOGO_PRODUCTOS[producto_a_eliminar]
-            guardar_catalogo(CATALOGO_PRODUCTOS)
+            eliminar_producto(producto_a_eliminar)
             st.success(f"✅ Producto '{producto_a_eliminar}' eliminado.")
             st.rerun()
+
+# --- ADMINISTRACIÓN: RENDIMIENTO ---
+with st.expander("⏱️ Administración: rendimiento de la página"):
+    st.write(
+        "Mediciones del último rerun completo de esta sesión. Cada rerun también se "
+        "escribe como una línea JSON en el log `inventario.medicion`."
+    )
+    ultima_medicion = st.session_state.get("ultima_medicion")
+    if ultima_medicion is None:
+        st.info("Todavía no hay un rerun completo medido; interactúa con la página.")
+    else:
+        col_r1, col_r2, col_r3, col_r4 = st.columns(4)
+        with col_r1:
+            st.metric("Tiempo total", f"{ultima_medicion['total_ms']:,.0f} ms")
+        with col_r2:
+            st.metric(
+                "Consultas SQL", len(ultima_medicion["consultas"]),
+                f"{ultima_medicion['sql_ms']:,.0f} ms", delta_color="off"
+            )
+        with col_r3:
+            st.metric("Filas leídas", f"{ultima_medicion['filas']:,}")
+        with col_r4:
+            st.metric("Enviado al navegador", f"{ultima_medicion['bytes_enviados'] / 1024:,.0f} KB")
+        st.write("**Tramos**")
+        st.dataframe(pd.DataFrame(ultima_medicion["tramos"]), hide_index=True, use_container_width=True)
+        if ultima_medicion["consultas"]:
+            st.write("**Consultas, de la más lenta a la más rápida**")
+            st.dataframe(
+                pd.DataFrame(ultima_medicion["consultas"]).sort_values("ms", ascending=False),
+                hide_index=True, use_container_width=True
+            )
+        if ultima_medicion["perfil"]:
+            st.caption(f"Perfil guardado en {ultima_medicion['perfil']}")
+    st.checkbox(
+        f"Guardar un perfil de cProfile de cada rerun en '{PERFILES_DIR}'",
+        value=PERFILAR, key="perfilar"
+    )
+
+# Fin del rerun: cerrar la medición
+st.session_state.ultima_medicion = cerrar_medicion(st.session_state.medicion)
+st.session_state.medicion = None
@@ -0,0 +1,43 @@
+"""Pruebas del armado del plan de conteo cíclico"""
+import os
+from datetime import date, datetime
+
+import pandas as pd
+
+# La capa de datos lee DATABASE_URL al importarse; el engine no se conecta hasta usarse
+os.environ.setdefault("DATABASE_URL", "postgresql://localhost/inventario_test")
+
+import inventario_datos as datos
+
+
+def candidatos(ultimas_fechas, volumenes):
+    return pd.DataFrame({
+        "codigo": [f"PT{n:03d}" for n in range(len(volumenes))],
+        "producto": [f"Producto {n}" for n in range(len(volumenes))],
+        "ultima_fecha": ultimas_fechas,
+        "volumen": volumenes,
+    })
+
+
+def test_almacen_nunca_contado():
+    # Sin ningún conteo en el almacén la columna de fechas llega como None sin tipo
+    stock = candidatos([None, None, None], [0, 0, 0])
+    plan = datos.armar_plan(stock, date(2026, 10, 17), "Almacen E")
+    assert [fila["codigo"] for fila in plan] == ["PT000", "PT001", "PT002"]
+    assert all(fila["ultima_fecha"] is None and fila["dias_atraso"] is None for fila in plan)
+
+
+def test_nunca_contado_va_primero():
+    stock = candidatos([datetime(2026, 1, 1), None], [100, 100])
+    plan = datos.armar_plan(stock, date(2026, 10, 17), "Almacen A")
+    assert [fila["codigo"] for fila in plan] == ["PT001", "PT000"]
+    assert plan[1]["dias_atraso"] > 0
+
+
+def test_al_dia_no_entra():
+    stock = candidatos([datetime(2026, 10, 16)], [100])
+    assert datos.armar_plan(stock, date(2026, 10, 17), "Almacen A") == []
+
+
+def test_candidatos_vacios():
+    assert datos.armar_plan(candidatos([], []), date(2026, 10, 17), "Almacen A") == []